@@ -0,0 +1,176 @@
+"""
+Benchmarks of the core functions of the pipeline, timing and peak memory
+usage on synthetic catalogs and maps of various sizes.
+
+Usage:
+    $ asv run
+"""
+import numpy as np
+import healpy as hp
+
+from desc.wlmassmap.shear_map import add_metacal_shear, bin_shear_map
+from desc.wlmassmap.projection import project_flat, project_healpix
+from desc.wlmassmap.kaiser_squires import flat_KS_map, healpix_KS_map
+from desc.wlmassmap.fft_backends import fft_backends
+from desc.wlmassmap.noise_realizations import compute_noise_realizations
+
+from .common import (ngals, map_sizes, nsides, write_catalogs, load_catalog,
+                     flat_projection)
+
+class AddMetacalShear(object):
+    params = [ngals]
+    param_names = ['ngal']
+    timeout = 600
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, ngal):
+        self.catalog = load_catalog(ngal)
+
+    def time_add_metacal_shear(self, ngal):
+        add_metacal_shear(self.catalog)
+
+    def peakmem_add_metacal_shear(self, ngal):
+        add_metacal_shear(self.catalog)
+
+class ProjectFlat(object):
+    params = [ngals, map_sizes]
+    param_names = ['ngal', 'nx']
+    timeout = 600
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, ngal, nx):
+        self.catalog = load_catalog(ngal, columns=['ra', 'dec'])
+        c = flat_projection(nx)
+        self.args = (c['nx'], c['ny'], c['pixel_size'], c['center_ra'],
+                     c['center_dec'])
+
+    def time_project_flat(self, ngal, nx):
+        project_flat(self.catalog, *self.args)
+
+    def peakmem_project_flat(self, ngal, nx):
+        project_flat(self.catalog, *self.args)
+
+class ProjectHealpix(object):
+    params = [ngals, nsides]
+    param_names = ['ngal', 'nside']
+    timeout = 600
+
+    def setup_cache(self):
+        write_catalogs(kinds=('healpix',))
+
+    def setup(self, ngal, nside):
+        self.catalog = load_catalog(ngal, 'healpix', columns=['ra', 'dec'])
+
+    def time_project_healpix(self, ngal, nside):
+        project_healpix(self.catalog, nside)
+
+    def peakmem_project_healpix(self, ngal, nside):
+        project_healpix(self.catalog, nside)
+
+class BinShearMapFlat(object):
+    params = [ngals, map_sizes]
+    param_names = ['ngal', 'nx']
+    timeout = 600
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, ngal, nx):
+        catalog = add_metacal_shear(load_catalog(ngal))
+        c = flat_projection(nx)
+        self.catalog, _, _ = project_flat(catalog, c['nx'], c['ny'],
+                                          c['pixel_size'], c['center_ra'],
+                                          c['center_dec'])
+
+    def time_bin_shear_map(self, ngal, nx):
+        bin_shear_map(self.catalog, nx=nx, ny=nx)
+
+    def peakmem_bin_shear_map(self, ngal, nx):
+        bin_shear_map(self.catalog, nx=nx, ny=nx)
+
+class BinShearMapHealpix(object):
+    params = [ngals, nsides]
+    param_names = ['ngal', 'nside']
+    timeout = 600
+
+    def setup_cache(self):
+        write_catalogs(kinds=('healpix',))
+
+    def setup(self, ngal, nside):
+        catalog = add_metacal_shear(load_catalog(ngal, 'healpix'))
+        self.catalog = project_healpix(catalog, nside)
+
+    def time_bin_shear_map(self, ngal, nside):
+        bin_shear_map(self.catalog, npix=hp.nside2npix(nside))
+
+    def peakmem_bin_shear_map(self, ngal, nside):
+        bin_shear_map(self.catalog, npix=hp.nside2npix(nside))
+
+class FlatKSMap(object):
+    params = [map_sizes, [0, 1]]
+    param_names = ['nx', 'zero_padding']
+
+    def setup(self, nx, zero_padding):
+        self.gmap = np.random.default_rng(0).normal(0, 0.1, (2, nx, nx))
+        # Builds the cached operator outside of the timed function
+        flat_KS_map(self.gmap, zero_padding=zero_padding)
+
+    def time_flat_KS_map(self, nx, zero_padding):
+        flat_KS_map(self.gmap, zero_padding=zero_padding)
+
+    def peakmem_flat_KS_map(self, nx, zero_padding):
+        flat_KS_map(self.gmap, zero_padding=zero_padding)
+
+class FlatKSBackends(object):
+    params = [map_sizes, fft_backends]
+    param_names = ['nx', 'fft_backend']
+
+    def setup(self, nx, fft_backend):
+        self.gmap = np.random.default_rng(0).normal(0, 0.1, (2, nx, nx))
+        # Builds the cached operator and FFT plans outside of the timed
+        # function, unavailable backends are skipped
+        try:
+            flat_KS_map(self.gmap, fft_backend=fft_backend)
+        except ImportError:
+            raise NotImplementedError
+
+    def time_flat_KS_map(self, nx, fft_backend):
+        flat_KS_map(self.gmap, fft_backend=fft_backend)
+
+class HealpixKSMap(object):
+    params = [nsides]
+    param_names = ['nside']
+    timeout = 600
+
+    def setup(self, nside):
+        npix = hp.nside2npix(nside)
+        self.gmap = np.random.default_rng(0).normal(0, 0.1, (2, npix))
+        # Builds the cached filters outside of the timed function
+        healpix_KS_map(self.gmap)
+
+    def time_healpix_KS_map(self, nside):
+        healpix_KS_map(self.gmap)
+
+    def peakmem_healpix_KS_map(self, nside):
+        healpix_KS_map(self.gmap)
+
+class NoiseRealizations(object):
+    params = [ngals, [1, 16]]
+    param_names = ['ngal', 'batch_size']
+    timeout = 1200
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, ngal, batch_size):
+        self.catalog = load_catalog(ngal)
+        self.projection = flat_projection(1024)
+        self.algorithm = {'name': 'flat_ks', 'zero_padding': 64}
+
+    def time_noise_realizations(self, ngal, batch_size):
+        compute_noise_realizations(self.catalog, self.projection,
+                                   self.algorithm, 32, batch_size=batch_size)
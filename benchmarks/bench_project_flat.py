@@ -0,0 +1,77 @@
+"""
+Compares the direct pixel index computation of `project_flat` with the
+previous implementation based on `scipy.stats.binned_statistic_2d` and a copy
+of the catalog restricted to the patch.
+
+Usage:
+    $ python benchmarks/bench_project_flat.py --ngal 10000000 100000000
+"""
+from optparse import OptionParser
+import time
+
+import numpy as np
+from astropy.table import Table
+from scipy.stats import binned_statistic_2d
+
+from desc.wlmassmap.projection import project_flat, flat_grid
+from desc.wlmassmap.projection_utils import radec2xy
+
+def project_flat_binned_statistic(catalog, nx, ny, pixel_size, center_ra,
+                                  center_dec, projection='gnomonic'):
+    """
+    Reference implementation, selecting the galaxies in the patch and
+    digitizing their coordinates with binned_statistic_2d
+    """
+    edges_x, edges_y, grid_ra, grid_dec = flat_grid(nx, ny, pixel_size,
+                                                    center_ra, center_dec,
+                                                    projection)
+    x,y = radec2xy(center_ra, center_dec, catalog['ra'], catalog['dec'])
+    sel = ((x >= edges_x[0]) & (x < edges_x[-1]) &
+           (y >= edges_y[0]) & (y < edges_y[-1]))
+    catalog = catalog[sel]
+    s, xe, ye ,binnumber = binned_statistic_2d(x[sel], y[sel],
+                                               np.ones_like(x[sel]),
+                                               statistic='count',
+                                               bins=(edges_x, edges_y),
+                                               expand_binnumbers=True)
+    binnumber -= 1
+    catalog['pixel_index'] = (binnumber[1,:] * nx + binnumber[0, :])
+    return catalog, grid_ra, grid_dec
+
+def make_catalog(ngal, seed=0):
+    """
+    Uniform catalog over a 10x10 deg patch with metacal shear columns
+    """
+    rng = np.random.default_rng(seed)
+    return Table({'ra': rng.uniform(0, 10, ngal),
+                  'dec': rng.uniform(-5, 5, ngal),
+                  'mcal_g': rng.normal(0, 0.2, (ngal, 2))})
+
+def timeit(func, *args):
+    t0 = time.perf_counter()
+    res = func(*args)
+    return time.perf_counter() - t0, res
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    parser.add_option("--ngal", type=float, action="append",
+                      help="Number of galaxies, can be repeated")
+    parser.add_option("--npix", type=int, default=512,
+                      help="Number of pixels along each side of the map")
+    (options, args) = parser.parse_args()
+
+    # 6x6 deg map, covering a fraction of the catalog
+    nx = ny = options.npix
+    pixel_size = 360. / options.npix
+
+    print("%12s %12s %12s %8s" % ("ngal", "old [s]", "new [s]", "speedup"))
+    for ngal in options.ngal or [1e7]:
+        catalog = make_catalog(int(ngal))
+        t_old, (ref, _, _) = timeit(project_flat_binned_statistic, catalog,
+                                    nx, ny, pixel_size, 5., 0.)
+        del ref
+        t_new, (new, _, _) = timeit(project_flat, catalog, nx, ny, pixel_size,
+                                    5., 0.)
+        print("%12d %12.3f %12.3f %8.1f" % (ngal, t_old, t_new, t_old / t_new))
+        del catalog, new
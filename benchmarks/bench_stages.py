@@ -0,0 +1,220 @@
+"""
+Benchmarks of the pipeline stages, run end to end on synthetic catalogs
+written to disk, including I/O.
+
+Usage:
+    $ asv run
+"""
+import os
+import numpy as np
+
+from desc.wlmassmap.mocks.mock_observation import mock_observation
+from desc.wlmassmap.selection import selection
+from desc.wlmassmap.shear_map import shear_map, shear_map_columns
+from desc.wlmassmap.convergence_map import convergence_map
+from desc.wlmassmap.pipeline import run_pipeline
+
+from .common import (ngals, map_sizes, nsides, write_catalogs,
+                     catalog_filename, flat_projection, load_catalog)
+
+# Stages do not overwrite existing maps, outputs are removed before each run
+def _remove(filename):
+    if os.path.exists(filename):
+        os.remove(filename)
+
+class MockObservation(object):
+    params = [ngals, [0, 1048576]]
+    param_names = ['ngal', 'chunk_size']
+    timeout = 1200
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',), catalogs=('truth',))
+
+    def setup(self, ngal, chunk_size):
+        self.config = {'input_filename': catalog_filename(ngal, 'flat', 'truth'),
+                       'output_filename': 'mock_%d_%d.hdf5' % (ngal, chunk_size),
+                       'reduced_shear': True,
+                       'shape_noise': {'type': 'Gaussian', 'sigma': 0.26},
+                       'format': {'type': 'metacal'},
+                       'chunk_size': chunk_size}
+
+    def teardown(self, ngal, chunk_size):
+        _remove(self.config['output_filename'])
+
+    def time_mock_observation(self, ngal, chunk_size):
+        mock_observation(self.config)
+
+    def peakmem_mock_observation(self, ngal, chunk_size):
+        mock_observation(self.config)
+
+class Selection(object):
+    params = [ngals]
+    param_names = ['ngal']
+    timeout = 1200
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, ngal):
+        self.config = {'input_filename': catalog_filename(ngal),
+                       'output_filename': 'selection_%d.hdf5' % ngal,
+                       'cuts': ["shape['redshift'] > 0.3",
+                                "abs(shape['mcal_g'][:,0]) < 1"]}
+
+    def teardown(self, ngal):
+        _remove(self.config['output_filename'])
+
+    def time_selection(self, ngal):
+        selection(self.config)
+
+    def peakmem_selection(self, ngal):
+        selection(self.config)
+
+class ShearMapFlat(object):
+    params = [ngals, map_sizes, [0, 1048576]]
+    param_names = ['ngal', 'nx', 'chunk_size']
+    timeout = 1200
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, ngal, nx, chunk_size):
+        self.config = {'input_filename': catalog_filename(ngal),
+                       'output_filename': 'shear_map_%d_%d.fits' % (ngal, nx),
+                       'projection': flat_projection(nx),
+                       'chunk_size': chunk_size}
+
+    def teardown(self, ngal, nx, chunk_size):
+        _remove(self.config['output_filename'])
+
+    def time_shear_map(self, ngal, nx, chunk_size):
+        _remove(self.config['output_filename'])
+        shear_map(self.config)
+
+    def peakmem_shear_map(self, ngal, nx, chunk_size):
+        _remove(self.config['output_filename'])
+        shear_map(self.config)
+
+class ShearMapHealpix(object):
+    params = [ngals, nsides, [False, True]]
+    param_names = ['ngal', 'nside', 'partial']
+    timeout = 1200
+
+    def setup_cache(self):
+        write_catalogs(kinds=('healpix',))
+
+    def setup(self, ngal, nside, partial):
+        self.config = {'input_filename': catalog_filename(ngal, 'healpix'),
+                       'output_filename': 'shear_map_%d_%d.fits' % (ngal, nside),
+                       'projection': {'type': 'healpix', 'nside': nside,
+                                      'partial': partial}}
+
+    def teardown(self, ngal, nside, partial):
+        _remove(self.config['output_filename'])
+
+    def time_shear_map(self, ngal, nside, partial):
+        _remove(self.config['output_filename'])
+        shear_map(self.config)
+
+    def peakmem_shear_map(self, ngal, nside, partial):
+        _remove(self.config['output_filename'])
+        shear_map(self.config)
+
+class ConvergenceMapFlat(object):
+    params = [map_sizes]
+    param_names = ['nx']
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+        for nx in map_sizes:
+            filename = 'gmap_flat_%d.fits' % nx
+            _remove(filename)
+            shear_map({'input_filename': catalog_filename(ngals[0]),
+                       'output_filename': filename,
+                       'projection': flat_projection(nx)})
+
+    def setup(self, nx):
+        self.config = {'input_filename': 'gmap_flat_%d.fits' % nx,
+                       'output_filename': 'kappa_flat_%d.fits' % nx,
+                       'algorithm': {'name': 'flat_ks', 'smoothing': 2.}}
+
+    def teardown(self, nx):
+        _remove(self.config['output_filename'])
+
+    def time_convergence_map(self, nx):
+        _remove(self.config['output_filename'])
+        convergence_map(self.config)
+
+    def peakmem_convergence_map(self, nx):
+        _remove(self.config['output_filename'])
+        convergence_map(self.config)
+
+class ConvergenceMapHealpix(object):
+    params = [nsides, [False, True]]
+    param_names = ['nside', 'partial']
+    timeout = 1200
+
+    def setup_cache(self):
+        write_catalogs(kinds=('healpix',))
+        for nside in nsides:
+            for partial in [False, True]:
+                filename = 'gmap_healpix_%d_%d.fits' % (nside, partial)
+                _remove(filename)
+                shear_map({'input_filename': catalog_filename(ngals[0], 'healpix'),
+                           'output_filename': filename,
+                           'projection': {'type': 'healpix', 'nside': nside,
+                                          'partial': partial}})
+
+    def setup(self, nside, partial):
+        self.config = {'input_filename': 'gmap_healpix_%d_%d.fits' % (nside, partial),
+                       'output_filename': 'kappa_healpix_%d.fits' % nside,
+                       'algorithm': {'name': 'healpix_ks', 'lmax': 2 * nside,
+                                     'smoothing': 10.}}
+
+    def teardown(self, nside, partial):
+        _remove(self.config['output_filename'])
+
+    def time_convergence_map(self, nside, partial):
+        _remove(self.config['output_filename'])
+        convergence_map(self.config)
+
+    def peakmem_convergence_map(self, nside, partial):
+        _remove(self.config['output_filename'])
+        convergence_map(self.config)
+
+class Precision(object):
+    """
+    Shear and convergence maps computed in memory in double and single
+    precision. `track_kappa_error` is the accuracy check of the float32 mode:
+    the maximum difference with the float64 convergence map, relative to the
+    standard deviation of the map.
+    """
+    params = [map_sizes, ['float64', 'float32']]
+    param_names = ['nx', 'dtype']
+    timeout = 600
+
+    def setup_cache(self):
+        write_catalogs(kinds=('flat',))
+
+    def setup(self, nx, dtype):
+        self.catalog = load_catalog(ngals[-1], columns=shear_map_columns)
+        self.config = {'shear_map': {'projection': flat_projection(nx)},
+                       'convergence_map': {'algorithm': {'name': 'flat_ks',
+                                                         'smoothing': 2.}},
+                       'dtype': dtype}
+
+    def _run(self, dtype):
+        config = dict(self.config, dtype=dtype)
+        return run_pipeline(config, shape_catalog=self.catalog)['convergence_map']
+
+    def time_pipeline(self, nx, dtype):
+        self._run(dtype)
+
+    def peakmem_pipeline(self, nx, dtype):
+        self._run(dtype)
+
+    def track_kappa_error(self, nx, dtype):
+        reference = self._run('float64')['kappa_e']
+        kappa = self._run(dtype)['kappa_e']
+        return float(np.abs(kappa - reference).max() / reference.std())
+    track_kappa_error.unit = 'relative error'
@@ -0,0 +1,66 @@
+"""
+Shared configuration of the benchmark suite: catalog sizes, footprints and
+synthetic catalogs written once per benchmark run.
+
+The number of galaxies can be overridden with a comma separated list in the
+WLMASSMAP_BENCH_NGAL environment variable, e.g. WLMASSMAP_BENCH_NGAL=1e5,1e8
+"""
+import os
+
+from desc.wlmassmap.mocks.synthetic import (write_synthetic_catalog,
+                                            healpix_footprint)
+from desc.wlmassmap.catalog_io import read_catalog
+from astropy.table import Table
+
+ngals = [int(float(n)) for n in
+         os.environ.get('WLMASSMAP_BENCH_NGAL', '1e5,1e6,1e7').split(',')]
+
+# Flat 10x10 deg patch, mapped with square maps of various sizes
+patch = {'type': 'patch', 'ra_range': [0., 10.], 'dec_range': [-5., 5.]}
+patch_center = (5., 0.)
+patch_size = 600. # arcmin
+map_sizes = [256, 1024, 2048]
+
+# Disc of 10 deg radius, mapped on HEALpix maps of various resolutions
+disc = {'nside': 32, 'center_ra': 40., 'center_dec': -30., 'radius': 10.}
+nsides = [256, 512, 1024]
+
+def footprint(kind):
+    """
+    Returns the flat or healpix footprint of the benchmark catalogs
+    """
+    if kind == 'flat':
+        return patch
+    return healpix_footprint(disc['nside'], disc['center_ra'],
+                             disc['center_dec'], disc['radius'])
+
+def catalog_filename(ngal, kind='flat', catalog='shape'):
+    return 'synthetic_%s_%s_%d.hdf5' % (catalog, kind, ngal)
+
+def write_catalogs(kinds=('flat', 'healpix'), catalogs=('shape',)):
+    """
+    Writes the synthetic catalogs used by the benchmarks in the current
+    directory, to be called from `setup_cache`
+    """
+    for kind in kinds:
+        for catalog in catalogs:
+            for ngal in ngals:
+                filename = catalog_filename(ngal, kind, catalog)
+                if not os.path.exists(filename):
+                    write_synthetic_catalog(filename, ngal, footprint(kind),
+                                            kind=catalog)
+
+def load_catalog(ngal, kind='flat', catalog='shape', columns=None):
+    """
+    Loads a synthetic catalog written by `write_catalogs` as a Table
+    """
+    return Table(read_catalog(catalog_filename(ngal, kind, catalog), columns),
+                 copy=False)
+
+def flat_projection(nx):
+    """
+    Projection configuration of a nx x nx map covering the patch
+    """
+    return {'type': 'gnomonic', 'nx': nx, 'ny': nx,
+            'pixel_size': patch_size / nx,
+            'center_ra': patch_center[0], 'center_dec': patch_center[1]}
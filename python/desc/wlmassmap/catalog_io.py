@@ -0,0 +1,240 @@
+# This module provides column selective, memory mapped access to the FITS and
+# HDF5 catalogs read by the different stages
+import numpy as np
+from astropy.io import fits
+import h5py
+
+from .instrumentation import span
+
+class CatalogReader(object):
+    """
+    Lazy reader for a table stored in a FITS or HDF5 file.
+
+    Nothing is read when the file is opened, columns are only accessed on
+    request and by range of rows. FITS tables are memory mapped and columns
+    stored without scaling or boolean encoding are returned as views of the
+    mapped records, in the on-disk (big-endian) byte order. Contiguous
+    uncompressed HDF5 datasets are memory mapped in the same way, other HDF5
+    datasets are read through h5py, transferring only the requested fields.
+
+    Parameters
+    ----------
+    filename: string
+        FITS or HDF5 file
+
+    path: string
+        Path of the compound dataset in HDF5 files (default: 'WLMassMap_data'),
+        falls back to the default path of astropy tables if missing
+
+    hdu: int or string
+        Table extension in FITS files (default: 1)
+    """
+
+    def __init__(self, filename, path='WLMassMap_data', hdu=1):
+        self.filename = filename
+        self.header = None
+        self._mmap = None
+
+        if h5py.is_hdf5(filename):
+            self.format = 'hdf5'
+            self._file = h5py.File(filename, 'r')
+            if path not in self._file and '__astropy_table__' in self._file:
+                path = '__astropy_table__'
+            self._data = self._file[path]
+            self.dtype = self._data.dtype
+
+            # Contiguous datasets can be memory mapped directly
+            offset = self._data.id.get_offset()
+            if (self._data.chunks is None and offset is not None and
+                    len(self._data) > 0):
+                self._mmap = np.memmap(filename, dtype=self.dtype, mode='r',
+                                       offset=offset, shape=self._data.shape)
+        else:
+            self.format = 'fits'
+            self._file = fits.open(filename, memmap=True)
+            table = self._file[hdu]
+            self.header = table.header
+            self._data = table.data
+            self._mmap = self._data.view(np.ndarray)
+            self.dtype = self._mmap.dtype
+            self._converted = set(col.name for col in table.columns
+                                  if not _is_raw_column(col))
+
+        self.columns = list(self.dtype.names)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._mmap = None
+        self._data = None
+        self._file.close()
+
+    def read(self, columns=None, start=0, stop=None):
+        """
+        Reads a range of rows of the requested columns
+
+        Parameters
+        ----------
+        columns: list of string, optional
+            Columns to read, defaults to all columns
+
+        start, stop: int, optional
+            Range of rows to read, defaults to the entire table
+
+        Returns
+        -------
+        data: dict
+            Dictionary of column arrays, views of the memory mapped file when
+            the on-disk layout allows it
+        """
+        columns = self.columns if columns is None else list(columns)
+        stop = len(self) if stop is None else stop
+
+        if self._mmap is not None:
+            rows = self._mmap[start:stop]
+            data = {name: rows[name] for name in columns}
+            if self.format == 'fits':
+                for name in self._converted.intersection(columns):
+                    data[name] = np.asarray(self._data.field(name)[start:stop])
+            return data
+
+        rows = self._data.fields(columns)[start:stop]
+        return {name: rows[name] for name in columns}
+
+    def take(self, rows, columns=None):
+        """
+        Reads a set of rows of the requested columns
+
+        Memory mapped tables are indexed directly. Other HDF5 datasets are
+        read by storage chunk, each chunk holding requested rows being read
+        once, from its first to its last requested row.
+
+        Parameters
+        ----------
+        rows: int array
+            Indices of the rows to read, in increasing order
+
+        columns: list of string, optional
+            Columns to read, defaults to all columns
+
+        Returns
+        -------
+        data: dict
+            Dictionary of column arrays, loaded in memory
+        """
+        columns = self.columns if columns is None else list(columns)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        if self._mmap is not None:
+            records = self._mmap[rows]
+            data = {name: records[name] for name in columns}
+            if self.format == 'fits':
+                for name in self._converted.intersection(columns):
+                    data[name] = np.asarray(self._data.field(name)[rows])
+            return data
+
+        data = {name: np.empty(len(rows), dtype=self.dtype[name])
+                for name in columns}
+        if len(rows) == 0:
+            return data
+        block = self._data.chunks[0] if self._data.chunks else len(self)
+        blocks = rows // block
+        bounds = np.concatenate([[0], np.nonzero(np.diff(blocks))[0] + 1,
+                                 [len(rows)]])
+        fields = self._data.fields(columns)
+        for i, j in zip(bounds[:-1], bounds[1:]):
+            start = rows[i]
+            part = fields[start:rows[j - 1] + 1]
+            for name in columns:
+                data[name][i:j] = part[name][rows[i:j] - start]
+        return data
+
+    def records(self, start=0, stop=None):
+        """
+        Returns a range of rows as raw records, in the on-disk format
+        """
+        stop = len(self) if stop is None else stop
+        if self._mmap is not None:
+            return self._mmap[start:stop]
+        return self._data[start:stop]
+
+    def iter_chunks(self, columns, chunk_size, start=0, stop=None):
+        """
+        Iterates over the table by chunks of rows
+
+        Parameters
+        ----------
+        columns: list of string
+            Columns to read
+
+        chunk_size: int
+            Number of rows per chunk
+
+        start, stop: int, optional
+            Range of rows to iterate over, defaults to the entire table
+
+        Yields
+        ------
+        chunk: dict
+            Dictionary of column arrays for the current chunk
+        """
+        stop = len(self) if stop is None else stop
+        for i in range(start, stop, chunk_size):
+            with span('read'):
+                chunk = self.read(columns, i, min(i + chunk_size, stop))
+            yield chunk
+
+def _is_raw_column(col):
+    """
+    Whether the values of a FITS column can be used without conversion
+    """
+    fmt = col.format
+    return (col.bscale in (None, 1) and col.bzero in (None, 0) and
+            col.dim is None and
+            not any(code in fmt for code in ['L', 'X', 'P', 'Q']))
+
+def catalog_length(filename):
+    """
+    Returns the number of rows of a FITS or HDF5 shape catalog, without
+    reading it
+    """
+    with CatalogReader(filename) as reader:
+        return len(reader)
+
+def read_catalog(filename, columns=None):
+    """
+    Reads the requested columns of a FITS or HDF5 shape catalog
+
+    Parameters
+    ----------
+    filename: string
+        FITS file containing the catalog in its first extension, or HDF5 file
+
+    columns: list of string, optional
+        Columns to read, defaults to all columns
+
+    Returns
+    -------
+    data: dict
+        Dictionary of column arrays, loaded in memory
+    """
+    with CatalogReader(filename) as reader:
+        return {name: np.array(values)
+                for name, values in reader.read(columns).items()}
+
+def iter_catalog_chunks(filename, columns, chunk_size, start=0, stop=None):
+    """
+    Iterates over a shape catalog by chunks of rows, reading only the
+    requested columns from a FITS file or from the `WLMassMap_data` table of
+    an HDF5 file. See `CatalogReader.iter_chunks`.
+    """
+    with CatalogReader(filename) as reader:
+        for chunk in reader.iter_chunks(columns, chunk_size, start, stop):
+            yield chunk
@@ -1,45 +1,293 @@
 # This module computes convergence maps
 from optparse import OptionParser
+import logging
 import os
+import time
+import warnings
 import yaml
 import numpy as np
 from astropy.io import fits
 
-from .kaiser_squires import flat_KS_map, healpix_KS_map
+from .kaiser_squires import get_flat_KS_operator, healpix_KS_map
+from .map_io import (is_partial_map, read_partial_map, write_partial_map,
+                     is_hdf5_filename, is_hdf5_map, read_hdf5_map,
+                     write_hdf5_map)
+from .instrumentation import profile_stage, span
 
-def convergence_map(config):
+logger = logging.getLogger(__name__)
+
+def read_shear_map(filename):
     """
-    Computes convergence map with specified algorithm
+    Reads a shear map written by `shear_map.write_shear_map`, in FITS or
+    HDF5
+
+    Returns
+    -------
+    maps: dictionary
+        Shear map `gmap` and number of galaxies per pixel `nmap`, with the
+        `pixel_size` of flat maps, and the observed `pixels`, `nside` and
+        `ordering` of partial sky maps
+    """
+    if is_hdf5_map(filename):
+        # Partial sky maps are stored with their pixels and NSIDE
+        (gmap, nmap), attrs = read_hdf5_map(filename, ['gmap', 'nmap'])
+        if 'NSIDE' in attrs:
+            (pixels,), _ = read_hdf5_map(filename, ['pixels'])
+            return {'gmap': gmap, 'nmap': nmap, 'pixels': pixels,
+                    'nside': int(attrs['NSIDE']),
+                    'ordering': str(attrs['ORDERING'])}
+        return {'gmap': gmap, 'nmap': nmap, 'pixel_size': attrs.get('PIXSIZE')}
+
+    if is_partial_map(filename):
+        pixels, (g1, g2, nmap), header = read_partial_map(filename,
+                                                          ['G1', 'G2', 'N'])
+        return {'gmap': np.stack([g1, g2], axis=-2), 'nmap': nmap,
+                'pixels': pixels, 'nside': header['NSIDE'],
+                'ordering': header['ORDERING'].strip()}
+
+    gmap, header = fits.getdata(filename, 0, header=True)
+    nmap = fits.getdata(filename, 1)
+    return {'gmap': gmap, 'nmap': nmap, 'pixel_size': header.get('PIXSIZE')}
+
+def smoothing_scale(algorithm):
     """
+    Returns the Gaussian smoothing [arcmin] of an algorithm configuration,
+    set by its `smoothing` option, or None. The former `sigma` option of
+    'healpix_ks' is still accepted, with a deprecation warning.
+    """
+    if 'sigma' in algorithm:
+        warnings.warn("The 'sigma' option of the convergence map algorithm is "
+                      "deprecated, use 'smoothing' [arcmin] instead",
+                      DeprecationWarning)
+        if algorithm.get('smoothing') is None:
+            return algorithm['sigma'] or None
+    return algorithm.get('smoothing') or None
 
-    filename = config['input_filename']
+def compute_convergence_map(maps, algorithm, warm_start=None):
+    """
+    Computes a convergence map from a shear map loaded in memory
 
-    # Extracts the shear map
-    gmap = fits.getdata(filename, 0)
-    c = config['algorithm']
+    Parameters
+    ----------
+    maps: dictionary
+        Shear map, as returned by `read_shear_map` or
+        `shear_map.compute_shear_map`
 
-    if c['name'] == 'flat_ks':
-        kappa_e, kappa_b = flat_KS_map(gmap)
+    algorithm: dictionary
+        Algorithm configuration, as in the `convergence_map` config
+
+    warm_start: dictionary, optional
+        State of the 'masked_flat_ks' algorithm across calls, updated in
+        place: the solution of a call is saved as `x`, and used as initial
+        guess by the next call
+
+    Returns
+    -------
+    kappa: dictionary
+        Convergence maps, as keyword arguments of `write_convergence_map`
+    """
+    c = algorithm
+    gmap = maps['gmap']
+    pixels = maps.get('pixels')
+    smoothing = smoothing_scale(c)
+    info = {}
+
+    # Precision of the inversion, following the shear map by default
+    dtype = np.dtype(c.get('dtype') or gmap.dtype).name
+
+    # Partial sky maps are handled separately, only storing observed pixels
+    if pixels is not None:
+        if c['name'] != 'healpix_ks':
+            raise NotImplementedError
+        with span('inversion'):
+            kappa_e, kappa_b = healpix_KS_map(gmap, lmax=c['lmax'],
+                                              sigma=smoothing,
+                                              pixels=pixels,
+                                              nside=maps['nside'],
+                                              nthreads=c.get('nthreads'))
+        kappa_e = kappa_e.astype(dtype, copy=False)
+        kappa_b = kappa_b.astype(dtype, copy=False)
+        return {'kappa_e': kappa_e, 'kappa_b': kappa_b, 'pixels': pixels,
+                'nside': maps['nside'],
+                'ordering': maps.get('ordering', 'RING')}
+
+    if c['name'] in ['flat_ks', 'masked_flat_ks']:
+        sigma = None
+        pixel_size = c.get('pixel_size') or maps.get('pixel_size')
+        if smoothing:
+            if pixel_size is None:
+                raise ValueError("Smoothing requires the pixel size of the map")
+            sigma = smoothing / pixel_size
+
+        ks = get_flat_KS_operator(gmap.shape[-2], gmap.shape[-1], dtype,
+                                  zero_padding=c.get('zero_padding') or 0,
+                                  sigma=sigma,
+                                  fft_backend=c.get('fft_backend'),
+                                  fft_threads=c.get('fft_threads'),
+                                  fft_wisdom=c.get('fft_wisdom'))
+        t0 = time.time()
+        if c['name'] == 'flat_ks':
+            with span('inversion'):
+                kappa_e, kappa_b = ks(gmap)
+        else:
+            if maps.get('nmap') is None:
+                raise ValueError("The masked inversion requires the number of "
+                                 "galaxies per pixel")
+            x0 = warm_start.get('x') if warm_start is not None else None
+            # Only used if the previous maps had the same shape
+            if x0 is not None and (x0[0].shape !=
+                                   gmap.shape[:-3] + gmap.shape[-2:]):
+                x0 = None
+            with span('inversion'):
+                kappa_e, kappa_b, solver = ks.masked(
+                    gmap, maps['nmap'],
+                    regularization=c.get('regularization', 1e-3),
+                    bmode_regularization=c.get('bmode_regularization', 1.),
+                    tol=c.get('tol', 1e-5), max_iter=c.get('max_iter', 200),
+                    x0=x0)
+            if warm_start is not None:
+                warm_start['x'] = solver['x']
+            info['NITER'] = (solver['niter'], 'Number of solver iterations')
+            info['RESID'] = (float(np.max(solver['residual'])),
+                             'Relative residual of the solver')
+            logger.info("masked_flat_ks: %d iterations, relative residual "
+                        "%.2e", solver['niter'], info['RESID'][0])
+        info['NXPAD'] = (ks.padded_shape[0], 'Padded size of the FFT grid')
+        info['NYPAD'] = (ks.padded_shape[1], 'Padded size of the FFT grid')
+        info['FFTTIME'] = (time.time() - t0, 'Time spent in the inversion [s]')
+        info['FFTBACK'] = (ks.fft.name, 'FFT backend')
+        logger.info("%s: padded shape %s, %s FFT, inversion time %.3fs",
+                    c['name'], ks.padded_shape, ks.fft.name,
+                    info['FFTTIME'][0])
 
     elif c['name'] == 'healpix_ks':
-        kappa_e, kappa_b = healpix_KS_map(gmap, lmax=c['lmax'])
+        with span('inversion'):
+            kappa_e, kappa_b = healpix_KS_map(gmap, lmax=c['lmax'],
+                                              sigma=smoothing,
+                                              nthreads=c.get('nthreads'))
+        # Spherical harmonic transforms are computed in double precision
+        kappa_e = kappa_e.astype(dtype, copy=False)
+        kappa_b = kappa_b.astype(dtype, copy=False)
     else:
         raise NotImplementedError
 
+    kappa = {'kappa_e': kappa_e, 'kappa_b': kappa_b, 'info': info}
+    if c['name'] != 'healpix_ks':
+        kappa['pixel_size'] = pixel_size
+    return kappa
+
+def write_convergence_map(filename, kappa_e, kappa_b, info=None, pixels=None,
+                          nside=None, ordering='RING', nmap=None,
+                          pixel_size=None, hdf5=None):
+    """
+    Saves E and B mode convergence maps to a FITS file, with the entries of
+    `info` and the `pixel_size` [arcmin] of flat maps in the primary header.
+    Partial sky maps are saved in a HEALpix partial sky table, with KAPPA_E
+    and KAPPA_B columns
+
+    If the extension of `filename` is '.h5' or '.hdf5', the maps are saved
+    in chunked and compressed `kappa_e` and `kappa_b` datasets of an HDF5
+    file instead, with the entries of `info` as attributes. Flat maps come
+    with a pyramid of coarser maps, averaged weighted by the number of
+    galaxies per pixel `nmap` if given, which is then saved as well, see
+    `map_io.write_hdf5_map`, whose options are given in the `hdf5`
+    dictionary.
+    """
+    if is_hdf5_filename(filename):
+        maps = {'kappa_e': kappa_e, 'kappa_b': kappa_b}
+        if nmap is not None:
+            maps['nmap'] = nmap
+        attrs = dict(info or {})
+        attrs['PIXSIZE'] = pixel_size
+        extra = {}
+        if pixels is not None:
+            extra['pixels'] = pixels
+            attrs.update(NSIDE=nside, ORDERING=ordering)
+        # Maps without pixel size are HEALpix maps, without pyramid
+        write_hdf5_map(filename, maps, weight='nmap' if nmap is not None
+                       else None, extra=extra, attrs=attrs,
+                       healpix=pixel_size is None, **dict(hdf5 or {}))
+        return
+
+    if pixels is not None:
+        write_partial_map(filename, pixels,
+                          {'KAPPA_E': kappa_e, 'KAPPA_B': kappa_b},
+                          nside, ordering, extname='CONVERGENCE_MAP')
+        return
+
     phdu = fits.PrimaryHDU(kappa_e)
+    if pixel_size is not None:
+        phdu.header['PIXSIZE'] = (pixel_size, 'Pixel size [arcmin]')
+    for key, value in (info or {}).items():
+        phdu.header[key] = value
     exthdu = fits.ImageHDU(kappa_b)
 
     hdulist = fits.HDUList([phdu, exthdu])
-
-    filename = config['output_filename']
     hdulist.writeto(filename)
 
+def convergence_map(config):
+    """
+    Computes convergence map with specified algorithm
+
+    For the 'flat_ks' algorithm, the optional `zero_padding` [pixels] and
+    `smoothing` [arcmin] options are supported. Smoothing requires the pixel
+    size, read from the PIXSIZE keyword of the shear map or from the
+    `pixel_size` option [arcmin]. The padded shape and the time spent in the
+    inversion are reported in the output header. The FFT backend is chosen
+    by `fft_backend`: 'numpy' (default), 'scipy' (multithreaded) or 'pyfftw'
+    (multithreaded, requires pyFFTW), with `fft_threads` threads (default:
+    all CPUs). The FFTW plans of 'pyfftw' are saved to and loaded from the
+    `fft_wisdom` file, if set, so that later runs skip the planning.
+
+    The 'masked_flat_ks' algorithm supports the same options, and uses the
+    number of galaxies per pixel of the shear map as mask and weights: the
+    convergence is the regularized weighted least squares solution of the KS
+    forward model, inpainted in empty pixels, see `FlatKSOperator.masked`.
+    The `regularization`, `bmode_regularization`, `tol` and `max_iter`
+    options of the conjugate gradient solver are supported, and the number of
+    iterations and residual are reported in the output header.
+
+    For the 'healpix_ks' algorithm, `lmax`, `smoothing` [arcmin] and
+    `nthreads` (which requires ducc0) are supported, `sigma` being a
+    deprecated alias of `smoothing`. Partial sky HEALpix shear maps
+    produce partial sky convergence maps on the same pixels.
+
+    The maps are computed in the precision of the shear map, unless the
+    `dtype` of the stage or of the algorithm is set: with 'float32', the FFT
+    buffers of the flat algorithms are complex64, and the convergence maps
+    are saved in single precision.
+
+    The shear map is read from FITS or HDF5, see `read_shear_map`. If
+    `output_filename` ends in '.h5' or '.hdf5', the convergence maps are
+    saved in HDF5 with the `hdf5` options, see `write_convergence_map`, the
+    pyramid of flat maps being weighted by the number of galaxies per pixel
+    of the shear map.
+
+    If `profile` is set, the time, memory and I/O of each phase are saved
+    next to the output, see `instrumentation.profile_stage`.
+    """
+    algorithm = dict(config['algorithm'])
+    if config.get('dtype'):
+        algorithm.setdefault('dtype', config['dtype'])
+    with profile_stage('convergence_map', config.get('profile'),
+                       config['output_filename']):
+        with span('read'):
+            maps = read_shear_map(config['input_filename'])
+
+        kappa = compute_convergence_map(maps, algorithm)
+
+        with span('write'):
+            write_convergence_map(config['output_filename'],
+                                  nmap=maps.get('nmap'),
+                                  hdf5=config.get('hdf5'), **kappa)
+
 if __name__ == "__main__":
 
     parser = OptionParser()
     (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
     with open(args[0]) as f:
-        config = yaml.load(f.read())
+        config = yaml.safe_load(f)
 
     convergence_map(config['convergence_map'])
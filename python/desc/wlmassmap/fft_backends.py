@@ -0,0 +1,169 @@
+# This module provides interchangeable implementations of the 2D FFTs used by
+# the flat sky inversions: numpy, multithreaded scipy.fft, and pyFFTW with
+# plans cached in memory and wisdom persisted on disk
+import os
+import pickle
+import threading
+import numpy as np
+from functools import lru_cache
+
+fft_backends = ['numpy', 'scipy', 'pyfftw']
+
+class NumpyFFT(object):
+    """
+    Single threaded FFTs of numpy, the default backend
+    """
+    name = 'numpy'
+
+    def fft2(self, a):
+        """
+        Forward transform along the last two axes of a complex array, which
+        may be overwritten
+        """
+        return np.fft.fft2(a, axes=(-2, -1)).astype(a.dtype, copy=False)
+
+    def ifft2(self, a):
+        """
+        Normalized inverse transform along the last two axes of a complex
+        array, which may be overwritten
+        """
+        return np.fft.ifft2(a, axes=(-2, -1)).astype(a.dtype, copy=False)
+
+class ScipyFFT(NumpyFFT):
+    """
+    FFTs of scipy.fft, multithreaded over `threads` workers for stacks of
+    maps and large maps, and computed in the precision of the input. Plans
+    are cached by scipy.
+
+    Parameters
+    ----------
+    threads: int, optional
+        Number of workers, defaults to the number of CPUs
+    """
+    name = 'scipy'
+
+    def __init__(self, threads=None):
+        import scipy.fft
+        self._fft = scipy.fft
+        self.threads = threads or os.cpu_count()
+
+    def fft2(self, a):
+        return self._fft.fft2(a, axes=(-2, -1), overwrite_x=True,
+                              workers=self.threads)
+
+    def ifft2(self, a):
+        return self._fft.ifft2(a, axes=(-2, -1), overwrite_x=True,
+                               workers=self.threads)
+
+class PyFFTW(NumpyFFT):
+    """
+    FFTs of FFTW through pyFFTW, multithreaded over `threads` threads.
+
+    FFTW plans are built once per shape and precision, then reused by all
+    the transforms of this process. Building a plan with `planner_effort`
+    beyond FFTW_ESTIMATE measures several algorithms, which takes time: the
+    resulting wisdom is loaded from and saved to `wisdom_filename`, so that
+    the plans of later processes are built almost immediately.
+
+    Parameters
+    ----------
+    threads: int, optional
+        Number of threads, defaults to the number of CPUs
+
+    wisdom_filename: string, optional
+        File storing the FFTW wisdom across processes
+
+    planner_effort: string
+        FFTW planner flag, FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT or
+        FFTW_EXHAUSTIVE
+    """
+    name = 'pyfftw'
+
+    def __init__(self, threads=None, wisdom_filename=None,
+                 planner_effort='FFTW_MEASURE'):
+        try:
+            import pyfftw
+        except ImportError:
+            raise ImportError("The pyfftw FFT backend requires pyFFTW")
+        self._pyfftw = pyfftw
+        self.threads = threads or os.cpu_count()
+        self.wisdom_filename = wisdom_filename
+        self.planner_effort = planner_effort
+        self._plans = {}
+        self._lock = threading.Lock()
+        if wisdom_filename and os.path.exists(wisdom_filename):
+            with open(wisdom_filename, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+
+    def _save_wisdom(self):
+        # Written to a temporary file then renamed, as several processes may
+        # update the wisdom concurrently
+        tmp = '%s.%d' % (self.wisdom_filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(self._pyfftw.export_wisdom(), f)
+        os.replace(tmp, self.wisdom_filename)
+
+    def plan(self, shape, dtype, direction):
+        """
+        Cached FFTW plan transforming arrays of a given shape and complex
+        dtype, with aligned input and output buffers
+        """
+        key = (tuple(shape), np.dtype(dtype).str, direction)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is None:
+                pyfftw = self._pyfftw
+                a = pyfftw.empty_aligned(shape, dtype=dtype)
+                b = pyfftw.empty_aligned(shape, dtype=dtype)
+                plan = pyfftw.FFTW(a, b, axes=(-2, -1), direction=direction,
+                                   flags=(self.planner_effort,
+                                          'FFTW_DESTROY_INPUT'),
+                                   threads=self.threads)
+                self._plans[key] = plan
+                if self.wisdom_filename:
+                    self._save_wisdom()
+        return plan
+
+    def _execute(self, a, direction):
+        plan = self.plan(a.shape, a.dtype, direction)
+        # Plans own their buffers, concurrent calls are serialized
+        with self._lock:
+            plan.input_array[...] = a
+            plan.execute()
+            out = np.array(plan.output_array)
+        if direction == 'FFTW_BACKWARD':
+            out /= np.prod(a.shape[-2:])
+        return out
+
+    def fft2(self, a):
+        return self._execute(a, 'FFTW_FORWARD')
+
+    def ifft2(self, a):
+        return self._execute(a, 'FFTW_BACKWARD')
+
+@lru_cache(maxsize=16)
+def get_fft_backend(name='numpy', threads=None, wisdom_filename=None):
+    """
+    Cached FFT backend, shared by all the operators of a process so that
+    plans are built once
+
+    Parameters
+    ----------
+    name: string
+        'numpy', 'scipy' or 'pyfftw'
+
+    threads: int, optional
+        Number of threads of the 'scipy' and 'pyfftw' backends, defaults to
+        the number of CPUs
+
+    wisdom_filename: string, optional
+        File storing the FFTW wisdom of the 'pyfftw' backend across processes
+    """
+    if name in [None, 'numpy']:
+        return NumpyFFT()
+    elif name == 'scipy':
+        return ScipyFFT(threads)
+    elif name == 'pyfftw':
+        return PyFFTW(threads, wisdom_filename)
+    raise ValueError("Unknown FFT backend %s, expected one of %s"
+                     % (name, fft_backends))
@@ -0,0 +1,215 @@
+# This module provides lightweight instrumentation of the internal phases of
+# the pipeline stages, recording wall and CPU time, peak memory and I/O
+import json
+import os
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Profiler collecting spans, None when instrumentation is disabled
+_profiler = None
+
+class _NullSpan(object):
+    """
+    Context manager doing nothing, returned by `span` when disabled
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_null_span = _NullSpan()
+
+def _read_proc(filename, keys):
+    """
+    Reads integer fields from a /proc/self file, None if unavailable
+    """
+    values = dict.fromkeys(keys)
+    try:
+        with open(filename) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in values:
+                    values[key] = int(value.split()[0])
+    except (IOError, OSError, ValueError):
+        pass
+    return values
+
+def _io_counters():
+    """
+    Bytes read and written by the process, through system calls (rchar,
+    wchar) and from storage (read_bytes, write_bytes)
+    """
+    return _read_proc('/proc/self/io', ['rchar', 'wchar',
+                                        'read_bytes', 'write_bytes'])
+
+def _peak_rss():
+    """
+    Peak resident set size since the last reset [bytes]
+    """
+    hwm = _read_proc('/proc/self/status', ['VmHWM'])['VmHWM']
+    if hwm is not None:
+        return hwm * 1024
+    # ru_maxrss is in kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def _reset_peak_rss():
+    """
+    Resets the peak resident set size, returns whether it is supported
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+class Profiler(object):
+    """
+    Collects timing, memory and I/O measurements of nested spans.
+
+    Spans are identified by their path, e.g. 'shear_map/binning', and
+    repeated spans (e.g. one per chunk of a catalog) are aggregated: times
+    and bytes are summed, the peak resident memory is the maximum over calls.
+
+    When the peak RSS of the process can be reset (Linux), the peak of a span
+    is measured over the span only, otherwise it is the peak of the process
+    since its start. Bytes read and written through system calls are taken
+    from /proc/self/io; reads of memory mapped files do not go through system
+    calls and only show up in the storage reads and major page faults.
+    """
+
+    def __init__(self):
+        self.spans = OrderedDict()
+        self._stack = []
+        self.per_span_peak = _reset_peak_rss()
+
+    @contextmanager
+    def span(self, name):
+        path = '/'.join([s['name'] for s in self._stack] + [name])
+        current = {'name': name, 'peak': 0}
+
+        # Peak memory of the enclosing spans up to now, before resetting it
+        if self.per_span_peak:
+            peak = _peak_rss()
+            for parent in self._stack:
+                parent['peak'] = max(parent['peak'], peak)
+            _reset_peak_rss()
+
+        self._stack.append(current)
+        io = _io_counters()
+        faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            faults = resource.getrusage(resource.RUSAGE_SELF).ru_majflt - faults
+            io_end = _io_counters()
+            peak = max(current['peak'], _peak_rss())
+            self._stack.pop()
+            for parent in self._stack:
+                parent['peak'] = max(parent['peak'], peak)
+
+            record = self.spans.setdefault(path, OrderedDict([
+                ('calls', 0), ('wall_time', 0.), ('cpu_time', 0.),
+                ('peak_rss', 0), ('bytes_read', 0), ('bytes_written', 0),
+                ('storage_bytes_read', 0), ('storage_bytes_written', 0),
+                ('major_page_faults', 0)]))
+            record['calls'] += 1
+            record['major_page_faults'] += faults
+            record['wall_time'] += wall
+            record['cpu_time'] += cpu
+            record['peak_rss'] = max(record['peak_rss'], peak)
+            for key, field in [('bytes_read', 'rchar'),
+                               ('bytes_written', 'wchar'),
+                               ('storage_bytes_read', 'read_bytes'),
+                               ('storage_bytes_written', 'write_bytes')]:
+                if io[field] is None or io_end[field] is None:
+                    record[key] = None
+                elif record[key] is not None:
+                    record[key] += io_end[field] - io[field]
+
+    def to_dict(self):
+        return OrderedDict([('per_span_peak_rss', self.per_span_peak),
+                            ('spans', [OrderedDict([('name', path)], **record)
+                                       for path, record in self.spans.items()])])
+
+    def write(self, filename, **metadata):
+        """
+        Saves the measurements in a JSON file, with optional metadata
+        """
+        data = OrderedDict(metadata)
+        data.update(self.to_dict())
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2)
+
+def span(name):
+    """
+    Context manager measuring an internal phase of a stage. Does nothing,
+    at the cost of a function call, unless a profiler is active, see
+    `profile_stage`.
+
+    Parameters
+    ----------
+    name: string
+        Name of the phase
+    """
+    if _profiler is None:
+        return _null_span
+    return _profiler.span(name)
+
+def profile_filename(output_filename, rank=None):
+    """
+    Name of the JSON file storing the profile of a stage, next to its output
+    """
+    base = os.path.splitext(output_filename)[0]
+    if rank:
+        return '%s.profile.%d.json' % (base, rank)
+    return base + '.profile.json'
+
+@contextmanager
+def profile_stage(name, enabled, output_filename, comm=None):
+    """
+    Profiles a stage if enabled, recording all the spans opened while it
+    runs and saving them in a JSON file next to the stage output, see
+    `profile_filename`. Under MPI each process writes its own profile.
+
+    Parameters
+    ----------
+    name: string
+        Name of the stage, used as the top level span
+
+    enabled: bool
+        Whether to profile the stage
+
+    output_filename: string
+        Output file of the stage
+
+    comm: MPI communicator, optional
+        Communicator the stage runs on
+    """
+    global _profiler
+    if _profiler is not None:
+        # Stage called from within a profiled run
+        with _profiler.span(name):
+            yield
+        return
+    if not enabled:
+        yield
+        return
+
+    rank = comm.rank if comm is not None else None
+    _profiler = Profiler()
+    try:
+        with _profiler.span(name):
+            yield
+        _profiler.write(profile_filename(output_filename, rank), stage=name,
+                        output_filename=output_filename, rank=rank)
+    finally:
+        _profiler = None
@@ -1,28 +1,526 @@
 # This module contains the code for a simple flat Kaiser-Squires inversion
+import warnings
 import numpy as np
-import healpy as hp
+from functools import lru_cache
 
-def flat_KS_map(gmap):
+from .fft_backends import get_fft_backend
+
+def fft_friendly_size(n):
+    """
+    Returns the smallest 2,3,5-smooth integer larger or equal to n, for which
+    FFTs are efficient
+    """
+    n = max(int(n), 1)
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+def padded_shape(nx, ny, zero_padding=0):
+    """
+    Shape of the FFT grid used to invert a (nx,ny) map with at least
+    `zero_padding` pixels of zeros on each side, rounded up to FFT friendly
+    sizes
+    """
+    if not zero_padding:
+        return nx, ny
+    return (fft_friendly_size(nx + 2*zero_padding),
+            fft_friendly_size(ny + 2*zero_padding))
+
+class FlatKSOperator(object):
+    """
+    Flat sky Kaiser-Squires inversion for maps of a given geometry.
+    The Fourier kernel is computed once, and the operator can be applied to
+    a single (2,nx,ny) shear map or to a stack of (nmaps,2,nx,ny) maps, in
+    which case FFTs are batched along the leading axis.
+
+    Parameters
+    ----------
+    nx, ny: int
+        Shape of the maps
+
+    dtype: dtype
+        Real floating point type of the computation, 'float32' uses complex64
+        FFT buffers
+
+    zero_padding: int
+        Minimum number of pixels of zeros added on each side of the map before
+        the inversion, see `padded_shape`
+
+    sigma: float, optional
+        Standard deviation of a Gaussian smoothing [pixels], applied as part
+        of the Fourier kernel
+
+    fft: object, optional
+        FFT backend, see `fft_backends.get_fft_backend`, defaults to numpy
+    """
+
+    def __init__(self, nx, ny, dtype='float64', zero_padding=0, sigma=None,
+                 fft=None):
+        self.nx = nx
+        self.ny = ny
+        self.dtype = np.dtype(dtype)
+        self.fft = fft if fft is not None else get_fft_backend()
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+        self.padded_shape = padded_shape(nx, ny, zero_padding)
+        self.offset = ((self.padded_shape[0] - nx) // 2,
+                       (self.padded_shape[1] - ny) // 2)
+        self.sigma = sigma
+
+        # Only the kernel of the direct inversion is kept. The unsmoothed
+        # kernel and the smoothing of the masked inversion are built on
+        # request, and without smoothing all kernels are the same array.
+        kernel = self._ks_kernel()
+        self._unsmoothed = None
+        self._unsmoothed_conj = None
+        if sigma:
+            kernel *= self._smoothing()
+        else:
+            self._unsmoothed = kernel
+        self.kernel = kernel
+
+    def _frequencies(self):
+        # k1 along the last axis and k2 along the first one
+        npx, npy = self.padded_shape
+        return np.meshgrid(np.fft.fftfreq(npy), np.fft.fftfreq(npx))
+
+    def _ks_kernel(self):
+        k1, k2 = self._frequencies()
+        denom = k1*k1 + k2*k2
+        denom[0, 0] = 1  # avoid division by 0
+        kernel = ((k1*k1 - k2*k2) - 2j*(k1*k2)) / denom
+        return kernel.astype(self.complex_dtype)
+
+    def _smoothing(self):
+        k1, k2 = self._frequencies()
+        return np.exp(-2 * (np.pi * self.sigma)**2 *
+                      (k1*k1 + k2*k2)).astype(self.dtype)
+
+    @property
+    def ks_kernel(self):
+        """
+        Unsmoothed Fourier kernel, used by the iterative masked inversion
+        """
+        if self._unsmoothed is None:
+            self._unsmoothed = self._ks_kernel()
+        return self._unsmoothed
+
+    @property
+    def ks_kernel_conj(self):
+        """
+        Conjugate of `ks_kernel`, the kernel of the KS forward operator
+        """
+        if self._unsmoothed_conj is None:
+            self._unsmoothed_conj = np.conj(self.ks_kernel)
+        return self._unsmoothed_conj
+
+    def __call__(self, gmap):
+        """
+        Computes kappa maps from binned shear maps of shape (...,2,nx,ny)
+        returns kappa_e and kappa_b of shape (...,nx,ny)
+        """
+        assert gmap.shape[-3:] == (2, self.nx, self.ny)
+        ox, oy = self.offset
+        inner = (Ellipsis, slice(ox, ox + self.nx), slice(oy, oy + self.ny))
+
+        # FFT(g1) + i FFT(g2) = FFT(g1 + i g2), a single complex transform
+        if self.padded_shape == (self.nx, self.ny):
+            g = np.empty(gmap.shape[:-3] + self.padded_shape,
+                         dtype=self.complex_dtype)
+        else:
+            g = np.zeros(gmap.shape[:-3] + self.padded_shape,
+                         dtype=self.complex_dtype)
+        g[inner].real = gmap[..., 0, :, :]
+        g[inner].imag = gmap[..., 1, :, :]
+
+        kap = self.fft.fft2(g)
+        kap *= self.kernel
+        kap = self.fft.ifft2(kap)[inner]
+
+        return np.real(kap), np.imag(kap)
+
+    def _pad(self, maps):
+        """
+        Embeds (...,nx,ny) maps in the padded FFT grid, as complex maps
+        """
+        ox, oy = self.offset
+        out = np.zeros(maps.shape[:-2] + self.padded_shape, dtype=self.complex_dtype)
+        out[..., ox:ox + self.nx, oy:oy + self.ny] = maps
+        return out
+
+    def _apply(self, maps, kernel, overwrite=False):
+        """
+        Applies a Fourier kernel to complex maps on the padded grid, the input
+        maps may be overwritten if `overwrite` is set
+        """
+        out = self.fft.fft2(maps if overwrite else maps.copy())
+        out *= kernel
+        return self.fft.ifft2(out)
+
+    def masked(self, gmap, nmap, regularization=1e-3, bmode_regularization=1.,
+               tol=1e-5, max_iter=200, x0=None):
+        """
+        Computes kappa maps from shear maps with empty or unevenly populated
+        pixels, instead of treating empty pixels as zero shear.
+
+        The complex convergence k = kappa_e + i kappa_b on the padded grid is
+        the solution of the regularized weighted least squares problem
+
+            min_k |W^1/2 (g - P k)|^2 + regularization |k|^2
+                  + bmode_regularization |kappa_b|^2
+
+        where P is the KS forward operator (the adjoint of the inversion
+        kernel) and W the weights of the pixels, proportional to the number
+        of galaxies per pixel and null in empty and padding pixels. Without
+        the B mode prior, the zero filled KS inversion is already a solution,
+        damping the B mode is what constrains kappa_e in the masked regions.
+        The normal equations are solved by conjugate gradient with the cached
+        Fourier kernel, preconditioned by the exact inverse of the problem
+        without the B mode prior, P^H (W + regularization)^-1 P, so that the
+        number of iterations barely depends on the size of the maps and of
+        the zero padding. The smoothing of the operator is applied to the
+        solution.
+
+        Parameters
+        ----------
+        gmap: ndarray
+            Shear maps of shape (...,2,nx,ny)
+
+        nmap: ndarray
+            Number of galaxies per pixel, of shape (nx,ny) or (...,nx,ny)
+
+        regularization: float
+            Tikhonov regularization, relative to the mean weight of the
+            observed pixels
+
+        bmode_regularization: float
+            Additional regularization of the B mode, relative to the mean
+            weight of the observed pixels
+
+        tol: float
+            Iterations stop once the norm of the residual of the normal
+            equations, relative to the norm of their right hand side, is
+            below `tol` for all maps
+
+        max_iter: int
+            Maximum number of iterations, a warning is issued if some maps
+            did not converge
+
+        x0: tuple of ndarray, optional
+            Warm start, (kappa_e, kappa_b) unsmoothed solution of a previous
+            call, broadcastable to the shape of the maps
+
+        Returns
+        -------
+        kappa_e, kappa_b: ndarray
+            Convergence maps of shape (...,nx,ny)
+
+        info: dict
+            Number of iterations `niter`, relative residual `residual` of
+            each map, and unsmoothed solution `x` usable as warm start
+        """
+        assert gmap.shape[-3:] == (2, self.nx, self.ny)
+        batch = gmap.shape[:-3]
+        axes = (-2, -1)
+
+        nmap = np.asarray(nmap, dtype=self.dtype)
+        observed = nmap > 0
+        mean = nmap[observed].mean() if observed.any() else 1.
+        w = self._pad(np.broadcast_to(nmap / mean, batch + (self.nx, self.ny))).real
+        lam = regularization
+        mu = bmode_regularization
+        kernel = self.ks_kernel
+        kernel_conj = self.ks_kernel_conj
+
+        def normal(x):
+            # (P^H W P + lambda + mu on the B mode) x
+            y = self._apply(x, kernel_conj)
+            y *= w
+            y = self._apply(y, kernel, overwrite=True)
+            y += lam * x
+            y.imag += mu * x.imag
+            return y
+
+        def dot(a, b):
+            return np.sum((np.conj(a) * b).real, axis=axes)
+
+        d = w + lam
+
+        def precondition(r):
+            # P^H (W + lambda)^-1 P r
+            z = self._apply(r, kernel_conj)
+            z /= d
+            return self._apply(z, kernel, overwrite=True)
+
+        g = self._pad(gmap[..., 0, :, :] + 1j * gmap[..., 1, :, :])
+        g *= w
+        b = self._apply(g, kernel, overwrite=True)
+        del g
+
+        if x0 is None:
+            x = np.zeros_like(b)
+            r = b.copy()
+        else:
+            x = self._pad(np.broadcast_to(x0[0] + 1j * x0[1],
+                                          batch + (self.nx, self.ny)))
+            r = b - normal(x)
+        z = precondition(r)
+        p = z.copy()
+        rz = dot(r, z)
+        tiny = np.finfo(self.dtype).tiny
+        bb = np.maximum(dot(b, b), tiny)
+
+        niter = 0
+        residual = np.sqrt(dot(r, r) / bb)
+        while niter < max_iter and np.any(residual > tol):
+            Ap = normal(p)
+            # Converged maps are left unchanged
+            active = residual > tol
+            alpha = np.where(active, rz / np.maximum(dot(p, Ap), tiny), 0)
+            alpha = alpha[..., np.newaxis, np.newaxis]
+            x += alpha * p
+            r -= alpha * Ap
+            z = precondition(r)
+            rz_new = dot(r, z)
+            beta = np.where(active, rz_new / np.maximum(rz, tiny), 0)
+            p *= beta[..., np.newaxis, np.newaxis]
+            p += z
+            rz = rz_new
+            residual = np.sqrt(dot(r, r) / bb)
+            niter += 1
+
+        if np.any(residual > tol):
+            warnings.warn("The masked KS inversion did not converge in %d "
+                          "iterations, relative residual %.2e > %.2e"
+                          % (niter, np.max(residual), tol))
+
+        ox, oy = self.offset
+        inner = (Ellipsis, slice(ox, ox + self.nx), slice(oy, oy + self.ny))
+        info = {'niter': niter, 'residual': residual,
+                'x': (np.real(x[inner]).copy(), np.imag(x[inner]).copy())}
+        if self.sigma:
+            x = self._apply(x, self._smoothing(), overwrite=True)
+        kap = x[inner]
+        return np.real(kap), np.imag(kap), info
+
+@lru_cache(maxsize=4)
+def get_flat_KS_operator(nx, ny, dtype='float64', zero_padding=0, sigma=None,
+                         fft_backend=None, fft_threads=None, fft_wisdom=None):
+    """
+    Returns a cached `FlatKSOperator` for the given geometry and options,
+    with the FFT backend `fft_backend` using `fft_threads` threads and the
+    wisdom file `fft_wisdom`, see `fft_backends.get_fft_backend`
+    """
+    fft = get_fft_backend(fft_backend or 'numpy', fft_threads, fft_wisdom)
+    return FlatKSOperator(nx, ny, dtype, zero_padding, sigma, fft)
+
+def flat_KS_map(gmap, dtype='float64', zero_padding=0, sigma=None,
+                fft_backend=None, fft_threads=None, fft_wisdom=None):
     """Compute kappa maps from binned shear maps.
     returns kappa_e and kappa_b
+
+    Parameters
+    ----------
+    gmap: ndarray
+        Shear map of shape (2,nx,ny), or stack of maps of shape (nmaps,2,nx,ny)
+
+    dtype: dtype
+        Precision of the computation, 'float64' or 'float32'
+
+    zero_padding: int
+        Minimum number of pixels of zeros added on each side of the map
+
+    sigma: float, optional
+        Gaussian smoothing applied to the map [pixels]
+
+    fft_backend, fft_threads, fft_wisdom: optional
+        FFT backend ('numpy', 'scipy' or 'pyfftw'), its number of threads and
+        its wisdom file, see `fft_backends.get_fft_backend`
+    """
+    nx = gmap.shape[-2]
+    ny = gmap.shape[-1]
+
+    return get_flat_KS_operator(nx, ny, np.dtype(dtype).name,
+                                zero_padding or 0, sigma, fft_backend,
+                                fft_threads, fft_wisdom)(gmap)
+
+def masked_flat_KS_map(gmap, nmap, dtype='float64', zero_padding=0, sigma=None,
+                       regularization=1e-3, bmode_regularization=1., tol=1e-5,
+                       max_iter=200, x0=None, fft_backend=None, fft_threads=None,
+                       fft_wisdom=None):
+    """Compute kappa maps from binned shear maps, accounting for empty pixels
+    with an iterative masked inversion, see `FlatKSOperator.masked`.
+    returns kappa_e, kappa_b and the convergence info
+
+    Parameters
+    ----------
+    gmap: ndarray
+        Shear map of shape (2,nx,ny), or stack of maps of shape (nmaps,2,nx,ny)
+
+    nmap: ndarray
+        Number of galaxies per pixel, used as mask and weights
+
+    dtype: dtype
+        Precision of the computation, 'float64' or 'float32'
+
+    zero_padding: int
+        Minimum number of pixels of zeros added on each side of the map
+
+    sigma: float, optional
+        Gaussian smoothing applied to the map [pixels]
+
+    regularization, bmode_regularization, tol, max_iter, x0:
+        Options of the iterative solver, see `FlatKSOperator.masked`
+
+    fft_backend, fft_threads, fft_wisdom: optional
+        FFT backend, see `flat_KS_map`
+    """
+    nx = gmap.shape[-2]
+    ny = gmap.shape[-1]
+
+    ks = get_flat_KS_operator(nx, ny, np.dtype(dtype).name, zero_padding or 0,
+                              sigma, fft_backend, fft_threads, fft_wisdom)
+    return ks.masked(gmap, nmap, regularization, bmode_regularization, tol,
+                     max_iter, x0)
+
+@lru_cache(maxsize=16)
+def healpix_KS_filter(lmax, sigma=None):
+    """
+    Multipole filter turning the E/B modes of a spin-2 shear field into the
+    E/B modes of the spin-0 convergence, with an optional Gaussian smoothing
+
+    Parameters
+    ----------
+    lmax: int
+        Maximum multipole order
+
+    sigma: float, optional
+        Gaussian smoothing [radians]
+
+    Returns
+    -------
+    fl: ndarray
+        Read-only filter for each multipole in [0, lmax]
+    """
+    ell = np.arange(lmax + 1, dtype='float64')
+    fl = np.zeros(lmax + 1)
+    l = ell[2:]
+    fl[2:] = ((l*(l+1.))/((l+2.)*(l-1)))**0.5
+    if sigma:
+        fl *= np.exp(-0.5 * ell*(ell+1.) * sigma**2)
+    fl.flags.writeable = False
+    return fl
+
+class HealpixKSOperator(object):
+    """
+    Spherical Kaiser-Squires inversion for HEALpix maps (in ring format) of a
+    given resolution. The shear maps are only analysed with spin-2
+    transforms, the multipole filter is cached, and E and B convergence maps
+    are synthesized together. Stacks of maps of shape (nmaps,2,npix) share
+    the same setup.
+
+    Parameters
+    ----------
+    nside: int
+        HEALpix nside parameter
+
+    lmax: int, optional
+        Maximum multipole order, defaults to 2*nside
+
+    sigma: float, optional
+        Gaussian smoothing applied to the alms [arcmin]
+
+    iter: int
+        Number of Jacobi iterations of the spin-2 analysis, as in
+        `healpy.map2alm`
+
+    nthreads: int, optional
+        If set, transforms are computed with ducc0 using that many threads
     """
-    nx = gmap.shape[1]
-    ny = gmap.shape[2]
 
-    # get frequencies
-    k1, k2 = np.meshgrid(np.fft.fftfreq(nx),
-                         np.fft.fftfreq(ny))
+    def __init__(self, nside, lmax=None, sigma=None, iter=3, nthreads=None):
+        # healpy is only imported by the spherical inversions
+        import healpy as hp
+        self._hp = hp
+        self.nside = nside
+        self.npix = hp.nside2npix(nside)
+        self.lmax = 2*nside if lmax is None else lmax
+        self.iter = iter
+        self.nthreads = nthreads
+
+        if sigma is not None:
+            # convert to radians
+            sigma = sigma / 60./180*np.pi
+        self.filter = healpix_KS_filter(self.lmax, sigma)
+
+        if nthreads:
+            try:
+                import ducc0
+            except ImportError:
+                raise ImportError("The threaded spherical KS mode requires ducc0")
+            self._sht = ducc0.sht
+            self._geometry = ducc0.healpix.Healpix_Base(nside, 'RING').sht_info()
+
+    def _synthesis(self, alms, spin):
+        if self.nthreads:
+            if spin == 0:
+                return np.concatenate([self._synthesis(alm[np.newaxis], spin=None)
+                                       for alm in alms])
+            return self._sht.synthesis(alm=alms, lmax=self.lmax, spin=spin or 0,
+                                       nthreads=self.nthreads, **self._geometry)
+        if spin == 2:
+            return np.array(self._hp.alm2map_spin(list(alms), self.nside, 2, self.lmax))
+        # Both maps are synthesized in a single call
+        return self._hp.alm2map(alms, nside=self.nside, lmax=self.lmax, pol=False)
+
+    def _adjoint_synthesis(self, maps):
+        if self.nthreads:
+            alms = self._sht.adjoint_synthesis(map=maps, lmax=self.lmax, spin=2,
+                                               nthreads=self.nthreads,
+                                               **self._geometry)
+            return alms * (4*np.pi / self.npix)
+        return np.array(self._hp.map2alm_spin(list(maps), 2, lmax=self.lmax))
+
+    def analysis(self, gmap):
+        """
+        Computes the E and B alms of a (2,npix) shear map
+        """
+        alms = self._adjoint_synthesis(gmap)
+        for i in range(self.iter):
+            alms += self._adjoint_synthesis(gmap - self._synthesis(alms, 2))
+        return alms
+
+    def __call__(self, gmap):
+        """
+        Computes kappa maps from shear maps of shape (...,2,npix)
+        returns kappa_e and kappa_b of shape (...,npix)
+        """
+        if gmap.ndim > 2:
+            kappa = [self(g) for g in gmap.reshape((-1, 2, self.npix))]
+            kappa = np.stack([np.stack(k) for k in kappa], axis=1)
+            kappa = kappa.reshape((2,) + gmap.shape[:-2] + (self.npix,))
+            return kappa[0], kappa[1]
 
-    g1 = np.fft.fft2(gmap[0])
-    g2 = np.fft.fft2(gmap[1])
-    denom = k1*k1 + k2*k2
-    denom[0, 0] = 1  # avoid division by 0
-    kap = ((k1*k1 - k2*k2) - 2j*(k1*k2)) * (g1 + 1j*g2) / denom
-    kap = np.fft.ifft2(kap)
+        alms = self.analysis(np.asarray(gmap, dtype='float64'))
+        for alm in alms:
+            self._hp.almxfl(alm, self.filter, inplace=True)
 
-    return np.real(kap), np.imag(kap)
+        E_map, B_map = self._synthesis(alms, 0)
+        return E_map, B_map
 
-def healpix_KS_map(gmap, lmax=None, sigma=None):
+@lru_cache(maxsize=4)
+def get_healpix_KS_operator(nside, lmax=None, sigma=None, nthreads=None):
+    """
+    Returns a cached `HealpixKSOperator` for the given resolution and options
+    """
+    return HealpixKSOperator(nside, lmax, sigma, nthreads=nthreads)
+
+def healpix_KS_map(gmap, lmax=None, sigma=None, pixels=None, nside=None,
+                   nthreads=None):
     """
     Computes kappa maps from a given healpix shear map (in ring format)
     Adapted from `g2k_sphere` DES code:
@@ -31,32 +529,27 @@ def healpix_KS_map(gmap, lmax=None, sigma=None):
     Parameters
     ----------
     gmap: ndarray
-        Healpix convergence map (ring format)
+        Healpix shear map (ring format), of shape (2,npix) or (nmaps,2,npix)
     lmax: int
         Maximum multipole order
     sigma: float
         Gaussian smoothing applied to the alms [arcmin]
+    pixels: int array, optional
+        For partial sky maps, indices of the pixels of gmap, kappa is then
+        only returned on these pixels
+    nside: int, optional
+        HEALpix nside parameter, required for partial sky maps
+    nthreads: int, optional
+        Number of threads used by the transforms, requires ducc0
     """
-    nside = hp.npix2nside(gmap.shape[1])
-
-    if sigma is not None:
-        # convert to radians
-        sigma = sigma / 60./180*np.pi
-
-    if lmax is None:
-        lmax = 2*nside
-
-    KQU_maps = [np.zeros_like(gmap[0]), gmap[0], gmap[1]]
-    alms = hp.map2alm(KQU_maps, lmax=lmax, pol=True)
-
-    ell, emm = hp.Alm.getlm(lmax=lmax)
-    almsE = alms[1]*((ell*(ell+1.))/((ell+2.)*(ell-1)))**0.5
-    almsB = alms[2]*((ell*(ell+1.))/((ell+2.)*(ell-1)))**0.5
-    almsE[ell==0] = 0.0
-    almsB[ell==0] = 0.0
-    almsE[ell==1] = 0.0
-    almsB[ell==1] = 0.0
+    import healpy as hp
+    if pixels is not None:
+        # Partial sky maps are only expanded for the harmonic transform
+        dense = np.zeros(gmap.shape[:-1] + (hp.nside2npix(nside),))
+        dense[..., pixels] = gmap
+        E_map, B_map = healpix_KS_map(dense, lmax=lmax, sigma=sigma,
+                                      nthreads=nthreads)
+        return E_map[..., pixels], B_map[..., pixels]
 
-    E_map = hp.alm2map(almsE, nside=nside, lmax=lmax, pol=False, sigma=sigma, verbose=False)
-    B_map = hp.alm2map(almsB, nside=nside, lmax=lmax, pol=False, sigma=sigma, verbose=False)
-    return E_map, B_map
+    nside = hp.npix2nside(gmap.shape[-1])
+    return get_healpix_KS_operator(nside, lmax, sigma, nthreads)(gmap)
@@ -0,0 +1,353 @@
+# This module handles reading and writing maps in the formats used by the
+# different stages
+import os
+import numpy as np
+from astropy.io import fits
+
+def write_partial_map(filename, pixels, columns, nside, ordering='RING',
+                      extname='PARTIAL_MAP', extra_hdus=()):
+    """
+    Writes a partial sky HEALpix map, storing only the observed pixels
+    following the explicit indexing scheme of the HEALpix FITS convention
+
+    Parameters
+    ----------
+    filename: string
+        Output FITS file
+
+    pixels: int array
+        Indices of the observed pixels
+
+    columns: dict
+        Values of each map at the observed pixels, as (npix_obs,) arrays or
+        as (nmaps, npix_obs) arrays for stacks of maps (e.g. tomographic bins)
+
+    nside: int
+        HEALpix nside parameter
+
+    ordering: string
+        HEALpix pixel order ('RING', 'NESTED')
+
+    extname: string
+        Name of the table extension
+
+    extra_hdus: list of HDU
+        Additional HDUs appended to the file
+    """
+    cols = [fits.Column(name='PIXEL', format='K', array=pixels)]
+    for name, values in columns.items():
+        values = np.asarray(values)
+        # Stacks of maps are stored as vector columns
+        if values.ndim == 2:
+            cols.append(fits.Column(name=name,
+                                    format='%d%s' % (values.shape[0],
+                                                     _fits_format(values)),
+                                    array=values.T))
+        else:
+            cols.append(fits.Column(name=name, format=_fits_format(values),
+                                    array=values))
+
+    hdu = fits.BinTableHDU.from_columns(cols, name=extname)
+    hdu.header['PIXTYPE'] = ('HEALPIX', 'HEALPIX pixelisation')
+    hdu.header['ORDERING'] = (ordering, 'Pixel ordering scheme')
+    hdu.header['NSIDE'] = (nside, 'Resolution parameter of HEALPIX')
+    hdu.header['INDXSCHM'] = ('EXPLICIT', 'Indexing: IMPLICIT or EXPLICIT')
+    hdu.header['OBJECT'] = ('PARTIAL', 'Sky coverage, FULLSKY or PARTIAL')
+
+    hdulist = fits.HDUList([fits.PrimaryHDU(), hdu] + list(extra_hdus))
+    hdulist.writeto(filename)
+
+def _fits_format(values):
+    if np.issubdtype(values.dtype, np.integer):
+        return 'K'
+    # Single precision maps are kept in single precision
+    return 'E' if values.dtype == np.float32 else 'D'
+
+def is_partial_map(filename):
+    """
+    Checks whether a FITS file contains a partial sky HEALpix map
+    """
+    with fits.open(filename) as hdul:
+        return (len(hdul) > 1 and
+                hdul[1].header.get('INDXSCHM', '').strip() == 'EXPLICIT')
+
+def read_partial_map(filename, columns):
+    """
+    Reads a partial sky HEALpix map written by `write_partial_map`
+
+    Parameters
+    ----------
+    filename: string
+        Input FITS file
+
+    columns: list of string
+        Maps to read
+
+    Returns
+    -------
+    pixels: int array
+        Indices of the observed pixels
+
+    maps: list of arrays
+        Values of the requested maps, stacks of maps are returned with shape
+        (nmaps, npix_obs)
+
+    header: Header
+        Header of the map extension, with NSIDE and ORDERING
+    """
+    with fits.open(filename) as hdul:
+        data = hdul[1].data
+        # Converted to native byte order, keeping the precision of the maps
+        native = lambda x: np.array(x, dtype=x.dtype.newbyteorder('='))
+        pixels = native(data['PIXEL'])
+        maps = [native(data[name]).T for name in columns]
+        header = hdul[1].header.copy()
+    return pixels, maps, header
+
+# Signature at the start of HDF5 files
+_hdf5_signature = b'\x89HDF\r\n\x1a\n'
+
+def is_hdf5_filename(filename):
+    """
+    Checks whether maps should be written to `filename` in the HDF5 format
+    of `write_hdf5_map` rather than in FITS, from its extension
+    """
+    return os.path.splitext(filename)[1].lower() in ['.h5', '.hdf5']
+
+def is_hdf5_map(filename):
+    """
+    Checks whether a file is an HDF5 file, without importing h5py
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(_hdf5_signature)) == _hdf5_signature
+
+def downsample_map(values, weights=None):
+    """
+    Downsamples a flat map by 2 along its last two axes, averaging blocks of
+    2x2 pixels weighted by `weights`. Maps of odd size get a last row or
+    column of coarse pixels averaging the remaining pixels.
+
+    Parameters
+    ----------
+    values: ndarray
+        Map, or stack of maps, of shape (...,n1,n2)
+
+    weights: ndarray, optional
+        Weights of the pixels, broadcastable to the shape of the map, e.g.
+        the number of galaxies per pixel. Defaults to uniform weights.
+
+    Returns
+    -------
+    values: ndarray
+        Weighted mean of each block, of shape (...,(n1+1)//2,(n2+1)//2), zero
+        in blocks of zero weight
+
+    weights: ndarray
+        Sum of the weights of each block, to downsample the result further
+    """
+    values = np.asarray(values)
+    if weights is None:
+        weights = np.ones(values.shape[-2:])
+    weights = np.broadcast_to(np.asarray(weights, dtype=np.float64),
+                              values.shape)
+
+    # Pads the map to an even size with pixels of zero weight
+    n1, n2 = values.shape[-2:]
+    pad = [(0, 0)] * (values.ndim - 2) + [(0, n1 % 2), (0, n2 % 2)]
+    wsum = np.pad(weights * values, pad)
+    weights = np.pad(weights, pad)
+
+    shape = values.shape[:-2] + ((n1 + 1) // 2, 2, (n2 + 1) // 2, 2)
+    wsum = wsum.reshape(shape).sum(axis=(-3, -1))
+    weights = weights.reshape(shape).sum(axis=(-3, -1))
+    mean = np.zeros(wsum.shape)
+    np.divide(wsum, weights, out=mean, where=weights > 0)
+    return mean.astype(values.dtype, copy=False), weights
+
+def _chunks(shape, chunk_size, healpix=False):
+    # HEALpix maps are chunked along their pixel axis, with as many pixels
+    # as the square tiles of flat maps
+    if healpix:
+        if not shape[-1]:
+            return None
+        return (1,) * (len(shape) - 1) + (min(chunk_size**2, shape[-1]),)
+    # Square tiles of the last two axes, one map of the stack at a time
+    if len(shape) < 2:
+        return (min(chunk_size**2, shape[0]),) if shape[0] else None
+    return ((1,) * (len(shape) - 2)
+            + tuple(max(1, min(chunk_size, n)) for n in shape[-2:]))
+
+def default_pyramid_levels(shape, min_size=64):
+    """
+    Number of levels of the pyramid of a flat map, halving its size until
+    it fits in `min_size` pixels
+    """
+    levels = 0
+    while max(shape[-2:]) > min_size:
+        shape = [(n + 1) // 2 for n in shape[-2:]]
+        levels += 1
+    return levels
+
+def write_hdf5_map(filename, maps, weight=None, extra=None, attrs=None,
+                   levels=None, chunk_size=256, compression='gzip',
+                   compression_level=4, healpix=False):
+    """
+    Writes maps to an HDF5 file, in chunked and compressed datasets, with a
+    pyramid of flat maps downsampled by 2 at each level for quick looks.
+
+    The full resolution maps are stored in root datasets named after the
+    maps, and level `l` of the pyramid in the `pyramid/l` group, whose
+    PIXSIZE attribute is the pixel size of the level if the full resolution
+    one is set in `attrs`. Chunks are square tiles of `chunk_size` pixels,
+    so that regions of the map can be read without decompressing the
+    entire map, see `read_hdf5_map`.
+
+    Parameters
+    ----------
+    filename: string
+        Output HDF5 file
+
+    maps: dict
+        Flat maps, as arrays of shape (...,n1,n2), included in the pyramid,
+        or HEALpix maps of shape (...,npix) if `healpix` is set.
+
+    weight: string, optional
+        Name of the map of weights, e.g. the number of galaxies per pixel,
+        summed in the coarse levels. The other maps are averaged, weighted
+        by this map broadcast over their leading axes (e.g. both components
+        of a shear map), or uniformly if not set.
+
+    extra: dict, optional
+        Additional datasets, not included in the pyramid (e.g. coordinates
+        or responsivity)
+
+    attrs: dict, optional
+        Attributes of the file, values may be (value, comment) tuples as for
+        FITS headers, only the values are stored
+
+    levels: int, optional
+        Number of coarse levels, see `default_pyramid_levels`
+
+    chunk_size: int
+        Size of the side of the chunks [pixels]
+
+    compression: string
+        HDF5 compression filter, 'gzip' or 'lzf', or None
+
+    compression_level: int
+        Level of the 'gzip' filter, from 0 to 9
+
+    healpix: bool
+        Whether the maps are HEALpix maps, chunked by `chunk_size**2`
+        pixels, one map of the stack at a time, and without pyramid
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Writing HDF5 maps requires h5py")
+
+    options = {}
+    if compression is not None:
+        options['compression'] = compression
+        options['shuffle'] = True
+        if compression == 'gzip':
+            options['compression_opts'] = compression_level
+
+    def create(group, name, data, healpix=False):
+        data = np.asarray(data)
+        chunks = _chunks(data.shape, chunk_size, healpix) if data.ndim else None
+        group.create_dataset(name, data=data, chunks=chunks,
+                             **(options if chunks else {}))
+
+    if healpix:
+        levels = 0
+    elif levels is None:
+        levels = max([default_pyramid_levels(np.shape(m)) for m in maps.values()
+                      if np.ndim(m) >= 2] or [0])
+
+    with h5py.File(filename, 'w') as f:
+        for key, value in (attrs or {}).items():
+            if isinstance(value, tuple):
+                value = value[0]
+            if value is not None:
+                f.attrs[key] = value
+        f.attrs['NLEVELS'] = levels
+
+        for name, data in (extra or {}).items():
+            create(f, name, data)
+        for name, data in maps.items():
+            create(f, name, data, healpix)
+
+        # Each level is computed from the previous one, carrying the weights
+        maps = {name: np.asarray(data) for name, data in maps.items()}
+        w = maps.get(weight)
+        for level in range(1, levels + 1):
+            group = f.create_group('pyramid/%d' % level)
+            if 'PIXSIZE' in f.attrs:
+                group.attrs['PIXSIZE'] = f.attrs['PIXSIZE'] * 2**level
+            coarse = {}
+            for name, data in maps.items():
+                if name == weight:
+                    continue
+                wb = None
+                if w is not None:
+                    wb = w.reshape(w.shape[:-2] + (1,) * (data.ndim - w.ndim)
+                                   + w.shape[-2:])
+                coarse[name], _ = downsample_map(data, wb)
+            if w is not None:
+                _, w = downsample_map(w, w)
+                coarse[weight] = w.astype(maps[weight].dtype, copy=False)
+            maps = coarse
+            for name, data in maps.items():
+                create(group, name, data)
+
+def read_hdf5_map(filename, names, level=0, region=None):
+    """
+    Reads maps written by `write_hdf5_map`, at full resolution or at a
+    coarse level of the pyramid, possibly restricted to a region. Only the
+    chunks overlapping the region are read and decompressed.
+
+    Parameters
+    ----------
+    filename: string
+        Input HDF5 file
+
+    names: list of string
+        Maps to read
+
+    level: int
+        Level of the pyramid, 0 for the full resolution maps
+
+    region: ((int, int), (int, int)), optional
+        Ranges (start, stop) of the last two axes of the maps, in pixels of
+        the full resolution maps, widened to whole pixels of the level
+
+    Returns
+    -------
+    maps: list of arrays
+        Values of the requested maps
+
+    attrs: dict
+        Attributes of the file, with the pixel size PIXSIZE of the level
+    """
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("Reading HDF5 maps requires h5py")
+
+    with h5py.File(filename, 'r') as f:
+        attrs = dict(f.attrs)
+        if level > attrs.get('NLEVELS', 0):
+            raise ValueError("%s has %d levels, level %d requested"
+                             % (filename, attrs.get('NLEVELS', 0), level))
+        group = f if level == 0 else f['pyramid/%d' % level]
+        attrs.update(group.attrs)
+
+        index = Ellipsis
+        if region is not None:
+            scale = 2**level
+            index = (Ellipsis,) + tuple(slice(start // scale,
+                                              -(-stop // scale))
+                                        for start, stop in region)
+        maps = [group[name][index] for name in names]
+    return maps, attrs
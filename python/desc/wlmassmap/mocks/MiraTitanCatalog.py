@@ -1,18 +1,77 @@
-from astropy.table import Table
-from astropy.io import fits
 from GCR import BaseGalaxyCatalog, register_reader
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
 import numpy as np
 from astropy.cosmology import FlatLambdaCDM
+from ..catalog_io import CatalogReader
 
 __all__ = ['MiraTitanCatalog']
 
 def _get_fits_data(fits_file):
     return fits_file[1].data
 
+@lru_cache(maxsize=16)
+def _native_columns(filename, mtime):
+    """
+    Columns of a tomographic file, cached until the file is modified
+    """
+    with CatalogReader(filename) as reader:
+        return tuple(reader.columns)
+
+class _TomoFile(object):
+    """
+    Native dataset of a tomographic bin. Columns are read on request from
+    the memory mapped file, in native byte order, on a thread pool. Requesting
+    a column also prefetches it from the following bins, so that their files
+    are read in the background while the current one is consumed.
+    """
+
+    def __init__(self, tomo, filename, pool):
+        self.tomo = tomo
+        self.filename = filename
+        self.following = []
+        self._pool = pool
+        self._futures = {}
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _read(self, name):
+        with self._lock:
+            if self._reader is None:
+                self._reader = CatalogReader(self.filename)
+        values = self._reader.read([name])[name]
+        return np.array(values, dtype=values.dtype.newbyteorder('='))
+
+    def prefetch(self, name):
+        if name not in self._futures:
+            self._futures[name] = self._pool.submit(self._read, name)
+
+    def fetch(self, name):
+        for dataset in self.following:
+            dataset.prefetch(name)
+        self.prefetch(name)
+        return self._futures.pop(name).result()
+
+    def close(self):
+        # Waits for the reads already started before closing the file
+        for future in self._futures.values():
+            future.cancel()
+        wait(self._futures.values())
+        self._futures = {}
+        with self._lock:
+            if self._reader is not None:
+                self._reader.close()
+            self._reader = None
+
 class MiraTitanCatalog(BaseGalaxyCatalog):
     """
     Mira Titan catalog reader for the DESCQA generic catalog reader
+
+    Each tomographic file is a native dataset. Files are memory mapped and
+    only the requested columns are read, while the same columns of the next
+    `prefetch` files (default: 1) are read in the background.
     """
 
     def _subclass_init(self,
@@ -20,7 +79,7 @@ class MiraTitanCatalog(BaseGalaxyCatalog):
             cosmo_h=0.704,
             cosmo_Omega_M0=0.272,
             filename_template='MT_LSST_tomo{}.fits',
-            nbins=10, **kwargs):
+            nbins=10, prefetch=1, **kwargs):
 
         self._quantity_modifiers ={
             'ra': 'ra_arcmin',
@@ -38,25 +97,38 @@ class MiraTitanCatalog(BaseGalaxyCatalog):
         self._filename_template = filename_template
         self._catalog_main_dir = catalog_main_dir
         self._tomo_list = list(range(1,self._nbins+1))
+        self._prefetch = prefetch
         print("WARNING: Mira-Titan Catalog does not provide galaxy ids, magnification, or convergence, these fields will be set to 0")
 
+    def _tomo_filename(self, i):
+        return os.path.join(self._catalog_main_dir, self._filename_template.format(i))
+
     def _generate_native_quantity_list(self):
-        with fits.open(os.path.join(self._catalog_main_dir, self._filename_template.format(1))) as d:
-            native_quantities = d[1].data.dtype.names
-        return native_quantities
+        filename = self._tomo_filename(1)
+        return list(_native_columns(filename, os.stat(filename).st_mtime_ns))
 
     def _iter_native_dataset(self, pre_filters=None):
-        for i in self._tomo_list:
-            if pre_filters and not all(f[0](*([i]*(len(f)-1))) for f in pre_filters):
-                continue
+        tomo_list = [i for i in self._tomo_list
+                     if not pre_filters or all(f[0](*([i]*(len(f)-1))) for f in pre_filters)]
 
-            fp = Table.read(os.path.join(self._catalog_main_dir, self._filename_template.format(i)))
-            yield i, fp
+        # Columns requested from a bin are prefetched from the `prefetch`
+        # following bins, files are only opened when first read
+        pool = ThreadPoolExecutor(max_workers=self._prefetch + 1)
+        datasets = [_TomoFile(i, self._tomo_filename(i), pool) for i in tomo_list]
+        for k, dataset in enumerate(datasets):
+            dataset.following = datasets[k+1:k+1+self._prefetch]
+        try:
+            for dataset in datasets:
+                yield dataset
+                dataset.close()
+        finally:
+            for dataset in datasets:
+                dataset.close()
+            pool.shutdown()
 
     @staticmethod
     def _fetch_native_quantity(dataset, native_quantity):
-        fid, data = dataset
-        return data[native_quantity]
+        return dataset.fetch(native_quantity)
 
 
 # Register reader
@@ -1,53 +1,218 @@
 # This module extracts from the simulation source a given footprint will all
 # fields required for downstream analysis
-from GCRCatalogs import load_catalog
 import os
 import yaml
 from optparse import OptionParser
 import astropy.table as table
+import h5py
+import numpy as np
+from ..instrumentation import profile_stage, span
+from ..spatial_index import patch_pixels
 
 required_quantities = ['galaxy_id', 'ra', 'dec',
                        'ra_true', 'dec_true',
                        'shear_1', 'shear_2',
                        'convergence', 'redshift']
 
-def extract_footprint(config):
+# Resolution of the healpix_pixel native quantity of the DC2 simulations
+native_nside = 32
+
+# Number of rows of the HDF5 chunks of the output catalog
+write_chunk_size = 65536
+
+def footprint_filters(catalog, footprint):
     """
-    Extracts data from simulation and exports the master catalog as an HDF5 table
+    Builds the GCR filters selecting a footprint in the simulation
 
     Parameters
     ----------
-        config: dictionary
-            Configuration dictionary read from yaml config file
+        catalog: GCR catalog
+            Simulation catalog
+
+        footprint: dictionary
+            Footprint configuration, as in the `extract_footprint` config
+
+    Returns
+    -------
+        filters: list
+            GCR filters
+    """
+    filters = []
+    if footprint['type'] == 'patch':
+        ra_min, ra_max = footprint['ra_range']
+        dec_min, dec_max = footprint['dec_range']
+
+        # if simulation has magnification, use apparent (ra,dec)
+        # otherwise fallback to true ra,dec
+        if catalog.has_quantities(['ra','dec']):
+            filters.append((lambda ra: (ra > ra_min) & (ra < ra_max), 'ra'))
+            filters.append((lambda dec: (dec > dec_min) & (dec < dec_max), 'dec'))
+        else:
+            filters.append((lambda ra: (ra > ra_min) & (ra < ra_max), 'ra_true'))
+            filters.append((lambda dec: (dec > dec_min) & (dec < dec_max), 'dec_true'))
+    else:
+        raise NotImplementedError
+    return filters
+
+def footprint_pixels(footprint, nside):
+    """
+    HEALpix pixels (RING ordering) overlapping a footprint
+
+    Parameters
+    ----------
+        footprint: dictionary
+            Footprint configuration, as in the `extract_footprint` config
+
+        nside: int
+            HEALpix resolution
+
+    Returns
+    -------
+        pixels: int array
+            Pixels overlapping the footprint, possibly including a few
+            pixels around it
+    """
+    if footprint['type'] != 'patch':
+        raise NotImplementedError
+    return patch_pixels(footprint['ra_range'], footprint['dec_range'], nside)
+
+def footprint_native_filters(catalog, footprint):
+    """
+    Builds the GCR native filters pre-selecting the native chunks of the
+    simulation overlapping a footprint, when the reader supports it, so that
+    the chunks outside of the footprint are not read
+
+    Parameters
+    ----------
+        catalog: GCR catalog
+            Simulation catalog
+
+        footprint: dictionary
+            Footprint configuration, as in the `extract_footprint` config
+
+    Returns
+    -------
+        native_filters: list
+            GCR native filters, empty if the reader has no spatial native
+            quantity
+    """
+    native_quantities = getattr(catalog, 'native_filter_quantities', None) or []
+    if 'healpix_pixel' not in native_quantities or footprint['type'] != 'patch':
+        return []
+    pixels = footprint_pixels(footprint, native_nside)
+    return [(lambda p: np.isin(p, pixels), 'healpix_pixel')]
+
+def iter_footprint_chunks(config):
     """
+    Iterates over the native chunks of the simulation (e.g. files or HEALpix
+    pixels), reading the quantities of the galaxies in the footprint in a
+    single pass
 
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary, as in the `extract_footprint` config
+
+    Yields
+    ------
+        chunk: dict of arrays
+            Quantities of the galaxies of a native chunk in the footprint
+    """
     # Load a catalog using the GCR a
-    catalog = load_catalog(config['catalog'])
+    with span('load_catalog'):
+        # The GCR catalogs are only imported when extracting a footprint
+        from GCRCatalogs import load_catalog
+        catalog = load_catalog(config['catalog'])
+
+    quantities = list(required_quantities)
+    for q in config.get('export_quantities') or []:
+        if q not in quantities:
+            quantities.append(q)
 
+    # Applies some filters to the input simulation, pushing the selection of
+    # the footprint down to the reader where possible
     filters = []
+    native_filters = []
+    if config.get('footprint') is not None:
+        filters = footprint_filters(catalog, config['footprint'])
+        native_filters = footprint_native_filters(catalog, config['footprint'])
 
-    # Applies some filters to the input simulation
-    if 'footprint' in config:
-        if config['footprint']['type'] == 'patch':
-            ra_min, ra_max = config['footprint']['ra_range']
-            dec_min, dec_max = config['footprint']['dec_range']
-
-            # if simulation has magnification, use apparent (ra,dec)
-            # otherwise fallback to true ra,dec
-            if catalog.has_quantities(['ra','dec']):
-                filters.append((lambda ra: (ra > ra_min) & (ra < ra_max), 'ra'))
-                filters.append((lambda dec: (dec > dec_min) & (dec < dec_max), 'dec'))
-            else:
-                filters.append((lambda ra: (ra > ra_min) & (ra < ra_max), 'ra_true'))
-                filters.append((lambda dec: (dec > dec_min) & (dec < dec_max), 'dec_true'))
-        else:
-            raise NotImplementedError
+    chunks = catalog.get_quantities(quantities, filters=filters,
+                                    native_filters=native_filters or None,
+                                    return_iterator=True)
+    while True:
+        with span('get_quantities'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield {q: np.asarray(chunk[q]) for q in quantities}
+
+def extract_footprint_catalog(config):
+    """
+    Extracts data from simulation as an in-memory table
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary, as in the `extract_footprint` config
+
+    Returns
+    -------
+        catalog: Table
+            Ground truth catalog
+    """
+    chunks = list(iter_footprint_chunks(config))
+    if not chunks:
+        return table.Table(names=required_quantities,
+                           dtype=['i8'] + ['f8'] * (len(required_quantities) - 1))
+    return table.Table({q: np.concatenate([c[q] for c in chunks])
+                        for q in chunks[0]}, names=list(chunks[0]))
+
+def extract_footprint(config):
+    """
+    Extracts data from simulation and exports the master catalog as an HDF5 table
+
+    The simulation is read in a single pass over its native chunks, each
+    chunk being appended to a resizable chunked `WLMassMap_data` dataset, so
+    that memory is bounded by the size of a native chunk rather than of the
+    footprint.
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary read from yaml config file. If
+            `profile` is set, the time, memory and I/O of each phase are
+            saved next to the output, see `instrumentation.profile_stage`.
+    """
+
+    with profile_stage('extract_footprint', config.get('profile'),
+                       config['output_filename']), \
+         h5py.File(config['output_filename'], 'w') as fout:
+        dset = None
+        for chunk in iter_footprint_chunks(config):
+            n = len(chunk['galaxy_id'])
+            if dset is None:
+                dtype = np.dtype([(q, v.dtype, v.shape[1:])
+                                  for q, v in chunk.items()])
+                dset = fout.create_dataset("WLMassMap_data", shape=(0,),
+                                           maxshape=(None,), dtype=dtype,
+                                           chunks=(write_chunk_size,))
+            if n == 0:
+                continue
+
+            with span('write'):
+                rows = np.empty(n, dtype=dset.dtype)
+                for q, v in chunk.items():
+                    rows[q] = v
+                start = dset.shape[0]
+                dset.resize((start + n,))
+                dset[start:] = rows
 
-    # Exports the catalog in an HDF5 file
-    filename = config['output_filename']
-    quantitites = catalog.get_quantities(required_quantities, filters=filters)
-    outdict = table.Table(catalog.get_quantities(required_quantities, filters=filters))
-    outdict.write(filename,path="WLMassMap_data")
+        if dset is None:
+            # Empty footprint
+            dtype = [('galaxy_id', 'i8')] + [(q, 'f8') for q in required_quantities[1:]]
+            fout.create_dataset("WLMassMap_data", shape=(0,), maxshape=(None,),
+                                dtype=dtype, chunks=(write_chunk_size,))
 
 if __name__ == "__main__":
 
@@ -55,6 +220,6 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     with open(args[0]) as f:
-        config = yaml.load(f.read())
+        config = yaml.safe_load(f)
 
     extract_footprint(config['extract_footprint'])
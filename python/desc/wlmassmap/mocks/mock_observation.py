@@ -2,11 +2,72 @@ import os
 import yaml
 from astropy.table import Table
 from optparse import OptionParser
-import h5py
 import numpy as np
-from numpy.random import randn
+from ..catalog_io import CatalogReader, read_catalog
+from ..instrumentation import profile_stage, span
 
-def metacal_format(catalog, e1, e2, g1, g2, R=np.diag([1,1]), delta_gamma=0.01, **kwargs):
+# Shear columns produced by the metacal format
+metacal_columns = ['mcal_g', 'mcal_g_1p', 'mcal_g_1m', 'mcal_g_2p', 'mcal_g_2m']
+
+# Number of rows drawn from each independent random stream of shape noise
+noise_block_size = 65536
+
+def metacal_shear(e1, e2, g1, g2, R=np.diag([1,1]), delta_gamma=0.01,
+                  out=None, work=None, dtype=None):
+    """
+    Computes the metacal shear measurements, modeled as e = e|g=0 + R . g
+
+    Parameters
+    ----------
+    e1, e2: array_like
+        Intrinsic ellipticity of the galaxies
+
+    g1, g2: array_like
+        Shear or reduced shear at the position of the galaxies
+
+    R: (2,2) array
+        Shear responsivity
+
+    delta_gamma: float
+        Shearing strength when measuring the responsivity
+
+    out: dict of (N,2) arrays, optional
+        Preallocated outputs for each of the `metacal_columns`
+
+    work: (N,) array, optional
+        Preallocated scratch buffer
+
+    dtype: dtype, optional
+        Floating point type of the outputs allocated here, float64 by default
+
+    Returns
+    -------
+    out: dict of (N,2) arrays
+        Measured shear, and measured shear for the 4 sheared images
+    """
+    R = np.asarray(R, dtype='float64')
+    if out is None:
+        out = {name: np.empty((len(e1), 2), dtype=dtype)
+               for name in metacal_columns}
+    if work is None:
+        work = np.empty(len(e1))
+
+    mcal_g = out['mcal_g']
+    for i, e in enumerate([e1, e2]):
+        np.multiply(g1, R[i, 0], out=mcal_g[:, i])
+        np.multiply(g2, R[i, 1], out=work)
+        mcal_g[:, i] += work
+        mcal_g[:, i] += e
+
+    # Sheared images only differ by a constant offset of delta_gamma * R[:,j]
+    np.add(mcal_g, delta_gamma * R[:, 0], out=out['mcal_g_1p'])
+    np.add(mcal_g, -delta_gamma * R[:, 0], out=out['mcal_g_1m'])
+    np.add(mcal_g, delta_gamma * R[:, 1], out=out['mcal_g_2p'])
+    np.add(mcal_g, -delta_gamma * R[:, 1], out=out['mcal_g_2m'])
+    return out
+
+def metacal_format(catalog, e1, e2, g1, g2, R=np.diag([1,1]), delta_gamma=0.01,
+                   dtype=None, **kwargs):
     """
     Populate the catalog with metacal fields
 
@@ -26,66 +87,240 @@ def metacal_format(catalog, e1, e2, g1, g2, R=np.diag([1,1]), delta_gamma=0.01,
 
     delta_gamma: float
         Shearing strength when measuring the responsivity
+
+    dtype: dtype, optional
+        Floating point type of the metacal columns, float64 by default
     """
 
     catalog['mcal_flags'] = 0
 
     # Model the measured shear as e = e|g=0 + R . g
-    catalog['mcal_g'] = np.stack([e1, e2], axis=1) + np.dot(R, np.stack([g1, g2], axis=1).T).T
+    shears = metacal_shear(e1, e2, g1, g2, R, delta_gamma, dtype=dtype)
+    for name in metacal_columns:
+        catalog[name] = shears[name]
 
-    catalog['mcal_g_1p'] = np.stack([e1, e2], axis=1) + np.dot(R, np.stack([g1 + delta_gamma, g2], axis=1).T).T
-    catalog['mcal_g_1m'] = np.stack([e1, e2], axis=1) + np.dot(R, np.stack([g1 - delta_gamma, g2], axis=1).T).T
+def shape_noise(sigma, start, stop, seed=None, out=None):
+    """
+    Draws Gaussian shape noise for rows [start, stop) of a catalog.
 
-    catalog['mcal_g_2p'] = np.stack([e1, e2], axis=1) + np.dot(R, np.stack([g1, g2 + delta_gamma], axis=1).T).T
-    catalog['mcal_g_2m'] = np.stack([e1, e2], axis=1) + np.dot(R, np.stack([g1, g2 - delta_gamma], axis=1).T).T
+    Noise is drawn from independent random streams, one per block of
+    `noise_block_size` rows, derived from `seed`. The noise of a given galaxy
+    therefore does not depend on how the catalog is split in chunks, as long
+    as `start` is a multiple of `noise_block_size`.
 
+    Parameters
+    ----------
+    sigma: float
+        Per component standard deviation of the noise
 
-def mock_observation(config):
+    start, stop: int
+        Range of rows to draw noise for
+
+    seed: int or SeedSequence, optional
+        Seed of the noise realization
+
+    out: tuple of arrays, optional
+        Preallocated (e1, e2) buffers of at least stop - start elements
+
+    Returns
+    -------
+    e1, e2: ndarray
+        Intrinsic ellipticities
     """
-    Create a mock shape catalog matching the format of a given shape measurement
-    pipeline.
+    assert start % noise_block_size == 0
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+
+    n = stop - start
+    if out is None:
+        out = (np.empty(n), np.empty(n))
+    e1, e2 = out[0][:n], out[1][:n]
+
+    for offset in range(0, n, noise_block_size):
+        block = (start + offset) // noise_block_size
+        size = min(noise_block_size, n - offset)
+        rng = np.random.default_rng(np.random.SeedSequence(seed.entropy,
+                                                           spawn_key=(block,)))
+        rng.standard_normal(out=e1[offset:offset + size])
+        rng.standard_normal(out=e2[offset:offset + size])
+
+    e1 *= sigma
+    e2 *= sigma
+    return e1, e2
+
+def mock_observation_chunked(config, chunk_size):
+    """
+    Create a mock metacal shape catalog by walking the ground truth catalog by
+    chunks, writing the result incrementally to a chunked HDF5 file under
+    the `WLMassMap_data` path. All per-chunk arrays are preallocated once.
 
     Parameters
     ----------
         config: dictionary
             Configuration dictionary read from yaml config file
+
+        chunk_size: int
+            Number of rows processed at once, rounded up to a multiple of
+            `noise_block_size`
+    """
+    import h5py
+    if config['format']['type'] != 'metacal':
+        raise NotImplementedError
+
+    fmt = config['format']
+    R = fmt.get('R', np.diag([1,1]))
+    delta_gamma = fmt.get('delta_gamma', 0.01)
+
+    noise = config.get('shape_noise')
+    if noise is not None and noise['type'] != 'Gaussian':
+        raise NotImplementedError
+    if noise is not None:
+        seed = np.random.SeedSequence(noise.get('seed'))
+
+    chunk_size = -(-chunk_size // noise_block_size) * noise_block_size
+
+    fields = ['galaxy_id', 'ra', 'dec', 'shear_1', 'shear_2']
+    if config['reduced_shear']:
+        fields.append('convergence')
+
+    # Positions are kept in double precision, shears are computed in double
+    # precision and stored following `dtype`
+    fdtype = np.dtype(config.get('dtype') or 'float64')
+    dtype = np.dtype([('id', 'i8'), ('ra', 'f8'), ('dec', 'f8'),
+                      ('mcal_flags', 'i8')] +
+                     [(name, fdtype, (2,)) for name in metacal_columns])
+
+    with CatalogReader(config['input_filename']) as cat_gt, \
+         h5py.File(config['output_filename'], 'w') as fout:
+        ntot = len(cat_gt)
+        dset = fout.create_dataset("WLMassMap_data", shape=(ntot,), dtype=dtype,
+                                   chunks=(max(1, min(chunk_size, ntot)),))
+
+        # Preallocated per chunk buffers
+        buf = np.zeros(chunk_size, dtype=dtype)
+        g1 = np.empty(chunk_size)
+        g2 = np.empty(chunk_size)
+        e = (np.zeros(chunk_size), np.zeros(chunk_size))
+        work = np.empty(chunk_size)
+
+        for start in range(0, ntot, chunk_size):
+            stop = min(start + chunk_size, ntot)
+            n = stop - start
+            out = buf[:n]
+            with span('read'):
+                gt = cat_gt.read(fields, start, stop)
+
+                out['id'] = gt['galaxy_id']
+                out['ra'] = gt['ra']
+                out['dec'] = gt['dec']
+
+                # Extract the shear that will be used to form the mock shape measurement
+                g1[:n] = gt['shear_1']
+                g2[:n] = gt['shear_2']
+                if config['reduced_shear']:
+                    np.add(gt['convergence'], 1, out=work[:n])
+                    g1[:n] /= work[:n]
+                    g2[:n] /= work[:n]
+
+            # Computes some intrinsic shapes for the galaxies
+            if noise is not None:
+                with span('shape_noise'):
+                    shape_noise(noise['sigma'], start, stop, seed, out=e)
+
+            with span('metacal'):
+                metacal_shear(e[0][:n], e[1][:n], g1[:n], g2[:n], R, delta_gamma,
+                              out={name: out[name] for name in metacal_columns},
+                              work=work[:n])
+
+            with span('write'):
+                dset[start:stop] = out
+
+def mock_shape_catalog(cat_gt, config):
     """
+    Create a mock shape catalog from a ground truth catalog loaded in memory
 
-    # Open the input ground_truth catalog
-    filename = config['input_filename']
-    cat_gt = h5py.File(filename, 'r')["WLMassMap_data"]
+    Parameters
+    ----------
+        cat_gt: table or dictionary
+            Ground truth catalog, with galaxy_id, ra, dec, shear_1, shear_2
+            and, for reduced shear, convergence columns
+
+        config: dictionary
+            Configuration dictionary, as in the `mock_observation` config
 
+    Returns
+    -------
+        catalog: Table
+            Mock shape catalog
+    """
     # Initialize catalog with mandatory fields
-    catalog = Table([cat_gt['galaxy_id'][...], cat_gt['ra'][...], cat_gt['dec'][...]],
-                    names=['id', 'ra', 'dec'])
+    catalog = Table([np.asarray(cat_gt[name])
+                     for name in ['galaxy_id', 'ra', 'dec']],
+                    names=['id', 'ra', 'dec'], copy=False)
 
     # Extract the shear that will be used to form the mock shape measurement
     if config['reduced_shear']:
-        factor = 1. / (1 + cat_gt['convergence'][...])
+        factor = 1. / (1 + np.asarray(cat_gt['convergence']))
     else:
         factor = 1.
-    g1 = factor * cat_gt['shear_1'][...]
-    g2 = factor * cat_gt['shear_2'][...]
+    g1 = factor * np.asarray(cat_gt['shear_1'])
+    g2 = factor * np.asarray(cat_gt['shear_2'])
 
     # Computes some intrinsic shapes for the galaxies
     e1 = np.zeros_like(g1)
     e2 = np.zeros_like(g2)
     if 'shape_noise' in config:
         if config['shape_noise']['type'] == 'Gaussian':
-            e1 = config['shape_noise']['sigma'] * randn(len(g1))
-            e2 = config['shape_noise']['sigma'] * randn(len(g2))
+            with span('shape_noise'):
+                e1, e2 = shape_noise(config['shape_noise']['sigma'], 0,
+                                     len(g1), config['shape_noise'].get('seed'))
         else:
             raise NotImplementedError
 
     # Adds format specific catalog fields
     if config['format']['type'] == 'metacal':
-        metacal_format(catalog, g1, g2, e1, e2, **config['format'])
+        with span('metacal'):
+            metacal_format(catalog, e1, e2, g1, g2, dtype=config.get('dtype'),
+                           **config['format'])
     else:
         raise NotImplementedError
 
-    # Exports the catalog in an HDF5 file
-    filename = config['output_filename']
-    catalog.write(filename, overwrite=True)
+    return catalog
+
+def mock_observation(config):
+    """
+    Create a mock shape catalog matching the format of a given shape measurement
+    pipeline.
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary read from yaml config file. If
+            `chunk_size` is set, the input is processed by chunks of rows and
+            the output is written as a chunked HDF5 file. If `profile` is
+            set, the time, memory and I/O of each phase are saved next to the
+            output, see `instrumentation.profile_stage`. If `dtype` is
+            'float32', the metacal columns are saved in single precision.
+    """
+    with profile_stage('mock_observation', config.get('profile'),
+                       config['output_filename']):
+        if config.get('chunk_size'):
+            return mock_observation_chunked(config, config['chunk_size'])
+
+        # Open the input ground_truth catalog, reading only the required fields
+        filename = config['input_filename']
+        fields = ['galaxy_id', 'ra', 'dec', 'shear_1', 'shear_2']
+        if config['reduced_shear']:
+            fields.append('convergence')
+        with span('read'):
+            cat_gt = read_catalog(filename, fields)
+
+        catalog = mock_shape_catalog(cat_gt, config)
+
+        # Exports the catalog in an HDF5 file
+        filename = config['output_filename']
+        with span('write'):
+            catalog.write(filename, overwrite=True)
 
 
 if __name__ == "__main__":
@@ -94,6 +329,6 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     with open(args[0]) as f:
-        config = yaml.load(f.read())
+        config = yaml.safe_load(f)
 
     mock_observation(config['mock_observation'])
@@ -0,0 +1,358 @@
+# This module generates synthetic catalogs with an analytic shear field, so
+# that the pipeline can be tested and benchmarked without access to a
+# simulation
+from optparse import OptionParser
+import yaml
+
+import numpy as np
+import healpy as hp
+import h5py
+from astropy.table import Table
+
+from ..projection_utils import radec2xy
+from .mock_observation import metacal_shear, metacal_columns, noise_block_size
+
+# Columns of the ground truth catalogs, as produced by extract_footprint
+truth_dtype = np.dtype([('galaxy_id', 'i8'), ('ra', 'f8'), ('dec', 'f8'),
+                        ('ra_true', 'f8'), ('dec_true', 'f8'),
+                        ('shear_1', 'f8'), ('shear_2', 'f8'),
+                        ('convergence', 'f8'), ('redshift', 'f8')])
+
+# Columns of the metacal shape catalogs, as produced by mock_observation
+shape_dtype = np.dtype([('id', 'i8'), ('ra', 'f8'), ('dec', 'f8'),
+                        ('mcal_flags', 'i8')] +
+                       [(name, 'f8', (2,)) for name in metacal_columns] +
+                       [('redshift', 'f8')])
+
+def footprint_center(footprint):
+    """
+    Returns the (ra, dec) center of a footprint [degrees]
+    """
+    if footprint['type'] == 'patch':
+        return (0.5 * sum(footprint['ra_range']),
+                0.5 * sum(footprint['dec_range']))
+    elif footprint['type'] == 'healpix':
+        theta, phi = hp.pix2ang(footprint['nside'],
+                                np.asarray(footprint['pixels']))
+        vec = np.array(hp.ang2vec(theta, phi)).reshape((-1, 3)).sum(axis=0)
+        theta, phi = hp.vec2ang(vec)
+        return np.degrees(phi[0]), 90. - np.degrees(theta[0])
+    else:
+        raise NotImplementedError
+
+def healpix_footprint(nside, center_ra, center_dec, radius):
+    """
+    Builds a HEALpix footprint covering a disc on the sky
+
+    Parameters
+    ----------
+    nside: int
+        HEALpix nside parameter of the footprint
+
+    center_ra, center_dec: float
+        Center of the disc [degrees]
+
+    radius: float
+        Radius of the disc [degrees]
+
+    Returns
+    -------
+    footprint: dict
+        Footprint configuration, with the RING pixels covering the disc
+    """
+    vec = hp.ang2vec(np.radians(90. - center_dec), np.radians(center_ra))
+    pixels = hp.query_disc(nside, vec, np.radians(radius))
+    return {'type': 'healpix', 'nside': nside, 'pixels': pixels}
+
+def sample_footprint(rng, n, footprint):
+    """
+    Draws positions uniformly distributed over a footprint
+
+    Parameters
+    ----------
+    rng: Generator
+        Random number generator
+
+    n: int
+        Number of positions to draw
+
+    footprint: dict
+        Either a `patch` in ra, dec with `ra_range` and `dec_range` [degrees],
+        or a set of `healpix` RING `pixels` at a given `nside`
+
+    Returns
+    -------
+    ra, dec: ndarray
+        Coordinates of the positions [degrees]
+    """
+    if footprint['type'] == 'patch':
+        ra_min, ra_max = footprint['ra_range']
+        dec_min, dec_max = footprint['dec_range']
+        # Uniform on the sphere within the ra, dec box
+        z = rng.uniform(np.sin(np.radians(dec_min)),
+                        np.sin(np.radians(dec_max)), n)
+        return rng.uniform(ra_min, ra_max, n), np.degrees(np.arcsin(z))
+
+    elif footprint['type'] == 'healpix':
+        nside = footprint['nside']
+        pixels = np.asarray(footprint['pixels'])
+        radius = hp.max_pixrad(nside)
+
+        ra = np.empty(n)
+        dec = np.empty(n)
+        todo = np.arange(n)
+        target = pixels[rng.integers(0, len(pixels), n)]
+        # Rejection sampling within a cap enclosing each of the pixels
+        while len(todo) > 0:
+            theta0, phi0 = hp.pix2ang(nside, target[todo])
+            cos_r = rng.uniform(np.cos(radius), 1., len(todo))
+            sin_r = np.sqrt(1 - cos_r**2)
+            psi = rng.uniform(0, 2 * np.pi, len(todo))
+            # Offset from the pole, rotated to the center of the pixel
+            x, y, z = sin_r * np.cos(psi), sin_r * np.sin(psi), cos_r
+            ct, st = np.cos(theta0), np.sin(theta0)
+            x, z = ct * x + st * z, -st * x + ct * z
+            x, y = np.cos(phi0) * x - np.sin(phi0) * y, \
+                   np.sin(phi0) * x + np.cos(phi0) * y
+            theta, phi = hp.vec2ang(np.stack([x, y, z], axis=-1))
+            keep = hp.ang2pix(nside, theta, phi) == target[todo]
+            ra[todo[keep]] = np.degrees(phi[keep])
+            dec[todo[keep]] = 90. - np.degrees(theta[keep])
+            todo = todo[~keep]
+        return ra, dec
+
+    else:
+        raise NotImplementedError
+
+def gaussian_halos(footprint, nhalos=4, kappa0=0.05, width=10., seed=0):
+    """
+    Draws the parameters of a set of Gaussian convergence profiles
+
+    Parameters
+    ----------
+    footprint: dict
+        Footprint the halos are placed in, see `sample_footprint`
+
+    nhalos: int
+        Number of halos
+
+    kappa0: float
+        Central convergence of the halos
+
+    width: float
+        Standard deviation of the profiles [arcmin]
+
+    seed: int
+        Seed of the halo positions
+
+    Returns
+    -------
+    halos: dict
+        Positions `ra`, `dec` [degrees], amplitudes `kappa0` and `width`
+        [arcmin] of the halos
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(seed))
+    ra, dec = sample_footprint(rng, nhalos, footprint)
+    return {'ra': ra, 'dec': dec,
+            'kappa0': np.full(nhalos, kappa0), 'width': np.full(nhalos, width)}
+
+def gaussian_halo_shear(ra, dec, halos):
+    """
+    Analytic convergence and shear of a sum of Gaussian convergence profiles
+    kappa(r) = kappa0 exp(-r^2 / 2 s^2), for which the tangential shear is
+
+        gamma_t(r) = kappa0 (2 s^2 / r^2) (1 - exp(-r^2 / 2 s^2)) - kappa(r)
+
+    Each profile is evaluated in the gnomonic projection around its center.
+
+    Parameters
+    ----------
+    ra, dec: array_like
+        Coordinates of the galaxies [degrees]
+
+    halos: dict
+        Halo parameters, as returned by `gaussian_halos`
+
+    Returns
+    -------
+    kappa, gamma1, gamma2: ndarray
+        Convergence and shear at the position of the galaxies
+    """
+    kappa = np.zeros(len(ra))
+    gamma1 = np.zeros(len(ra))
+    gamma2 = np.zeros(len(ra))
+    for ra0, dec0, k0, s in zip(halos['ra'], halos['dec'],
+                                halos['kappa0'], halos['width']):
+        x, y = radec2xy(ra0, dec0, ra, dec)
+        s = s / 60.
+        r2 = x**2 + y**2
+        k = k0 * np.exp(-0.5 * r2 / s**2)
+        # Mean convergence within r, taking the limit at the center
+        kmean = np.where(r2 > 1e-12 * s**2,
+                         k0 * 2 * s**2 / np.maximum(r2, 1e-300) * (1 - k / k0),
+                         k0)
+        gt = kmean - k
+        cos2phi = np.where(r2 > 0, (x**2 - y**2) / np.maximum(r2, 1e-300), 1.)
+        sin2phi = np.where(r2 > 0, 2 * x * y / np.maximum(r2, 1e-300), 0.)
+        kappa += k
+        gamma1 -= gt * cos2phi
+        gamma2 -= gt * sin2phi
+    return kappa, gamma1, gamma2
+
+def smail_redshifts(rng, n, z0=0.5, beta=1.5):
+    """
+    Draws redshifts from n(z) ~ z^2 exp(-(z/z0)^beta)
+    """
+    return z0 * rng.gamma(3. / beta, size=n)**(1. / beta)
+
+def synthetic_block(block, size, footprint, halos, kind='shape', seed=0,
+                    sigma_e=0.26, R=np.diag([1,1]), delta_gamma=0.01, out=None):
+    """
+    Generates a block of rows of a synthetic catalog. Each block is drawn
+    from an independent random stream, so that a catalog does not depend on
+    how it is split in blocks.
+
+    Parameters
+    ----------
+    block: int
+        Index of the block, rows start at block * `noise_block_size`
+
+    size: int
+        Number of rows of the block, at most `noise_block_size`
+
+    footprint: dict
+        Footprint of the catalog, see `sample_footprint`
+
+    halos: dict
+        Parameters of the shear field, see `gaussian_halos`
+
+    kind: string
+        Type of catalog, 'truth' or 'shape' (metacal format)
+
+    seed: int
+        Seed of the catalog
+
+    sigma_e: float
+        Per component shape noise of shape catalogs
+
+    R: (2,2) array
+        Metacal responsivity of shape catalogs
+
+    delta_gamma: float
+        Metacal shearing strength
+
+    out: structured array, optional
+        Preallocated output
+
+    Returns
+    -------
+    catalog: structured array
+        Rows of the catalog, with `truth_dtype` or `shape_dtype`
+    """
+    dtype = truth_dtype if kind == 'truth' else shape_dtype
+    if out is None:
+        out = np.zeros(size, dtype=dtype)
+
+    rng = np.random.default_rng(np.random.SeedSequence(seed,
+                                                       spawn_key=(block,)))
+    ra, dec = sample_footprint(rng, size, footprint)
+    kappa, gamma1, gamma2 = gaussian_halo_shear(ra, dec, halos)
+    start = block * noise_block_size
+
+    out['ra'] = ra
+    out['dec'] = dec
+    out['redshift'] = smail_redshifts(rng, size)
+    if kind == 'truth':
+        out['galaxy_id'] = np.arange(start, start + size)
+        out['ra_true'] = ra
+        out['dec_true'] = dec
+        out['shear_1'] = gamma1
+        out['shear_2'] = gamma2
+        out['convergence'] = kappa
+    else:
+        out['id'] = np.arange(start, start + size)
+        e1 = sigma_e * rng.standard_normal(size)
+        e2 = sigma_e * rng.standard_normal(size)
+        # Metacal measurement of the reduced shear
+        work = 1 - kappa
+        metacal_shear(e1, e2, gamma1 / work, gamma2 / work, R, delta_gamma,
+                      out={name: out[name] for name in metacal_columns},
+                      work=work)
+    return out
+
+def synthetic_catalog(ngal, footprint, kind='shape', nhalos=4, seed=0, **kwargs):
+    """
+    Generates a synthetic catalog in memory, see `synthetic_block`
+
+    Parameters
+    ----------
+    ngal: int
+        Number of galaxies
+
+    footprint: dict
+        Footprint of the catalog, see `sample_footprint`
+
+    kind: string
+        Type of catalog, 'truth' or 'shape' (metacal format)
+
+    nhalos: int
+        Number of Gaussian halos in the shear field
+
+    seed: int
+        Seed of the catalog
+
+    Returns
+    -------
+    catalog: Table
+        Synthetic catalog
+    """
+    halos = gaussian_halos(footprint, nhalos, seed=seed)
+    dtype = truth_dtype if kind == 'truth' else shape_dtype
+    catalog = np.zeros(ngal, dtype=dtype)
+    for start in range(0, ngal, noise_block_size):
+        stop = min(start + noise_block_size, ngal)
+        synthetic_block(start // noise_block_size, stop - start, footprint,
+                        halos, kind, seed, out=catalog[start:stop], **kwargs)
+    return Table(catalog, copy=False)
+
+def write_synthetic_catalog(filename, ngal, footprint, kind='shape', nhalos=4,
+                            seed=0, chunk_size=4194304, **kwargs):
+    """
+    Writes a synthetic catalog by chunks of rows to the `WLMassMap_data`
+    table of an HDF5 file, so that catalogs of 10^8 galaxies can be produced
+    with a memory footprint set by `chunk_size`. See `synthetic_catalog` for
+    the other parameters.
+    """
+    halos = gaussian_halos(footprint, nhalos, seed=seed)
+    dtype = truth_dtype if kind == 'truth' else shape_dtype
+    chunk_size = -(-chunk_size // noise_block_size) * noise_block_size
+    buf = np.zeros(min(chunk_size, ngal), dtype=dtype)
+
+    with h5py.File(filename, 'w') as f:
+        dset = f.create_dataset('WLMassMap_data', shape=(ngal,), dtype=dtype,
+                                chunks=(max(1, min(noise_block_size, ngal)),))
+        for start in range(0, ngal, chunk_size):
+            stop = min(start + chunk_size, ngal)
+            for i in range(start, stop, noise_block_size):
+                j = min(i + noise_block_size, stop)
+                synthetic_block(i // noise_block_size, j - i, footprint, halos,
+                                kind, seed, out=buf[i - start:j - start],
+                                **kwargs)
+            dset[start:stop] = buf[:stop - start]
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    (options, args) = parser.parse_args()
+
+    with open(args[0]) as f:
+        config = yaml.safe_load(f)
+
+    c = config['synthetic_catalog']
+    footprint = c['footprint']
+    if footprint['type'] == 'healpix' and 'pixels' not in footprint:
+        footprint = healpix_footprint(footprint['nside'], footprint['center_ra'],
+                                      footprint['center_dec'], footprint['radius'])
+    write_synthetic_catalog(c['output_filename'], int(c['ngal']),
+                            footprint, c.get('kind', 'shape'),
+                            c.get('nhalos', 4), c.get('seed', 0))
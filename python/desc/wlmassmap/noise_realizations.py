@@ -0,0 +1,308 @@
+# This module generates many randomized realizations of the convergence map
+# of a shape catalog, e.g. to estimate noise maps and error bars, projecting
+# the catalog only once
+from optparse import OptionParser
+import logging
+import time
+import yaml
+import numpy as np
+import healpy as hp
+from astropy.table import Table
+
+from .shear_map import add_metacal_shear, shear_map_columns
+from .projection import project_flat, project_healpix
+from .convergence_map import compute_convergence_map, write_convergence_map
+from .catalog_io import read_catalog
+from .instrumentation import profile_stage, span
+
+logger = logging.getLogger(__name__)
+
+class ShearRealizations(object):
+    """
+    Bins randomized realizations of the shear of a projected catalog.
+
+    The pixel of each galaxy is fixed, so that the selection of the galaxies,
+    the number of galaxies per pixel and the index of each galaxy in a stack
+    of maps are computed once. Realizations are then binned by batches, the
+    shear of `batch_size` realizations being accumulated in a single
+    bincount into a (batch_size,2,...) stack of maps.
+
+    Realizations are either:
+        - 'rotation': the shear of each galaxy is rotated by a random angle,
+          removing the lensing signal while preserving the noise properties
+          of the catalog
+        - 'noise': Gaussian shape noise of standard deviation `sigma` is added
+          to the shear of each galaxy, e.g. of a noise free mock catalog
+
+    The random numbers of realization `i` are drawn from an independent
+    stream derived from `seed`, so that a realization does not depend on the
+    batch it is computed in.
+
+    Parameters
+    ----------
+    pixel_index: int array
+        Pixel index of each galaxy, galaxies with index -1 are ignored
+
+    g: (N,2) array
+        Calibrated shear of each galaxy
+
+    npix: int
+        Number of pixels of the maps
+
+    kind: string
+        Type of realizations, 'rotation' or 'noise'
+
+    sigma: float, optional
+        Per component standard deviation of the shape noise, for 'noise'
+        realizations
+
+    seed: int, optional
+        Seed of the realizations
+
+    batch_size: int
+        Number of realizations binned at once. Scratch buffers take about
+        5 x 8 x batch_size bytes per galaxy.
+    """
+
+    def __init__(self, pixel_index, g, npix, kind='rotation', sigma=None,
+                 seed=None, batch_size=16):
+        if kind not in ['rotation', 'noise']:
+            raise NotImplementedError
+        if kind == 'noise' and sigma is None:
+            raise ValueError("Noise realizations require the shape noise sigma")
+        self.kind = kind
+        self.sigma = sigma
+        self.npix = npix
+        self.batch_size = batch_size
+        self.entropy = np.random.SeedSequence(seed).entropy
+
+        pixel_index = np.asarray(pixel_index)
+        sel = pixel_index >= 0
+        self.g1 = np.ascontiguousarray(np.asarray(g)[sel, 0])
+        self.g2 = np.ascontiguousarray(np.asarray(g)[sel, 1])
+        index = pixel_index[sel]
+        n = len(index)
+
+        # Galaxy counts are the same for all realizations
+        self.nmap = np.bincount(index, minlength=npix)
+        self._inv_nmap = np.zeros(npix)
+        self._inv_nmap[self.nmap > 0] = 1. / self.nmap[self.nmap > 0]
+
+        # Index of each galaxy in a flattened stack of maps, realizations
+        # being contiguous so that smaller batches use a prefix of it
+        self._index = (index[np.newaxis, :] +
+                       npix * np.arange(batch_size)[:, np.newaxis]).ravel()
+
+        # Scratch buffers, reused by all batches
+        self._w1 = np.empty((batch_size, n))
+        self._w2 = np.empty((batch_size, n))
+        self._buf = (np.empty(n), np.empty(n), np.empty(n))
+
+    def _draw(self, i, w1, w2):
+        """
+        Randomized shear of realization i
+        """
+        rng = np.random.default_rng(np.random.SeedSequence(self.entropy,
+                                                           spawn_key=(i,)))
+        if self.kind == 'rotation':
+            # Rotating a spin-2 field by an angle theta multiplies it by
+            # exp(2i theta), uniform over the circle
+            phi, c, tmp = self._buf
+            rng.random(out=phi)
+            phi *= 2 * np.pi
+            np.cos(phi, out=c)
+            np.sin(phi, out=phi)
+            np.multiply(self.g1, c, out=w1)
+            np.multiply(self.g2, phi, out=tmp)
+            w1 -= tmp
+            np.multiply(self.g1, phi, out=w2)
+            np.multiply(self.g2, c, out=tmp)
+            w2 += tmp
+        else:
+            rng.standard_normal(out=w1)
+            rng.standard_normal(out=w2)
+            w1 *= self.sigma
+            w2 *= self.sigma
+            w1 += self.g1
+            w2 += self.g2
+
+    def __call__(self, start, stop):
+        """
+        Bins realizations [start, stop), with stop - start <= batch_size
+
+        Returns
+        -------
+        gmap: (stop-start,2,npix) ndarray
+            Stack of shear maps
+        """
+        nreal = stop - start
+        assert 0 < nreal <= self.batch_size
+        w1, w2 = self._w1[:nreal], self._w2[:nreal]
+        for j in range(nreal):
+            self._draw(start + j, w1[j], w2[j])
+
+        index = self._index[:nreal * len(self.g1)]
+        size = nreal * self.npix
+        gmap = np.empty((nreal, 2, self.npix))
+        gmap[:, 0] = np.bincount(index, weights=w1.ravel(),
+                                 minlength=size).reshape((nreal, self.npix))
+        gmap[:, 1] = np.bincount(index, weights=w2.ravel(),
+                                 minlength=size).reshape((nreal, self.npix))
+        gmap *= self._inv_nmap
+        return gmap
+
+def compute_noise_realizations(catalog, projection, algorithm, nrealizations,
+                               kind='rotation', sigma=None, seed=None,
+                               batch_size=16, warm_start=False):
+    """
+    Computes convergence maps of randomized realizations of a shape catalog
+    loaded in memory. The catalog is calibrated and projected once, then
+    realizations are binned and inverted by batches, see `ShearRealizations`.
+
+    Parameters
+    ----------
+    catalog: table
+        Shape catalog, with at least the `shear_map_columns`
+
+    projection: dictionary
+        Projection configuration, as in the `shear_map` config
+
+    algorithm: dictionary
+        Algorithm configuration, as in the `convergence_map` config
+
+    nrealizations: int
+        Number of realizations
+
+    kind, sigma, seed, batch_size:
+        Type and options of the realizations, see `ShearRealizations`
+
+    warm_start: bool
+        With the 'masked_flat_ks' algorithm, whether the iterations of each
+        batch start from the solution of the previous batch
+
+    Returns
+    -------
+    kappa: dictionary
+        Stacks of convergence maps of shape (nrealizations,...), as keyword
+        arguments of `convergence_map.write_convergence_map`, the throughput
+        being reported in `info`
+    """
+    c = projection
+
+    with span('metacal'):
+        catalog = add_metacal_shear(catalog)
+
+    # Projects the catalog once, maps are binned on a compact set of pixels
+    maps = {}
+    with span('projection'):
+        if c['type'] in ['gnomonic']:
+            catalog, _, _ = project_flat(catalog, c['nx'], c['ny'],
+                                         c['pixel_size'], c['center_ra'],
+                                         c['center_dec'], c['type'])
+            pixel_index = np.asarray(catalog['pixel_index'])
+            npix = c['nx'] * c['ny']
+            shape = (c['ny'], c['nx'])
+            maps['pixel_size'] = c['pixel_size']
+        elif c['type'] == 'healpix':
+            catalog = project_healpix(catalog, nside=c['nside'])
+            pixel_index = np.asarray(catalog['pixel_index'])
+            npix = hp.nside2npix(c['nside'])
+            shape = (npix,)
+            if c.get('partial', False):
+                sel = pixel_index >= 0
+                maps['pixels'], inverse = np.unique(pixel_index[sel],
+                                                    return_inverse=True)
+                maps['nside'] = c['nside']
+                pixel_index = np.full(len(pixel_index), -1, dtype=np.int64)
+                pixel_index[sel] = inverse
+                npix = len(maps['pixels'])
+                shape = (npix,)
+        else:
+            raise NotImplementedError
+
+        realizations = ShearRealizations(pixel_index, catalog['g'], npix,
+                                         kind, sigma, seed, batch_size)
+        maps['nmap'] = realizations.nmap.reshape(shape)
+
+    solver = {} if warm_start else None
+
+    kappa_e = kappa_b = kappa = None
+    t0 = time.time()
+    for start in range(0, nrealizations, batch_size):
+        stop = min(start + batch_size, nrealizations)
+        with span('binning'):
+            maps['gmap'] = realizations(start, stop).reshape((stop - start, 2)
+                                                             + shape)
+        kappa = compute_convergence_map(maps, algorithm, solver)
+        if kappa_e is None:
+            kappa_e = np.empty((nrealizations,) + kappa['kappa_e'].shape[1:])
+            kappa_b = np.empty((nrealizations,) + kappa['kappa_b'].shape[1:])
+        kappa_e[start:stop] = kappa['kappa_e']
+        kappa_b[start:stop] = kappa['kappa_b']
+    elapsed = time.time() - t0
+
+    rate = nrealizations / elapsed if elapsed > 0 else float('inf')
+    logger.info("noise_realizations: %d %s realizations in %.3fs, "
+                "%.2f realizations/s", nrealizations, kind, elapsed, rate)
+
+    kappa['kappa_e'] = kappa_e
+    kappa['kappa_b'] = kappa_b
+    kappa['nmap'] = maps['nmap']
+    info = kappa.get('info')
+    if info is not None:
+        info.pop('FFTTIME', None)
+        info['NREAL'] = (nrealizations, 'Number of realizations')
+        info['REALTYPE'] = (kind, 'Type of realizations')
+        info['REALTIME'] = (elapsed, 'Time spent in the realizations [s]')
+        info['REALRATE'] = (rate, 'Throughput [realizations/s]')
+    return kappa
+
+def noise_realizations(config):
+    """
+    Computes convergence maps of many randomized realizations of a shape
+    catalog, reading and projecting the catalog only once. The E and B mode
+    maps are saved as stacks of shape (nrealizations,...) in the same format
+    as `convergence_map`.
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary read from yaml config file, with the
+            `projection` of the `shear_map` stage, the `algorithm` of the
+            `convergence_map` stage, the number of realizations
+            `nrealizations`, their `type` ('rotation' or 'noise'), the
+            shape noise `sigma` of 'noise' realizations, and optionally a
+            `seed`, a `batch_size` (default 16) and the `warm_start` of the
+            'masked_flat_ks' algorithm. If `profile` is set, the time, memory
+            and I/O of each phase are saved next to the output, see
+            `instrumentation.profile_stage`.
+    """
+    with profile_stage('noise_realizations', config.get('profile'),
+                       config['output_filename']):
+        with span('read'):
+            catalog = Table(read_catalog(config['input_filename'],
+                                         shear_map_columns), copy=False)
+
+        kappa = compute_noise_realizations(catalog, config['projection'],
+                                           config['algorithm'],
+                                           config['nrealizations'],
+                                           config.get('type', 'rotation'),
+                                           config.get('sigma'),
+                                           config.get('seed'),
+                                           config.get('batch_size') or 16,
+                                           config.get('warm_start', False))
+
+        with span('write'):
+            write_convergence_map(config['output_filename'],
+                                  hdf5=config.get('hdf5'), **kappa)
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args[0]) as f:
+        config = yaml.safe_load(f)
+
+    noise_realizations(config['noise_realizations'])
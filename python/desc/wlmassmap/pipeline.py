@@ -0,0 +1,159 @@
+# This module runs the stages of the pipeline in a single process, passing
+# catalogs and maps between stages in memory instead of through files
+from optparse import OptionParser
+import yaml
+
+from astropy.table import Table
+
+from .catalog_io import read_catalog
+from .shear_map import compute_shear_map, write_shear_map, shear_map_columns
+from .convergence_map import (compute_convergence_map, write_convergence_map,
+                              read_shear_map)
+from .mocks.mock_observation import mock_shape_catalog
+from .instrumentation import profile_stage, span
+
+# Stages of the pipeline, in order, with the name of their product
+stages = [('extract_footprint', 'truth_catalog'),
+          ('mock_observation', 'shape_catalog'),
+          ('shear_map', 'shear_map'),
+          ('convergence_map', 'convergence_map')]
+
+def run_pipeline(config, truth_catalog=None, shape_catalog=None,
+                 shear_map=None):
+    """
+    Runs the stages configured in `config` in memory, in the order
+    extract_footprint -> mock_observation -> shear_map -> convergence_map.
+
+    Each stage is configured by the section of the same name, as for the
+    file based stages, and uses the product of the previous stage directly.
+    Only the first stage reads its `input_filename`, unless its input is
+    provided as an argument, and a product is only written to disk if its
+    stage sets an `output_filename`. Catalogs are processed in memory, the
+    `chunk_size` options are ignored.
+
+    Parameters
+    ----------
+    config: dictionary
+        Configuration dictionary read from yaml config file, with a section
+        for each stage to run. Stages without a section are skipped. If
+        `profile` is set in the top level of the config, the phases of all
+        stages are profiled together, see `instrumentation.profile_stage`.
+        A top level `dtype` applies to all stages which do not set their
+        own, e.g. 'float32' to keep catalogs and maps in single precision.
+
+    truth_catalog: table, optional
+        Ground truth catalog, skipping extract_footprint
+
+    shape_catalog: table, optional
+        Shape catalog, skipping the previous stages
+
+    shear_map: dictionary, optional
+        Shear maps, as returned by `shear_map.compute_shear_map`, skipping
+        the previous stages
+
+    Returns
+    -------
+    products: dictionary
+        Products of the stages that were run, as in-memory catalogs and maps,
+        keyed by 'truth_catalog', 'shape_catalog', 'shear_map' and
+        'convergence_map'
+    """
+    products = {'truth_catalog': truth_catalog,
+                'shape_catalog': shape_catalog,
+                'shear_map': shear_map}
+    products = {k: v for k, v in products.items() if v is not None}
+
+    # The pipeline starts after the last provided product
+    start = 0
+    for i, (name, product) in enumerate(stages):
+        if product in products:
+            start = i + 1
+    run = [name for name, product in stages[start:] if name in config]
+
+    outputs = [config[name]['output_filename'] for name in run
+               if config[name].get('output_filename')]
+    with profile_stage('pipeline', config.get('profile'),
+                       outputs[-1] if outputs else 'pipeline'):
+        for name in run:
+            c = config[name]
+            if config.get('dtype') and not c.get('dtype'):
+                c = dict(c, dtype=config['dtype'])
+            with span(name):
+                products.update(_run_stage(name, c, products))
+
+    return products
+
+def _run_stage(name, c, products):
+    """
+    Runs a single stage in memory, writing its product if requested
+    """
+    output_filename = c.get('output_filename')
+
+    if name == 'extract_footprint':
+        # The GCR is only needed when extracting from a simulation
+        from .mocks.extract_footprint import extract_footprint_catalog
+        catalog = extract_footprint_catalog(c)
+        if output_filename:
+            with span('write'):
+                catalog.write(output_filename, path="WLMassMap_data")
+        return {'truth_catalog': catalog}
+
+    elif name == 'mock_observation':
+        cat_gt = products.get('truth_catalog')
+        if cat_gt is None:
+            fields = ['galaxy_id', 'ra', 'dec', 'shear_1', 'shear_2']
+            if c['reduced_shear']:
+                fields.append('convergence')
+            with span('read'):
+                cat_gt = read_catalog(c['input_filename'], fields)
+        catalog = mock_shape_catalog(cat_gt, c)
+        if output_filename:
+            with span('write'):
+                catalog.write(output_filename, overwrite=True)
+        return {'shape_catalog': catalog}
+
+    elif name == 'shear_map':
+        catalog = products.get('shape_catalog')
+        columns = list(shear_map_columns)
+        if c.get('tomography') is not None:
+            columns.append(c['tomography']['column'])
+        if catalog is None:
+            with span('read'):
+                catalog = read_catalog(c['input_filename'], columns)
+        # Only passes the required columns, leaving the input catalog as is
+        catalog = Table([catalog[name] for name in columns], names=columns,
+                        copy=False)
+        maps = compute_shear_map(catalog, c['projection'], c.get('tomography'),
+                                 c.get('dtype'))
+        if output_filename:
+            with span('write'):
+                write_shear_map(output_filename, hdf5=c.get('hdf5'), **maps)
+        return {'shear_map': maps}
+
+    elif name == 'convergence_map':
+        maps = products.get('shear_map')
+        if maps is None:
+            with span('read'):
+                maps = read_shear_map(c['input_filename'])
+        algorithm = dict(c['algorithm'])
+        if c.get('dtype'):
+            algorithm.setdefault('dtype', c['dtype'])
+        kappa = compute_convergence_map(maps, algorithm)
+        if output_filename:
+            with span('write'):
+                write_convergence_map(output_filename, nmap=maps.get('nmap'),
+                                      hdf5=c.get('hdf5'), **kappa)
+        return {'convergence_map': kappa}
+
+    else:
+        raise NotImplementedError
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    (options, args) = parser.parse_args()
+
+    with open(args[0]) as f:
+        config = yaml.safe_load(f)
+
+    run_pipeline(config)
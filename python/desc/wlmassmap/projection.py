@@ -1,8 +1,6 @@
 # This module handles the projection of a catalog on a specific grid
 import numpy as np
-from scipy.stats import binned_statistic_2d
 from .projection_utils import radec2xy, xy2radec, eq2ang
-import healpy as hp
 
 def project_healpix(catalog, nside, hp_type='RING'):
     """
@@ -24,15 +22,127 @@ def project_healpix(catalog, nside, hp_type='RING'):
     catalog: table
         Output shape catalog with pixel index column
     """
+    import healpy as hp
     theta, phi = eq2ang(catalog['ra'], catalog['dec'])
     catalog['pixel_index'] = hp.ang2pix(nside, theta, phi,
                                         nest=(hp_type=='NESTED'))
     return catalog
 
-def project_flat(catalog, nx, ny, pixel_size, center_ra, center_dec, projection='gnomonic'):
+def flat_grid(nx, ny, pixel_size, center_ra, center_dec, projection='gnomonic',
+              dtype=None):
+    """
+    Defines the pixel grid of a flat projected map
+
+    Parameters
+    ----------
+    nx, ny: int
+        Number of pixels along the x and y axes
+
+    pixel_size: float
+        Size of the pixels [arcmin]
+
+    center_ra, center_dec: float
+        Coordinates of projection origin [degrees]
+
+    projection: string
+        Type of 2D projection in ['gnomonic'] (default:'gnomonic')
+
+    dtype: dtype, optional
+        Floating point type of the coordinate grid, float64 by default. Edges
+        are always computed in float64, as they determine the pixel index.
+
+    Returns
+    -------
+    edges_x, edges_y: 1d arrays
+        Pixel edges in projected coordinates [degrees]
+
+    grid_ra, grid_dec: 2d arrays
+        Ra, Dec coordinates of pixel centers
+    """
+    # Convert pixel_size to deg for consistency
+    pixel_size = pixel_size / 60.
+
+    # Create coordinate grid for the map
+    edges_x = np.linspace(-nx/2*pixel_size, nx/2*pixel_size, nx + 1)
+    edges_y = np.linspace(-ny/2*pixel_size, ny/2*pixel_size, ny + 1)
+
+    # coordinate grid for center of pixels
+    grid_x, grid_y = np.meshgrid(0.5*(edges_x[1:] +edges_x[:-1]),
+                                 0.5*(edges_y[1:] +edges_y[:-1]))
+
+    if projection == 'gnomonic':
+        grid_ra, grid_dec = xy2radec(center_ra, center_dec,
+                                     grid_x.flatten(), grid_y.flatten())
+        grid_ra  = grid_ra.reshape(grid_x.shape)
+        grid_dec = grid_dec.reshape(grid_y.shape)
+    else:
+        raise NotImplementedError
+
+    if dtype is not None:
+        grid_ra = grid_ra.astype(dtype, copy=False)
+        grid_dec = grid_dec.astype(dtype, copy=False)
+
+    return edges_x, edges_y, grid_ra, grid_dec
+
+def flat_pixel_index(ra, dec, edges_x, edges_y, center_ra, center_dec,
+                     projection='gnomonic'):
+    """
+    Computes the flat map pixel index of a set of galaxies, following the
+    convention ind = y * nx + x. On a regular grid the index follows directly
+    from the projected coordinates, galaxies outside of the patch are flagged
+    with index -1.
+
+    Parameters
+    ----------
+    ra, dec: array_like
+        Coordinates of the galaxies [degrees]
+
+    edges_x, edges_y: 1d arrays
+        Pixel edges in projected coordinates, as returned by `flat_grid`
+
+    center_ra, center_dec: float
+        Coordinates of projection origin [degrees]
+
+    projection: string
+        Type of 2D projection in ['gnomonic'] (default:'gnomonic')
+
+    Returns
+    -------
+    pixel_index: int array
+        Pixel index of each galaxy, -1 outside of the patch
+    """
+    nx = len(edges_x) - 1
+    ny = len(edges_y) - 1
+
+    # Computes projected coordinates on 2D plane
+    if projection == 'gnomonic':
+        x,y = radec2xy(center_ra, center_dec, ra, dec)
+    else:
+        raise NotImplementedError
+
+    # Converts in place to fractional pixel coordinates
+    x -= edges_x[0]
+    x *= nx / (edges_x[-1] - edges_x[0])
+    y -= edges_y[0]
+    y *= ny / (edges_y[-1] - edges_y[0])
+
+    # Flags the galaxies that fall outside of the patch
+    outside = ~((x >= 0) & (x < nx) & (y >= 0) & (y < ny))
+
+    np.floor(y, out=y)
+    pixel_index = y.astype(np.int64)
+    pixel_index *= nx
+    pixel_index += np.floor(x, out=x).astype(np.int64)
+    pixel_index[outside] = -1
+
+    return pixel_index
+
+def project_flat(catalog, nx, ny, pixel_size, center_ra, center_dec, projection='gnomonic',
+                 dtype=None):
     """
     Adds a pixel index for a Gnomonic projected map. Pixels are indexed
-    starting from 0 according to ind = y * nx + x
+    starting from 0 according to ind = y * nx + x, galaxies outside of the
+    map have an index of -1
 
     Parameters
     ----------
@@ -58,10 +168,13 @@ def project_flat(catalog, nx, ny, pixel_size, center_ra, center_dec, projection=
     projection: string
         Type of 2D projection in ['Gnomonic'] (default:'Gnomonic')
 
+    dtype: dtype, optional
+        Floating point type of the coordinate grid, see `flat_grid`
+
     Returns
     -------
     catalog: table
-        Output shape catalog with pixel index column
+        Input shape catalog with added pixel index column
 
     grid_ra: 2d array
         Ra coordinates of pixels
@@ -69,40 +182,12 @@ def project_flat(catalog, nx, ny, pixel_size, center_ra, center_dec, projection=
     grid_dec: 2d array
         Dec coordinates of pixels
     """
-    # Convert pixel_size to deg for consistency
-    pixel_size = pixel_size / 60.
-
-    # Create coordinate grid for the map
-    edges_x = np.linspace(-nx/2*pixel_size, nx/2*pixel_size, nx + 1)
-    edges_y = np.linspace(-ny/2*pixel_size, ny/2*pixel_size, ny + 1)
-
-    # coordinate grid for center of pixels
-    grid_x, grid_y = np.meshgrid(0.5*(edges_x[1:] +edges_x[:-1]),
-                                 0.5*(edges_y[1:] +edges_y[:-1]))
-
-    # Computes projected coordinates on 2D plane
-    if projection == 'gnomonic':
-        x,y = radec2xy(center_ra, center_dec, catalog['ra'], catalog['dec'])
-        grid_ra, grid_dec = xy2radec(center_ra, center_dec,
-                                     grid_x.flatten(), grid_y.flatten())
-        grid_ra  = grid_ra.reshape(grid_x.shape)
-        grid_dec = grid_dec.reshape(grid_y.shape)
-    else:
-        raise NotImplementedError
+    edges_x, edges_y, grid_ra, grid_dec = flat_grid(nx, ny, pixel_size,
+                                                    center_ra, center_dec,
+                                                    projection, dtype)
 
-    # Restricts to the galaxies that fall within the patch
-    sel = ((x >= edges_x[0]) & (x < edges_x[-1]) &
-           (y >= edges_y[0]) & (y < edges_y[-1]))
-    catalog = catalog[sel]
-
-    # Use this function mostly for its 2d digitize equivalent
-    s, xe, ye ,binnumber = binned_statistic_2d(x[sel], y[sel],
-                                               np.ones_like(x[sel]),
-                                               statistic='count',
-                                               bins=(edges_x, edges_y),
-                                               expand_binnumbers=True)
-    binnumber -= 1
-    pixel_index =  (binnumber[1,:] * nx + binnumber[0, :])
-    catalog['pixel_index'] = pixel_index
+    catalog['pixel_index'] = flat_pixel_index(catalog['ra'], catalog['dec'],
+                                              edges_x, edges_y,
+                                              center_ra, center_dec, projection)
 
     return catalog, grid_ra, grid_dec
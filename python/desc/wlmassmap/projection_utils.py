@@ -53,20 +53,30 @@ def radec2xy(ra0, dec0, ra, dec, radians=False):
     # Convert the input coordinates to radians
     x0 = np.deg2rad(ra0)
     y0 = np.deg2rad(dec0)
-    alpha = np.deg2rad(ra)
+    dalpha = np.deg2rad(ra) - x0
     delta = np.deg2rad(dec)
 
+    # Trigonometric terms are evaluated once per galaxy, and reused in place
+    cos_d = np.cos(delta)
+    sin_d = np.sin(delta, out=delta)
+    cos_da = np.cos(dalpha)
+    x = np.sin(dalpha, out=dalpha)
+    x *= cos_d
+    cos_d *= cos_da
+
     # Compute projected values
-    denom = (np.cos(y0) * np.cos(delta) * np.cos(alpha - x0) +
-             np.sin(y0) * np.sin(delta))
-    x = np.cos(delta) * np.sin(alpha - x0) / denom
-    y = ((np.cos(y0) * np.sin(delta) -
-          np.sin(y0) * np.cos(delta) * np.cos(alpha - x0)) / denom)
+    denom = np.multiply(cos_d, np.cos(y0), out=cos_da)
+    denom += np.sin(y0) * sin_d
+    y = np.multiply(sin_d, np.cos(y0), out=sin_d)
+    cos_d *= np.sin(y0)
+    y -= cos_d
+    x /= denom
+    y /= denom
 
     if radians:
         return x, y
 
-    return np.rad2deg(x), np.rad2deg(y)
+    return np.rad2deg(x, out=x), np.rad2deg(y, out=y)
 
 
 def xy2radec(center_ra, center_dec, x, y):
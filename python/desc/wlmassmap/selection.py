@@ -1,30 +1,210 @@
 # This scripts applies a series of cuts to the input catalog
 from optparse import OptionParser
+import ast
 import os
+import types
 import yaml
 
 import numpy as np
 
-from astropy.table import Table
 from astropy.io import fits
+import h5py
+
+from .catalog_io import CatalogReader
+
+# Functions that can be used in cut expressions, as `abs(...)` or `np.abs(...)`
+cut_functions = {name: getattr(np, name) for name in
+                 ['abs', 'sqrt', 'log', 'log10', 'exp', 'isfinite', 'isnan',
+                  'minimum', 'maximum', 'hypot']}
+
+_allowed_nodes = (ast.Expression, ast.Compare, ast.BinOp, ast.UnaryOp,
+                  ast.Call, ast.Subscript, ast.Slice, ast.Tuple, ast.Name,
+                  ast.Attribute, ast.Constant, ast.Load,
+                  ast.cmpop, ast.operator, ast.unaryop)
+
+class CutExpression(object):
+    """
+    Series of cuts on the columns of a catalog, written as python expressions
+    such as `shape['mcal_s2n_r'] > 10`, compiled into a single vectorized
+    boolean expression.
+
+    The expressions are parsed once and only a restricted set of operations
+    is allowed: arithmetic, comparisons, bitwise operators, indexing of the
+    columns and the functions listed in `cut_functions`. The columns
+    referenced by the cuts are available in `columns`.
+
+    Parameters
+    ----------
+    cuts: list of string
+        Cuts to apply, all of which must be satisfied
+    """
+
+    def __init__(self, cuts):
+        self.cuts = list(cuts)
+        self.columns = []
+        trees = [self._parse(cut) for cut in self.cuts]
+
+        # Fuses all cuts in a single expression
+        if trees:
+            body = trees[0]
+            for tree in trees[1:]:
+                body = ast.BinOp(left=body, op=ast.BitAnd(), right=tree)
+            expression = ast.fix_missing_locations(ast.Expression(body=body))
+            self._code = compile(expression, '<cuts>', 'eval')
+        else:
+            self._code = None
+
+    def _parse(self, cut):
+        tree = ast.parse(cut.strip(), mode='eval')
+        for node in ast.walk(tree):
+            if not isinstance(node, _allowed_nodes):
+                raise ValueError("Unsupported operation %s in cut: %s"
+                                 % (type(node).__name__, cut))
+            if isinstance(node, ast.Name) and node.id not in ['shape', 'np'] \
+               and node.id not in cut_functions:
+                raise ValueError("Unknown name %s in cut: %s" % (node.id, cut))
+            if isinstance(node, ast.Attribute) and not (
+                    isinstance(node.value, ast.Name) and node.value.id == 'np'
+                    and node.attr in cut_functions):
+                raise ValueError("Unsupported attribute %s in cut: %s"
+                                 % (node.attr, cut))
+            if isinstance(node, ast.Call) and (node.keywords or not (
+                    isinstance(node.func, ast.Attribute) or
+                    (isinstance(node.func, ast.Name) and
+                     node.func.id in cut_functions))):
+                raise ValueError("Unsupported function call in cut: %s" % cut)
+            # Collects the referenced columns
+            if isinstance(node, ast.Subscript) and \
+               isinstance(node.value, ast.Name) and node.value.id == 'shape':
+                if not (isinstance(node.slice, ast.Constant) and
+                        isinstance(node.slice.value, str)):
+                    raise ValueError("Columns must be referenced by name in cut: %s"
+                                     % cut)
+                if node.slice.value not in self.columns:
+                    self.columns.append(node.slice.value)
+        return tree.body
+
+    def __call__(self, shape):
+        """
+        Evaluates the cuts on a catalog, or chunk of a catalog, given as a
+        table or a dictionary of columns
+
+        Returns
+        -------
+        mask: boolean array
+            Whether each row satisfies all cuts
+        """
+        if self._code is None:
+            return None
+        namespace = dict(cut_functions)
+        namespace['shape'] = shape
+        namespace['np'] = types.SimpleNamespace(**cut_functions)
+        return np.asarray(eval(self._code, {'__builtins__': {}}, namespace),
+                          dtype='bool')
+
+def selection_mask(filename, cuts, chunk_size=1000000):
+    """
+    Evaluates the cuts on a catalog by chunks, only reading the columns
+    referenced by the cuts
+
+    Parameters
+    ----------
+    filename: string
+        Input FITS or HDF5 catalog
+
+    cuts: list of string or CutExpression
+        Cuts to apply
+
+    chunk_size: int
+        Number of rows read at once
+
+    Returns
+    -------
+    mask: boolean array
+        Whether each row satisfies all cuts
+    """
+    if not isinstance(cuts, CutExpression):
+        cuts = CutExpression(cuts)
+
+    with CatalogReader(filename) as reader:
+        mask = np.ones(len(reader), dtype='bool')
+        # Cuts without columns, such as `False`, are evaluated once
+        if not cuts.columns:
+            if cuts.cuts:
+                mask[:] = cuts({})
+            return mask
+
+        for start in range(0, len(reader), chunk_size):
+            chunk = reader.read(cuts.columns, start, start + chunk_size)
+            mask[start:start + chunk_size] = cuts(chunk)
+    return mask
+
+def _write_selected_fits(input_filename, output_filename, mask, chunk_size):
+    """
+    Streams the selected rows of a FITS table to a new file, copying the
+    raw records without decoding the columns
+    """
+    with CatalogReader(input_filename) as reader:
+        if reader.header.get('PCOUNT', 0) != 0:
+            raise NotImplementedError("Tables with variable length arrays are not supported")
+
+        header = reader.header.copy()
+        header['NAXIS2'] = int(mask.sum())
+        for key in ['CHECKSUM', 'DATASUM']:
+            header.remove(key, ignore_missing=True)
+
+        stream = fits.StreamingHDU(output_filename, header)
+        for start in range(0, len(reader), chunk_size):
+            rows = reader.records(start, start + chunk_size)
+            rows = rows[mask[start:start + chunk_size]]
+            if len(rows):
+                stream.write(np.ascontiguousarray(rows).view(np.uint8))
+        stream.close()
+
+def _write_selected_hdf5(input_filename, output_filename, mask, chunk_size):
+    """
+    Streams the selected rows of the `WLMassMap_data` table of an HDF5 file
+    to a new chunked HDF5 file
+    """
+    with CatalogReader(input_filename) as reader, \
+         h5py.File(output_filename, 'w') as fout:
+        nsel = int(mask.sum())
+        out = fout.create_dataset('WLMassMap_data', shape=(nsel,),
+                                  dtype=reader.dtype,
+                                  chunks=(max(1, min(chunk_size, nsel)),))
+        offset = 0
+        for start in range(0, len(reader), chunk_size):
+            rows = reader.records(start, start + chunk_size)
+            rows = rows[mask[start:start + chunk_size]]
+            out[offset:offset + len(rows)] = rows
+            offset += len(rows)
 
 def selection(config):
     """
     Applies a series of cuts to the input catalog
+
+    The cuts are evaluated by chunks of `chunk_size` rows (default 1000000),
+    reading only the columns they reference, and the selected rows are
+    streamed to the output file, so that memory usage does not depend on the
+    size of the catalog. FITS and HDF5 catalogs are supported, the output
+    has the same format as the input.
     """
 
     filename = config['input_filename']
-    shape = Table.read(filename)
-    mask = np.ones(len(shape)).astype('bool')
+    chunk_size = config.get('chunk_size') or 1000000
 
-    for cut in config['cuts']:
-        mask &= eval(cut)
-
-    shape = shape[mask]
+    cuts = CutExpression(config.get('cuts') or [])
+    mask = selection_mask(filename, cuts, chunk_size)
 
     # Exports the catalog in
-    filename = config['output_filename']
-    shape.write(filename, overwrite=True)
+    output_filename = config['output_filename']
+    if os.path.exists(output_filename):
+        os.remove(output_filename)
+
+    if h5py.is_hdf5(filename):
+        _write_selected_hdf5(filename, output_filename, mask, chunk_size)
+    else:
+        _write_selected_fits(filename, output_filename, mask, chunk_size)
 
 if __name__ == "__main__":
 
@@ -32,6 +212,6 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     with open(args[0]) as f:
-        config = yaml.load(f.read())
+        config = yaml.safe_load(f)
 
     selection(config['selection'])
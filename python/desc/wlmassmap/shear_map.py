@@ -5,31 +5,358 @@ from optparse import OptionParser
 import os
 import yaml
 from numpy.linalg import pinv
-from .projection import project_flat, project_healpix
+from .projection import project_flat, project_healpix, flat_grid, flat_pixel_index
+from .map_io import write_partial_map, is_hdf5_filename, write_hdf5_map
+from .catalog_io import catalog_length, iter_catalog_chunks, read_catalog
+from .instrumentation import profile_stage, span
 from astropy.table import Table
 from astropy.io import fits
-import healpy as hp
 
-def add_metacal_shear(catalog, delta_gamma=0.01):
+# Columns needed to compute the metacal responsivity
+responsivity_columns = ['mcal_g_1p', 'mcal_g_1m', 'mcal_g_2p', 'mcal_g_2m']
+
+# Columns needed to build a shear map
+shear_map_columns = ['ra', 'dec', 'mcal_g'] + responsivity_columns
+
+def tomographic_bins(catalog, tomography):
     """
-    Computes the responsivity for metacalibration measurements
-    TODO: Add selection effects
+    Assigns galaxies to tomographic bins
+
+    Parameters
+    ----------
+    catalog: table or dict
+        Shape catalog
+
+    tomography: dictionary
+        Tomography configuration, with the name of a `column` and either
+        the bin `edges` on the values of that column (e.g. a redshift), or
+        the number of bins `nbins` if the column already holds a bin index
+
+    Returns
+    -------
+    bins: int array
+        Bin index of each galaxy, -1 for galaxies outside of all bins
+
+    nbins: int
+        Number of tomographic bins
+    """
+    values = np.asarray(catalog[tomography['column']])
+    nbins = tomographic_nbins(tomography)
+    if tomography.get('edges') is not None:
+        bins = np.digitize(values, np.asarray(tomography['edges'])) - 1
+    else:
+        bins = values.astype(np.int64)
+    bins[(bins < 0) | (bins >= nbins)] = -1
+    return bins, nbins
+
+def tomographic_nbins(tomography):
+    """
+    Number of tomographic bins of a tomography configuration, see
+    `tomographic_bins`
+    """
+    if tomography.get('edges') is not None:
+        nbins = len(tomography['edges']) - 1
+    else:
+        nbins = tomography['nbins']
+    if nbins < 1:
+        raise ValueError("Tomography requires at least one bin")
+    return nbins
+
+def metacal_responsivity_sums(catalog, delta_gamma=0.01, bins=None, nbins=None):
+    """
+    Computes the partial sums entering the mean metacal responsivity, so that
+    it can be accumulated over several chunks of a catalog
+
+    Parameters
+    ----------
+    catalog: table or dict
+        Shape catalog (or chunk of) with metacal columns
+
+    delta_gamma: float
+        Shear step used in finite differencing
+
+    bins: int array, optional
+        Tomographic bin of each galaxy, see `tomographic_bins`
+
+    nbins: int, optional
+        Number of tomographic bins
+
+    Returns
+    -------
+    R_sum: (2,2) or (nbins,2,2) ndarray
+        Sum of the responsivity matrices
+
+    n: int or (nbins,) ndarray
+        Number of galaxies entering the sum
     """
     R1 = (catalog['mcal_g_1p'] - catalog['mcal_g_1m']) / (2 * delta_gamma)
     R2 = (catalog['mcal_g_2p'] - catalog['mcal_g_2m']) / (2 * delta_gamma)
-    R = np.stack([R1, R2],axis=1)
 
-    # Averages the responsivity matrix over entire sample
-    R = np.mean(R, axis=0)
+    if bins is None:
+        R_sum = np.stack([R1.sum(axis=0, dtype=np.float64),
+                          R2.sum(axis=0, dtype=np.float64)], axis=0)
+        return R_sum, len(R1)
+
+    sel = bins >= 0
+    b = bins[sel]
+    R_sum = np.zeros((nbins, 2, 2))
+    for i, Ri in enumerate([R1, R2]):
+        for j in range(2):
+            R_sum[:, i, j] = np.bincount(b, weights=Ri[sel, j], minlength=nbins)
+    return R_sum, np.bincount(b, minlength=nbins)
+
+def metacal_responsivity(R_sum, n):
+    """
+    Mean responsivity from accumulated sums, see `metacal_responsivity_sums`.
+    Empty tomographic bins get a null responsivity.
+    """
+    n = np.maximum(n, 1)
+    if np.ndim(n) == 0:
+        return R_sum / n
+    return R_sum / n[:, np.newaxis, np.newaxis]
+
+def add_metacal_shear(catalog, delta_gamma=0.01, R=None, bins=None, dtype=None):
+    """
+    Computes the responsivity for metacalibration measurements
+    TODO: Add selection effects
+
+    Parameters
+    ----------
+    catalog: table or dict
+        Shape catalog with metacal columns
+
+    delta_gamma: float
+        Shear step used in finite differencing
+
+    R: (2,2) or (nbins,2,2) array, optional
+        Mean responsivity, computed from the catalog if not provided
+
+    bins: int array, optional
+        Tomographic bin of each galaxy, in which case R must hold the
+        responsivity of each bin
+
+    dtype: dtype, optional
+        Floating point type of the calibrated shear, float64 by default. The
+        responsivity is always averaged in float64.
+    """
+    if R is None:
+        R1 = (catalog['mcal_g_1p'] - catalog['mcal_g_1m']) / (2 * delta_gamma)
+        R2 = (catalog['mcal_g_2p'] - catalog['mcal_g_2m']) / (2 * delta_gamma)
+        R = np.stack([R1, R2],axis=1)
+
+        # Averages the responsivity matrix over entire sample
+        R = np.mean(R, axis=0, dtype=np.float64)
 
     # Inverts the responsivity matrix
     Rinv = pinv(R)
 
     # Computes the estimated shear
-    catalog['g'] = np.dot(Rinv, np.array(catalog['mcal_g']).T).T
+    if bins is None:
+        g = np.dot(Rinv, np.array(catalog['mcal_g']).T).T
+        catalog['g'] = g if dtype is None else g.astype(dtype, copy=False)
+    else:
+        # Galaxies outside of all bins get an arbitrary calibration, they
+        # are discarded when binning
+        mcal_g = np.asarray(catalog['mcal_g'])
+        g = np.empty(mcal_g.shape, dtype=dtype or np.float64)
+        for i in range(2):
+            g[:, i] = (Rinv[bins, i, 0] * mcal_g[:, 0] +
+                       Rinv[bins, i, 1] * mcal_g[:, 1])
+        catalog['g'] = g
     return catalog
 
-def bin_shear_map(catalog, nx=None, ny=None, npix=None):
+def accumulate_shear_map(pixel_index, g, npix, out=None):
+    """
+    Accumulates the sums of shear and number of galaxies per pixel, without
+    normalizing them. This allows a map to be built from several chunks.
+
+    Parameters
+    ----------
+    pixel_index: int array
+        Pixel index of each galaxy, galaxies with index -1 are ignored
+
+    g: (N,2) array
+        Calibrated shear of each galaxy
+
+    npix: int
+        Total number of pixels of the map
+
+    out: tuple of arrays, optional
+        (g1sum, g2sum, nmap) accumulators to update in place
+
+    Returns
+    -------
+    g1sum, g2sum: ndarray
+        Sum of the shear components in each pixel
+
+    nmap: ndarray
+        Number of galaxies per pixels
+    """
+    # Shifting the index by one collects flagged galaxies in a first bin
+    # which is dropped, instead of copying the selected rows
+    index = np.asarray(pixel_index) + 1
+    g1sum = np.bincount(index, weights=g[:,0], minlength=npix + 1)[1:]
+    g2sum = np.bincount(index, weights=g[:,1], minlength=npix + 1)[1:]
+    nmap = np.bincount(index, minlength=npix + 1)[1:]
+
+    if out is None:
+        return g1sum, g2sum, nmap
+
+    for acc, s in zip(out, (g1sum, g2sum, nmap)):
+        acc += s
+    return out
+
+def normalize_shear_map(g1map, g2map, Nmap, nx=None, ny=None, nbins=None,
+                        dtype=None):
+    """
+    Turns accumulated shear sums into a mean shear map, see
+    `accumulate_shear_map`. Arrays are normalized in place, the shear map is
+    then converted to `dtype` if set.
+
+    Returns
+    -------
+    gmap: ndarray
+        Shear map, of shape (nbins,2,...) for tomographic maps
+
+    nmap: ndarray
+        Number of galaxies per pixels
+    """
+    # Rebining as a 2D map if requested, pixels are indexed as y * nx + x
+    shape = (-1,) if nx is None else (ny, nx)
+    if nbins is not None:
+        shape = (nbins,) + shape
+    if nx is not None or nbins is not None:
+        g1map = g1map.reshape(shape)
+        g2map = g2map.reshape(shape)
+        Nmap = Nmap.reshape(shape)
+
+    # Normalize by number of galaxies
+    nz_ind = Nmap > 0
+    g1map[nz_ind] /= Nmap[nz_ind]
+    g2map[nz_ind] /= Nmap[nz_ind]
+
+    gmap = np.stack([g1map,g2map], axis=0 if nbins is None else 1)
+    if dtype is not None:
+        gmap = gmap.astype(dtype, copy=False)
+
+    return gmap, Nmap
+
+def accumulate_sparse_shear_map(pixel_index, g, acc=None):
+    """
+    Sparse equivalent of `accumulate_shear_map`, only storing the pixels
+    that contain galaxies, so that memory does not scale with the full sky
+
+    Parameters
+    ----------
+    pixel_index: int array
+        Pixel index of each galaxy, galaxies with index -1 are ignored
+
+    g: (N,2) array
+        Calibrated shear of each galaxy
+
+    acc: tuple of arrays, optional
+        (pixels, g1sum, g2sum, nmap) accumulated so far, merged with the new
+        galaxies
+
+    Returns
+    -------
+    pixels: int array
+        Sorted indices of the observed pixels
+
+    g1sum, g2sum: ndarray
+        Sum of the shear components in each observed pixel
+
+    nmap: ndarray
+        Number of galaxies per observed pixel
+    """
+    pixel_index = np.asarray(pixel_index)
+    sel = pixel_index >= 0
+    g = np.asarray(g)[sel]
+    pixels, inverse = np.unique(pixel_index[sel], return_inverse=True)
+    sums = (pixels,
+            np.bincount(inverse, weights=g[:,0], minlength=len(pixels)),
+            np.bincount(inverse, weights=g[:,1], minlength=len(pixels)),
+            np.bincount(inverse, minlength=len(pixels)))
+
+    if acc is None:
+        return sums
+    return merge_sparse_shear_maps(acc, sums)
+
+def merge_sparse_shear_maps(a, b):
+    """
+    Merges two sets of sparse accumulators, see `accumulate_sparse_shear_map`.
+    The cost is linear in the number of pixels of `a`, so that a small chunk
+    can be merged efficiently into a large map.
+    """
+    pixels = a[0]
+    pos = np.searchsorted(pixels, b[0])
+    found = pos < len(pixels)
+    found[found] = pixels[pos[found]] == b[0][found]
+
+    # Adds to the pixels already observed, inserts the new ones
+    merged = [pixels]
+    for x, y in zip(a[1:], b[1:]):
+        x = x.copy()
+        x[pos[found]] += y[found]
+        merged.append(x)
+    return tuple(np.insert(x, pos[~found], y[~found])
+                 for x, y in zip(merged, b))
+
+def normalize_sparse_shear_map(keys, g1map, g2map, Nmap, npix, nbins=None,
+                               dtype=None):
+    """
+    Turns sparse accumulated sums into mean shear on the observed pixels, of
+    type `dtype` if set.
+    For tomographic maps, keys combine bin and pixel index, see
+    `tomographic_index`, and the maps of all bins are defined on the union of
+    the observed pixels.
+
+    Returns
+    -------
+    pixels: int array
+        Indices of the observed pixels
+
+    gmap: ndarray
+        Shear map, of shape (2,npix_obs) or (nbins,2,npix_obs)
+
+    nmap: ndarray
+        Number of galaxies per observed pixel
+    """
+    g1map = g1map / Nmap
+    g2map = g2map / Nmap
+    dtype = dtype or g1map.dtype
+
+    if nbins is None:
+        return keys, np.stack([g1map, g2map], axis=0).astype(dtype, copy=False), Nmap
+
+    pixels, inverse = np.unique(keys % npix, return_inverse=True)
+    bins = keys // npix
+    gmap = np.zeros((nbins, 2, len(pixels)), dtype=dtype)
+    nmap = np.zeros((nbins, len(pixels)), dtype=Nmap.dtype)
+    gmap[bins, 0, inverse] = g1map
+    gmap[bins, 1, inverse] = g2map
+    nmap[bins, inverse] = Nmap
+    return pixels, gmap, nmap
+
+def tomographic_index(pixel_index, bins, npix):
+    """
+    Combines tomographic bins and pixel indices into a single index
+    bin * npix + pixel_index, so that all bins are binned in a single pass.
+    Galaxies outside of all bins or outside of the map are discarded.
+
+    Returns
+    -------
+    index: int array
+        Combined index of the selected galaxies
+
+    sel: boolean array
+        Galaxies belonging to a tomographic bin
+    """
+    sel = (bins >= 0) & (pixel_index >= 0)
+    return bins[sel] * npix + pixel_index[sel], sel
+
+def bin_shear_map(catalog, nx=None, ny=None, npix=None, bins=None, nbins=None,
+                  dtype=None):
     """
     Computes the shear map by binning the catalog according to pixel_index.
     Either nx,ny or npix must be provided.
@@ -45,10 +372,20 @@ def bin_shear_map(catalog, nx=None, ny=None, npix=None):
     npix: int, optional
         Number of pixels of a spherical map (or other 1D pixelating scheme)
 
+    bins: int array, optional
+        Tomographic bin of each galaxy, see `tomographic_bins`
+
+    nbins: int, optional
+        Number of tomographic bins
+
+    dtype: dtype, optional
+        Floating point type of the shear map, the shear is always accumulated
+        in float64
+
     Returns
     -------
     gmap: ndarray
-        Shear map
+        Shear map, of shape (nbins,2,...) for tomographic maps
 
     nmap: ndarray
         Number of galaxies per pixels
@@ -59,84 +396,470 @@ def bin_shear_map(catalog, nx=None, ny=None, npix=None):
     if npix is None:
         npix = nx*ny
 
-    g1map = np.bincount(catalog['pixel_index'],
-                        weights=catalog['g'][:,0],
-                        minlength=npix)
-    g2map = np.bincount(catalog['pixel_index'],
-                        weights=catalog['g'][:,1],
-                        minlength=npix)
-    Nmap  = np.bincount(catalog['pixel_index'], minlength=npix)
+    index = catalog['pixel_index']
+    g = catalog['g']
+    if bins is not None:
+        index, sel = tomographic_index(np.asarray(index), np.asarray(bins), npix)
+        g = np.asarray(g)[sel]
+        npix = nbins * npix
 
-    # Rebining as a 2D map if requested
-    if nx is not None:
-        g1map = g1map.reshape((nx, ny))
-        g2map = g2map.reshape((nx, ny))
-        Nmap = Nmap.reshape((nx, ny))
+    g1map, g2map, Nmap = accumulate_shear_map(index, g, npix)
 
-    # Normalize by number of galaxies
-    nz_ind = Nmap > 0
-    g1map[nz_ind] /= Nmap[nz_ind]
-    g2map[nz_ind] /= Nmap[nz_ind]
+    return normalize_shear_map(g1map, g2map, Nmap, nx, ny, nbins, dtype)
+
+def bin_sparse_shear_map(catalog, npix, bins=None, nbins=None, dtype=None):
+    """
+    Computes a partial sky shear map by binning the catalog according to
+    pixel_index, only storing the observed pixels
 
-    gmap = np.stack([g1map,g2map], axis=0)
+    Parameters
+    ----------
+    catalog: table
+        Input shape catalog with pixel_index column
 
-    return gmap, Nmap
+    npix: int
+        Total number of pixels of the spherical map
 
-def shear_map(config):
+    bins: int array, optional
+        Tomographic bin of each galaxy, see `tomographic_bins`
+
+    nbins: int, optional
+        Number of tomographic bins
+
+    dtype: dtype, optional
+        Floating point type of the shear map, the shear is always accumulated
+        in float64
+
+    Returns
+    -------
+    pixels: int array
+        Indices of the observed pixels
+
+    gmap: ndarray
+        Shear map on the observed pixels, of shape (nbins,2,npix_obs) for
+        tomographic maps
+
+    nmap: ndarray
+        Number of galaxies per observed pixel
     """
-    Builds a shear map from a given shape catalog
+    index = np.asarray(catalog['pixel_index'])
+    g = catalog['g']
+    if bins is not None:
+        index, sel = tomographic_index(index, np.asarray(bins), npix)
+        g = np.asarray(g)[sel]
+
+    sums = accumulate_sparse_shear_map(index, g)
+    return normalize_sparse_shear_map(*sums, npix=npix, nbins=nbins,
+                                      dtype=dtype)
+
+def stream_responsivity(filename, chunk_size=1000000, delta_gamma=0.01,
+                        comm=None, tomography=None, start=0, stop=None):
+    """
+    Mean metacal responsivity of a shape catalog read by chunks, reading
+    only the `responsivity_columns` and the tomography column
 
     Parameters
     ----------
-        config: dictionary
-            Configuration dictionary read from yaml config file
+    filename: string
+        Input FITS or HDF5 shape catalog
+
+    chunk_size: int
+        Number of rows read at once
+
+    delta_gamma: float
+        Shear step used in finite differencing
+
+    comm: MPI communicator, optional
+        Communicator over which the sums are reduced, each process reading
+        the rows [start, stop)
+
+    tomography: dictionary, optional
+        Tomography configuration, see `tomographic_bins`
+
+    start, stop: int, optional
+        Range of rows read by this process, defaults to the entire catalog
+
+    Returns
+    -------
+    R: (2,2) or (nbins,2,2) ndarray
+        Mean responsivity, per tomographic bin if requested, null if no
+        galaxy was read
     """
-    filename = config['input_filename']
-    catalog = Table.read(filename)
+    columns = list(responsivity_columns)
+    bins = nbins = None
+    R_sum = np.zeros((2, 2))
+    n = 0
+    if tomography is not None:
+        columns.append(tomography['column'])
+        nbins = tomographic_nbins(tomography)
+        R_sum = np.zeros((nbins, 2, 2))
+        n = np.zeros(nbins, dtype=np.int64)
+
+    for chunk in iter_catalog_chunks(filename, columns, chunk_size, start, stop):
+        with span('responsivity'):
+            if tomography is not None:
+                bins, nbins = tomographic_bins(chunk, tomography)
+            s, k = metacal_responsivity_sums(chunk, delta_gamma, bins, nbins)
+            R_sum = R_sum + s
+            n = n + k
+    if comm is not None:
+        with span('reduce'):
+            R_sum = comm.allreduce(R_sum)
+            n = comm.allreduce(n)
+    return metacal_responsivity(R_sum, n)
+
+def stream_shear_map(filename, projection, chunk_size, delta_gamma=0.01,
+                     comm=None, tomography=None, dtype=None):
+    """
+    Builds a shear map from a shape catalog read by chunks, so that peak
+    memory depends on the chunk and map sizes rather than on the number of
+    galaxies. The responsivity is accumulated in a first pass, the calibrated
+    shear is binned in a second pass.
 
-    # Computes calibrated shear
-    catalog = add_metacal_shear(catalog)
+    When an MPI communicator is provided, each process reads a disjoint range
+    of rows. Responsivity sums are reduced over all processes, and partial
+    shear sums and counts are reduced on rank 0 before normalization.
 
-    # Extracts projection configuration
-    c = config['projection']
-    projection2d = False
+    Parameters
+    ----------
+    filename: string
+        Input FITS shape catalog
 
-    # Applies projection to catalog
-    if c['type'] in ['gnomonic']: # Any 2D flat projection
-        projection2d =True
+    projection: dictionary
+        Projection configuration, as in the `shear_map` config
 
-        catalog, grid_ra, grid_dec = project_flat(catalog, c['nx'], c['ny'],
-                    c['pixel_size'], c['center_ra'], c['center_dec'], c['type'])
+    chunk_size: int
+        Number of rows read at once
 
-        # Bins the projected catalog
-        gmap, nmap = bin_shear_map(catalog, nx=c['nx'], ny=c['ny'])
+    delta_gamma: float
+        Shear step used in finite differencing
 
-    elif c['type'] == 'healpix': # Any spherical projection
-        catalog = project_healpix(catalog, nside=c['nside'])
+    comm: MPI communicator, optional
+        Communicator to distribute the catalog over
+
+    tomography: dictionary, optional
+        Tomography configuration, see `tomographic_bins`
+
+    dtype: dtype, optional
+        Floating point type of the calibrated shear and of the maps, sums are
+        always accumulated in float64
+
+    Returns
+    -------
+    maps: dictionary
+        Maps to save, as keyword arguments of `write_shear_map`, None on ranks
+        other than 0
+    """
+    c = projection
+
+    # Range of rows processed by this process
+    start, stop = 0, None
+    if comm is not None:
+        ntot = catalog_length(filename)
+        start = ntot * comm.rank // comm.size
+        stop = ntot * (comm.rank + 1) // comm.size
+        chunk_size = chunk_size or max(1, stop - start)
+
+    bins = nbins = None
+    extra_columns = []
+
+    # First pass, mean responsivity from running sums
+    R = stream_responsivity(filename, chunk_size, delta_gamma, comm,
+                            tomography, start, stop)
+    if tomography is not None:
+        extra_columns = [tomography['column']]
+        nbins = len(R)
+
+    nx = ny = grid_ra = grid_dec = None
+    sparse = c['type'] == 'healpix' and c.get('partial', False)
+    if c['type'] in ['gnomonic']:
+        nx, ny = c['nx'], c['ny']
+        npix = nx*ny
+        edges_x, edges_y, grid_ra, grid_dec = flat_grid(nx, ny,
+                    c['pixel_size'], c['center_ra'], c['center_dec'], c['type'],
+                    dtype)
+    elif c['type'] == 'healpix':
+        import healpy as hp
+        npix = hp.nside2npix(c['nside'])
+    else:
+        raise NotImplementedError
+
+    # Second pass, projects and accumulates the calibrated shear
+    ntot = npix if nbins is None else nbins * npix
+    if sparse:
+        sums = None
+    else:
+        sums = (np.zeros(ntot), np.zeros(ntot), np.zeros(ntot, dtype=np.int64))
+    for chunk in iter_catalog_chunks(filename, ['ra', 'dec', 'mcal_g'] + extra_columns,
+                                     chunk_size, start, stop):
+        with span('metacal'):
+            if tomography is not None:
+                bins, nbins = tomographic_bins(chunk, tomography)
+            chunk = add_metacal_shear(chunk, delta_gamma, R=R, bins=bins,
+                                      dtype=dtype)
+
+        with span('projection'):
+            if nx is not None:
+                pixel_index = flat_pixel_index(chunk['ra'], chunk['dec'],
+                                               edges_x, edges_y,
+                                               c['center_ra'], c['center_dec'],
+                                               c['type'])
+            else:
+                pixel_index = project_healpix(chunk, nside=c['nside'])['pixel_index']
+        g = chunk['g']
+
+        with span('binning'):
+            if bins is not None:
+                pixel_index, sel = tomographic_index(pixel_index, bins, npix)
+                g = g[sel]
+
+            if sparse:
+                sums = accumulate_sparse_shear_map(pixel_index, g, acc=sums)
+            else:
+                accumulate_shear_map(pixel_index, g, ntot, out=sums)
+
+    if comm is not None and sparse:
+        # Sparse maps have different pixels on each process, they are
+        # gathered and merged on rank 0
+        with span('reduce'):
+            parts = comm.gather(sums, root=0)
+        if comm.rank != 0:
+            return None
+        sums = None
+        for part in parts:
+            if part is not None:
+                sums = part if sums is None else merge_sparse_shear_maps(sums, part)
+    elif comm is not None:
+        from mpi4py import MPI
+        with span('reduce'):
+            for acc in sums:
+                if comm.rank == 0:
+                    comm.Reduce(MPI.IN_PLACE, acc, op=MPI.SUM, root=0)
+                else:
+                    comm.Reduce(acc, None, op=MPI.SUM, root=0)
+        if comm.rank != 0:
+            return None
+
+    maps = {'grid_ra': grid_ra, 'grid_dec': grid_dec,
+            'pixel_size': c.get('pixel_size')}
+    if tomography is not None:
+        maps['responsivity'] = R
+
+    if sparse:
+        if sums is None:
+            sums = accumulate_sparse_shear_map(np.zeros(0, dtype=np.int64),
+                                               np.zeros((0, 2)))
+        maps['pixels'], maps['gmap'], maps['nmap'] = \
+            normalize_sparse_shear_map(*sums, npix=npix, nbins=nbins,
+                                       dtype=dtype)
+        maps['nside'] = c['nside']
+    else:
+        maps['gmap'], maps['nmap'] = normalize_shear_map(*sums, nx=nx, ny=ny,
+                                                         nbins=nbins,
+                                                         dtype=dtype)
+    return maps
+
+def compute_shear_map(catalog, projection, tomography=None, dtype=None, R=None):
+    """
+    Builds a shear map from a shape catalog loaded in memory
+
+    Parameters
+    ----------
+    catalog: table
+        Shape catalog, with at least the `shear_map_columns`
+
+    projection: dictionary
+        Projection configuration, as in the `shear_map` config
+
+    tomography: dictionary, optional
+        Tomography configuration, see `tomographic_bins`
+
+    dtype: dtype, optional
+        Floating point type of the calibrated shear and of the maps, sums are
+        always accumulated in float64
+
+    R: (2,2) or (nbins,2,2) array, optional
+        Mean responsivity, per tomographic bin if requested, computed from
+        the catalog if not provided, see `stream_responsivity`
 
-        # Bins the projected catalog
-        gmap, nmap = bin_shear_map(catalog, npix=hp.nside2npix(c['nside']))
+    Returns
+    -------
+    maps: dictionary
+        Maps, as keyword arguments of `write_shear_map`
+    """
+    c = projection
+
+    # Computes calibrated shear, per tomographic bin if requested
+    nbins = bins = None
+    with span('metacal'):
+        if tomography is not None:
+            bins, nbins = tomographic_bins(catalog, tomography)
+            if R is None:
+                R = metacal_responsivity(*metacal_responsivity_sums(catalog,
+                                                bins=bins, nbins=nbins))
+        catalog = add_metacal_shear(catalog, R=R, bins=bins, dtype=dtype)
+
+    maps = {'responsivity': R if tomography is not None else None}
+
+    # Applies projection to catalog and bins the projected catalog
+    if c['type'] in ['gnomonic']: # Any 2D flat projection
+        with span('projection'):
+            catalog, maps['grid_ra'], maps['grid_dec'] = project_flat(catalog,
+                    c['nx'], c['ny'], c['pixel_size'], c['center_ra'],
+                    c['center_dec'], c['type'], dtype)
+        with span('binning'):
+            maps['gmap'], maps['nmap'] = bin_shear_map(catalog, nx=c['nx'],
+                                                       ny=c['ny'], bins=bins,
+                                                       nbins=nbins, dtype=dtype)
+        maps['pixel_size'] = c['pixel_size']
+
+    elif c['type'] == 'healpix': # Any spherical projection
+        import healpy as hp
+        with span('projection'):
+            catalog = project_healpix(catalog, nside=c['nside'])
+        with span('binning'):
+            if c.get('partial', False):
+                # Bins the projected catalog on the observed pixels only
+                maps['pixels'], maps['gmap'], maps['nmap'] = \
+                    bin_sparse_shear_map(catalog, npix=hp.nside2npix(c['nside']),
+                                         bins=bins, nbins=nbins, dtype=dtype)
+                maps['nside'] = c['nside']
+            else:
+                maps['gmap'], maps['nmap'] = bin_shear_map(catalog,
+                                                npix=hp.nside2npix(c['nside']),
+                                                bins=bins, nbins=nbins,
+                                                dtype=dtype)
     else:
         raise NotImplementedError
 
-    # Saves the resulting map
-    # In the case of a spherical map, only saves the shear map nmap
-    # For projected map also saves the ra,dec of each pixels
+    return maps
+
+def write_shear_map(filename, gmap, nmap, grid_ra=None, grid_dec=None,
+                    pixel_size=None, responsivity=None, pixels=None, nside=None,
+                    hdf5=None):
+    """
+    Saves a shear map to a FITS file.
+    In the case of a spherical map, only saves the shear map and nmap
+    For projected map also saves the ra,dec of each pixels, and the pixel
+    size [arcmin] in the PIXSIZE header keyword
+    For tomographic maps, the responsivity of each bin is appended in a
+    RESPONSIVITY extension
+    For partial sky maps, the observed `pixels` are saved in a HEALpix
+    partial sky table, with G1, G2 and N columns
+
+    If the extension of `filename` is '.h5' or '.hdf5', the maps are saved
+    in chunked and compressed `gmap` and `nmap` datasets of an HDF5 file
+    instead, with the other arrays as datasets of the same name and PIXSIZE,
+    NSIDE and ORDERING attributes. Flat maps come with a pyramid of coarser
+    maps, the shear being averaged weighted by nmap, see
+    `map_io.write_hdf5_map`, whose options are given in the `hdf5`
+    dictionary.
+    """
+    if is_hdf5_filename(filename):
+        extra = {'grid_ra': grid_ra, 'grid_dec': grid_dec,
+                 'responsivity': responsivity, 'pixels': pixels}
+        # Maps without pixel size are HEALpix maps, without pyramid
+        write_hdf5_map(filename, {'gmap': gmap, 'nmap': nmap}, weight='nmap',
+                       extra={k: v for k, v in extra.items() if v is not None},
+                       attrs={'PIXSIZE': pixel_size, 'NSIDE': nside,
+                              'ORDERING': 'RING' if nside else None},
+                       healpix=pixel_size is None, **dict(hdf5 or {}))
+        return
+
+    if pixels is not None:
+        extra_hdus = []
+        if responsivity is not None:
+            extra_hdus.append(fits.ImageHDU(responsivity, name='RESPONSIVITY'))
+        gmap = np.asarray(gmap)
+        write_partial_map(filename, pixels,
+                          {'G1': gmap[..., 0, :], 'G2': gmap[..., 1, :],
+                           'N': nmap},
+                          nside, extname='SHEAR_MAP', extra_hdus=extra_hdus)
+        return
+
     phdu = fits.PrimaryHDU(gmap)
+    if pixel_size is not None:
+        phdu.header['PIXSIZE'] = (pixel_size, 'Pixel size [arcmin]')
     nhdu = fits.ImageHDU(nmap)
 
     # In the case of 2D map, we are also saving the coordinate grid
-    if projection2d:
+    if grid_ra is not None:
         rahdu = fits.ImageHDU(grid_ra)
         dechdu = fits.ImageHDU(grid_dec)
         hdulist = fits.HDUList([phdu, nhdu, rahdu, dechdu])
     else:
         hdulist = fits.HDUList([phdu, nhdu])
 
+    if responsivity is not None:
+        hdulist.append(fits.ImageHDU(responsivity, name='RESPONSIVITY'))
 
-    filename = config['output_filename']
     hdulist.writeto(filename)
 
+def shear_map(config, comm=None):
+    """
+    Builds a shear map from a given shape catalog
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary read from yaml config file. If
+            `chunk_size` is set, the catalog is streamed by chunks of that
+            many rows instead of being loaded in memory. If `tomography` is
+            set, maps of all tomographic bins are built in a single pass,
+            see `tomographic_bins`. If `profile` is set, the time, memory
+            and I/O of each phase are saved next to the output, see
+            `instrumentation.profile_stage`. If `spatial_index` is set and
+            the catalog is loaded in memory, only the rows around a flat map
+            are read from a catalog sorted by `spatial_index`, the
+            responsivity being averaged over the whole catalog from its
+            responsivity columns only, see `stream_responsivity`. If
+            `dtype` is 'float32', the calibrated shear and the maps are
+            stored in single precision, the sums being accumulated in
+            double precision. If `output_filename` ends in '.h5' or
+            '.hdf5', the map is saved in HDF5 with the `hdf5` options, see
+            `write_shear_map`.
+
+        comm: MPI communicator, optional
+            If provided, the catalog is split between processes and the map
+            is written by rank 0
+    """
+    filename = config['input_filename']
+
+    # Extracts projection configuration
+    c = config['projection']
+    tomography = config.get('tomography')
+    dtype = config.get('dtype')
+
+    with profile_stage('shear_map', config.get('profile'),
+                       config['output_filename'], comm):
+        if config.get('chunk_size') or comm is not None:
+            maps = stream_shear_map(filename, c, config.get('chunk_size'),
+                                    comm=comm, tomography=tomography,
+                                    dtype=dtype)
+        else:
+            # Only loads the columns used to build the map
+            columns = list(shear_map_columns)
+            if tomography is not None:
+                columns.append(tomography['column'])
+            R = None
+            region = config.get('spatial_index') and c['type'] in ['gnomonic']
+            if region:
+                R = stream_responsivity(filename, tomography=tomography)
+            with span('read'):
+                if region:
+                    from .spatial_index import read_flat_map_region
+                    catalog = read_flat_map_region(filename, c, columns)
+                else:
+                    catalog = read_catalog(filename, columns)
+                catalog = Table(catalog, copy=False)
+            maps = compute_shear_map(catalog, c, tomography, dtype, R)
+
+        # Saves the resulting map
+        if comm is None or comm.rank == 0:
+            with span('write'):
+                write_shear_map(config['output_filename'],
+                                hdf5=config.get('hdf5'), **maps)
+
 
 if __name__ == "__main__":
 
@@ -144,6 +867,6 @@ if __name__ == "__main__":
     (options, args) = parser.parse_args()
 
     with open(args[0]) as f:
-        config = yaml.load(f.read())
+        config = yaml.safe_load(f)
 
     shear_map(config['shear_map'])
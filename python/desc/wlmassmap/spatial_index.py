@@ -0,0 +1,297 @@
+# This module sorts catalogs by coarse HEALpix pixel and stores the row range
+# of each pixel in a sidecar file, so that patches of the sky can be read
+# without scanning the entire catalog
+from optparse import OptionParser
+import os
+import yaml
+import numpy as np
+import healpy as hp
+import h5py
+from astropy.io import fits
+
+from .catalog_io import CatalogReader
+from .instrumentation import profile_stage, span
+
+def patch_pixels(ra_range, dec_range, nside, nest=False):
+    """
+    HEALpix pixels overlapping a patch of the sky delimited in ra and dec
+
+    Parameters
+    ----------
+    ra_range, dec_range: (float, float)
+        Limits of the patch [degrees], ra_range may wrap around 0
+
+    nside: int
+        HEALpix resolution
+
+    nest: bool
+        Whether to return NESTED pixel indices, instead of RING
+
+    Returns
+    -------
+    pixels: int array
+        Pixels overlapping the patch, possibly including a few pixels around
+        it
+    """
+    ra_min, ra_max = ra_range
+    dec_min, dec_max = dec_range
+
+    # Pixels of the declination band, then of the right ascension range up
+    # to the size of a pixel, widened away from the equator
+    margin = np.rad2deg(hp.max_pixrad(nside))
+    pixels = hp.query_strip(nside, np.deg2rad(90. - dec_max),
+                            np.deg2rad(90. - dec_min), inclusive=True,
+                            nest=nest)
+    ra, dec = hp.pix2ang(nside, pixels, nest=nest, lonlat=True)
+    cos_dec = np.cos(np.deg2rad(min(max(abs(dec_min), abs(dec_max)) + margin,
+                                    90.)))
+    if cos_dec <= margin / 180. or ra_max - ra_min >= 360.:
+        return pixels
+    margin = margin / cos_dec
+    width = (ra_max - ra_min) % 360.
+    offset = (ra - ra_min + margin) % 360.
+    return pixels[offset <= width + 2 * margin]
+
+def spatial_index_filename(filename):
+    """
+    Name of the sidecar file storing the spatial index of a catalog
+    """
+    return os.path.splitext(filename)[0] + '.index.fits'
+
+def build_spatial_index(input_filename, output_filename, nside=32,
+                        chunk_size=1000000):
+    """
+    Sorts a catalog by coarse HEALpix pixel (NESTED ordering) and saves it as
+    an HDF5 `WLMassMap_data` table, with its spatial index in a sidecar file,
+    see `spatial_index_filename`. Galaxies of a pixel keep their original
+    order, and neighbouring pixels are mostly stored next to each other.
+
+    The index is a table with the PIXEL, START and STOP row range of each
+    occupied pixel, with the resolution (NSIDE), the number of rows (NROWS)
+    and the size of the sorted catalog (CATSIZE) in its header.
+
+    Parameters
+    ----------
+    input_filename: string
+        FITS or HDF5 catalog, with ra and dec columns [degrees]
+
+    output_filename: string
+        Sorted HDF5 catalog
+
+    nside: int
+        Resolution of the coarse pixels
+
+    chunk_size: int
+        Number of rows processed at once. Only ra and dec are read for the
+        whole catalog, the rows of the sorted catalog being gathered from
+        the input by windows of `chunk_size` rows.
+    """
+    with CatalogReader(input_filename) as reader:
+        n = len(reader)
+        pixels = np.empty(n, dtype=np.int64)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            with span('read'):
+                chunk = reader.read(['ra', 'dec'], start, stop)
+            with span('pixelization'):
+                pixels[start:stop] = hp.ang2pix(nside, chunk['ra'], chunk['dec'],
+                                                nest=True, lonlat=True)
+
+        with span('sort'):
+            order = np.argsort(pixels, kind='stable')
+            counts = np.bincount(pixels, minlength=hp.nside2npix(nside))
+            del pixels
+
+        # Rows are gathered window by window from the input, in increasing
+        # order for locality, and converted to native byte order
+        empty = reader.read(None, 0, 0)
+        dtype = np.dtype([(name, empty[name].dtype.newbyteorder('='),
+                           empty[name].shape[1:]) for name in reader.columns])
+        with h5py.File(output_filename, 'w') as fout:
+            dset = fout.create_dataset('WLMassMap_data', shape=(n,), dtype=dtype,
+                                       chunks=(max(1, min(chunk_size, n, 65536)),))
+            for start in range(0, n, chunk_size):
+                stop = min(start + chunk_size, n)
+                index = order[start:stop]
+                s = np.argsort(index)
+                with span('read'):
+                    data = reader.take(index[s])
+                with span('gather'):
+                    rows = np.empty(stop - start, dtype=dtype)
+                    for name in reader.columns:
+                        rows[name][s] = data[name]
+                with span('write'):
+                    dset[start:stop] = rows
+
+    occupied = np.nonzero(counts)[0]
+    stops = np.cumsum(counts)
+    cols = [fits.Column(name='PIXEL', format='K', array=occupied),
+            fits.Column(name='START', format='K',
+                        array=stops[occupied] - counts[occupied]),
+            fits.Column(name='STOP', format='K', array=stops[occupied])]
+    hdu = fits.BinTableHDU.from_columns(cols, name='SPATIAL_INDEX')
+    hdu.header['PIXTYPE'] = ('HEALPIX', 'HEALPIX pixelisation')
+    hdu.header['ORDERING'] = ('NESTED', 'Pixel ordering scheme')
+    hdu.header['NSIDE'] = (nside, 'Resolution parameter of HEALPIX')
+    hdu.header['NROWS'] = (n, 'Number of rows of the catalog')
+    hdu.header['CATSIZE'] = (os.path.getsize(output_filename),
+                             'Size of the catalog [bytes]')
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(
+        spatial_index_filename(output_filename), overwrite=True)
+
+class SpatialIndex(object):
+    """
+    Spatial index of a catalog sorted by `build_spatial_index`. Queries
+    return the ranges of rows of the coarse pixels overlapping a region of
+    the sky, merged when contiguous, and only these rows are read.
+
+    Parameters
+    ----------
+    filename: string
+        Sorted catalog, whose index is read from its sidecar file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with fits.open(spatial_index_filename(filename)) as hdul:
+            header = hdul['SPATIAL_INDEX'].header
+            data = hdul['SPATIAL_INDEX'].data
+            self.pixels = np.array(data['PIXEL'])
+            self.starts = np.array(data['START'])
+            self.stops = np.array(data['STOP'])
+        self.nside = header['NSIDE']
+        self.nrows = header['NROWS']
+        if os.path.getsize(filename) != header['CATSIZE']:
+            raise ValueError("The spatial index of %s is out of date" % filename)
+
+    def query_pixels(self, pixels):
+        """
+        Ranges of rows of a set of coarse pixels (NESTED ordering)
+
+        Returns
+        -------
+        ranges: (n,2) int array
+            Sorted, non overlapping (start, stop) ranges of rows
+        """
+        pixels = np.unique(pixels)
+        sel = np.isin(self.pixels, pixels, assume_unique=True)
+        starts, stops = self.starts[sel], self.stops[sel]
+
+        # Merges the ranges of consecutive pixels
+        if len(starts) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        breaks = np.nonzero(starts[1:] != stops[:-1])[0] + 1
+        return np.stack([starts[np.concatenate([[0], breaks])],
+                         stops[np.concatenate([breaks - 1, [len(stops) - 1]])]],
+                        axis=1)
+
+    def query_disc(self, ra, dec, radius):
+        """
+        Ranges of rows of the coarse pixels overlapping a disc
+
+        Parameters
+        ----------
+        ra, dec: float
+            Center of the disc [degrees]
+
+        radius: float
+            Radius of the disc [degrees]
+        """
+        vec = hp.ang2vec(ra, dec, lonlat=True)
+        return self.query_pixels(hp.query_disc(self.nside, vec,
+                                               np.deg2rad(radius),
+                                               inclusive=True, nest=True))
+
+    def query_polygon(self, ra, dec):
+        """
+        Ranges of rows of the coarse pixels overlapping a convex polygon
+
+        Parameters
+        ----------
+        ra, dec: array_like
+            Vertices of the polygon [degrees]
+        """
+        vertices = hp.ang2vec(np.asarray(ra), np.asarray(dec), lonlat=True)
+        return self.query_pixels(hp.query_polygon(self.nside, vertices,
+                                                  inclusive=True, nest=True))
+
+    def query_patch(self, ra_range, dec_range):
+        """
+        Ranges of rows of the coarse pixels overlapping a patch delimited in
+        ra and dec [degrees], see `patch_pixels`
+        """
+        return self.query_pixels(patch_pixels(ra_range, dec_range, self.nside,
+                                              nest=True))
+
+    def read(self, ranges, columns=None):
+        """
+        Reads the requested columns of the rows of a set of ranges, as
+        returned by the queries
+
+        Returns
+        -------
+        data: dict
+            Dictionary of column arrays, loaded in memory
+        """
+        with CatalogReader(self.filename) as reader:
+            columns = reader.columns if columns is None else list(columns)
+            parts = [reader.read(columns, start, stop) for start, stop in ranges]
+            if not parts:
+                empty = reader.read(columns, 0, 0)
+                return {name: np.array(empty[name]) for name in columns}
+            return {name: np.concatenate([p[name] for p in parts])
+                    for name in columns}
+
+def read_flat_map_region(filename, projection, columns=None):
+    """
+    Reads the rows of an indexed catalog in the coarse pixels overlapping a
+    flat map, see the `projection` configuration of `shear_map`
+
+    Parameters
+    ----------
+    filename: string
+        Sorted catalog, with a spatial index
+
+    projection: dictionary
+        Gnomonic projection configuration
+
+    columns: list of string, optional
+        Columns to read, defaults to all columns
+    """
+    c = projection
+    # Angular radius of the disc circumscribing the map
+    half_diagonal = np.hypot(c['nx'], c['ny']) * c['pixel_size'] / 120.
+    radius = np.rad2deg(np.arctan(np.deg2rad(half_diagonal)))
+    index = SpatialIndex(filename)
+    return index.read(index.query_disc(c['center_ra'], c['center_dec'], radius),
+                      columns)
+
+def spatial_index(config):
+    """
+    Sorts a catalog by coarse HEALpix pixel and writes its spatial index,
+    see `build_spatial_index`
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary read from yaml config file, with the
+            resolution `nside` of the coarse pixels (default: 32) and the
+            `chunk_size` (default: 1000000). If `profile` is set, the time,
+            memory and I/O of each phase are saved next to the output, see
+            `instrumentation.profile_stage`.
+    """
+    with profile_stage('spatial_index', config.get('profile'),
+                       config['output_filename']):
+        build_spatial_index(config['input_filename'], config['output_filename'],
+                            config.get('nside') or 32,
+                            config.get('chunk_size') or 1000000)
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    (options, args) = parser.parse_args()
+
+    with open(args[0]) as f:
+        config = yaml.safe_load(f)
+
+    spatial_index(config['spatial_index'])
@@ -0,0 +1,39 @@
+# This module provides the small synthetic catalogs and map configurations
+# shared by the tests
+import pytest
+
+from desc.wlmassmap.mocks.synthetic import write_synthetic_catalog
+
+# Number of galaxies of the test catalogs, spanning several noise blocks
+ngal = 150000
+
+# Flat 4x4 deg patch around (ra, dec) = (20, -10)
+patch = {'type': 'patch', 'ra_range': [18., 22.], 'dec_range': [-12., -8.]}
+
+@pytest.fixture
+def flat_projection():
+    """
+    Projection of a 60x50 flat map covering most of the test patch
+    """
+    return {'type': 'gnomonic', 'center_ra': 20., 'center_dec': -10.,
+            'pixel_size': 4., 'nx': 60, 'ny': 50}
+
+@pytest.fixture(scope='session')
+def shape_catalog(tmp_path_factory):
+    """
+    Synthetic metacal shape catalog, written to an HDF5 file
+    """
+    filename = str(tmp_path_factory.mktemp('catalogs') / 'shape.hdf5')
+    write_synthetic_catalog(filename, ngal, patch, kind='shape',
+                            chunk_size=65536)
+    return filename
+
+@pytest.fixture(scope='session')
+def truth_catalog(tmp_path_factory):
+    """
+    Synthetic ground truth catalog, written to an HDF5 file
+    """
+    filename = str(tmp_path_factory.mktemp('catalogs') / 'truth.hdf5')
+    write_synthetic_catalog(filename, ngal, patch, kind='truth',
+                            chunk_size=65536)
+    return filename
@@ -0,0 +1,89 @@
+# This module tests the cache of the stage outputs
+import os
+
+import pytest
+
+pytest.importorskip('ceci')
+from mmpipe.cache import StageCache, code_version
+
+def write(filename, content):
+    with open(filename, 'w') as f:
+        f.write(content)
+
+def read(filename):
+    with open(filename) as f:
+        return f.read()
+
+def test_key(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    inputs = {'catalog': str(tmp_path / 'catalog.txt')}
+    write(inputs['catalog'], 'galaxies')
+    config = {'nside': 64, 'output_filename': 'a.fits', 'profile': True}
+    key = cache.key('ShearMap', config, inputs)
+
+    # Filenames and options not affecting the outputs are ignored
+    assert cache.key('ShearMap', dict(config, output_filename='b.fits',
+                                      profile=False), inputs) == key
+    # Touching an input does not change the key, rewriting it does
+    os.utime(inputs['catalog'], ns=(0, 0))
+    assert cache.key('ShearMap', config, inputs) == key
+    assert cache.key('ConvergenceMap', config, inputs) != key
+    assert cache.key('ShearMap', dict(config, nside=128), inputs) != key
+    write(inputs['catalog'], 'other galaxies')
+    assert cache.key('ShearMap', config, inputs) != key
+
+    # Digests are remembered across instances
+    assert StageCache(str(tmp_path / 'cache'))._digests == cache._digests
+
+def test_fetch_store(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    outputs = {'map': str(tmp_path / 'map.fits')}
+    assert not cache.fetch('key', outputs)
+
+    write(outputs['map'], 'map')
+    cache.store('key', outputs, 'ShearMap')
+    os.remove(outputs['map'])
+    assert cache.fetch('key', outputs)
+    assert read(outputs['map']) == 'map'
+
+    # Entries with other outputs are not hits
+    assert not cache.fetch('key', dict(outputs, kappa='kappa.fits'))
+
+def test_lru_eviction(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'), max_size=2.5e-6)
+    outputs = {'map': str(tmp_path / 'map.fits')}
+    for i, key in enumerate(['a', 'b']):
+        write(outputs['map'], key * 1000)
+        cache.store(key, outputs)
+        meta = os.path.join(cache.cache_dir, key, 'meta.json')
+        os.utime(meta, (i, i))
+    assert [key for _, _, key in cache.entries()] == ['a', 'b']
+
+    # Using 'a' makes 'b' the least recently used entry, evicted by 'c'
+    assert cache.fetch('a', outputs)
+    write(outputs['map'], 'c' * 1000)
+    cache.store('c', outputs)
+    assert sorted(key for _, _, key in cache.entries()) == ['a', 'c']
+    assert cache.fetch('a', outputs) and read(outputs['map']) == 'a' * 1000
+    assert not cache.fetch('b', outputs)
+
+def test_code_version(tmp_path, monkeypatch):
+    import desc.wlmassmap
+    package = tmp_path / 'wlmassmap'
+    os.makedirs(str(package / 'tests'))
+    write(str(package / '__init__.py'), '')
+    write(str(package / 'tests' / 'test_module.py'), 'a = 1')
+    monkeypatch.setattr(desc.wlmassmap, '__file__',
+                        str(package / '__init__.py'))
+
+    def version():
+        code_version.cache_clear()
+        return code_version()
+
+    # Changes of the tests do not invalidate the cache, of the code do
+    before = version()
+    write(str(package / 'tests' / 'test_module.py'), 'a = 2')
+    assert version() == before
+    write(str(package / 'module.py'), 'a = 1')
+    assert version() != before
+    code_version.cache_clear()
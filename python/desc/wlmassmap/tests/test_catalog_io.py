@@ -0,0 +1,57 @@
+# This module tests the column selective catalog reader
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+import h5py
+from astropy.table import Table
+
+from desc.wlmassmap.catalog_io import (CatalogReader, read_catalog,
+                                       iter_catalog_chunks, catalog_length)
+
+@pytest.fixture
+def catalogs(tmp_path):
+    """
+    The same table as a FITS file, a contiguous and a chunked HDF5 file
+    """
+    rng = np.random.default_rng(3)
+    n = 10000
+    data = np.zeros(n, dtype=[('id', 'i8'), ('ra', 'f8'), ('g', 'f4', (2,)),
+                              ('flag', '?')])
+    data['id'] = np.arange(n)
+    data['ra'] = rng.uniform(0, 360, n)
+    data['g'] = rng.standard_normal((n, 2))
+    data['flag'] = rng.random(n) < 0.5
+
+    filenames = {'fits': str(tmp_path / 'cat.fits'),
+                 'contiguous': str(tmp_path / 'contiguous.hdf5'),
+                 'chunked': str(tmp_path / 'chunked.hdf5')}
+    Table(data).write(filenames['fits'])
+    with h5py.File(filenames['contiguous'], 'w') as f:
+        f.create_dataset('WLMassMap_data', data=data)
+    with h5py.File(filenames['chunked'], 'w') as f:
+        f.create_dataset('WLMassMap_data', data=data, chunks=(1000,),
+                         compression='gzip')
+    return data, filenames
+
+@pytest.mark.parametrize('kind', ['fits', 'contiguous', 'chunked'])
+def test_reader(catalogs, kind):
+    data, filenames = catalogs
+    filename = filenames[kind]
+    assert catalog_length(filename) == len(data)
+
+    with CatalogReader(filename) as reader:
+        assert reader.columns == ['id', 'ra', 'g', 'flag']
+        # Only contiguous data is memory mapped
+        assert (reader._mmap is not None) == (kind != 'chunked')
+        rows = reader.read(['ra', 'flag'], 1234, 5678)
+        assert sorted(rows) == ['flag', 'ra']
+        assert_array_equal(rows['ra'], data['ra'][1234:5678])
+        assert_array_equal(rows['flag'], data['flag'][1234:5678])
+
+    full = read_catalog(filename)
+    for name in data.dtype.names:
+        assert_array_equal(full[name], data[name])
+
+    chunks = list(iter_catalog_chunks(filename, ['id', 'g'], 3001))
+    assert len(chunks) == 4
+    assert_array_equal(np.concatenate([c['g'] for c in chunks]), data['g'])
@@ -0,0 +1,48 @@
+# This module tests the selection of the native chunks of the simulations
+# overlapping a footprint
+import numpy as np
+import healpy as hp
+import pytest
+
+from desc.wlmassmap.mocks.extract_footprint import (footprint_pixels,
+                                                    footprint_native_filters,
+                                                    native_nside)
+
+class NativeCatalog(object):
+    """
+    Catalog exposing the healpix_pixel native quantity, as the DC2 readers
+    """
+    native_filter_quantities = ['healpix_pixel']
+
+def random_points(ra_range, dec_range, n=200000, seed=0):
+    rng = np.random.default_rng(seed)
+    ra_min, ra_max = ra_range
+    width = ra_max - ra_min if ra_max - ra_min >= 360. else \
+        (ra_max - ra_min) % 360.
+    ra = (ra_min + width * rng.random(n)) % 360.
+    dec = rng.uniform(dec_range[0], dec_range[1], n)
+    return ra, dec
+
+@pytest.mark.parametrize('ra_range', [[18., 22.], [350., 10.], [0., 360.]])
+def test_footprint_pixels(ra_range):
+    footprint = {'type': 'patch', 'ra_range': ra_range,
+                 'dec_range': [-10., 10.]}
+    ra, dec = random_points(ra_range, footprint['dec_range'])
+    expected = np.unique(hp.ang2pix(native_nside, ra, dec, lonlat=True))
+
+    pixels = footprint_pixels(footprint, native_nside)
+    assert np.all(np.isin(expected, pixels))
+    # Only a margin of about one pixel is added around the footprint
+    assert len(pixels) <= len(expected) * 1.5
+
+    [(select, quantity)] = footprint_native_filters(NativeCatalog(),
+                                                    footprint)
+    assert quantity == 'healpix_pixel'
+    all_pixels = np.arange(hp.nside2npix(native_nside))
+    assert np.all(select(expected))
+    assert np.array_equal(all_pixels[select(all_pixels)], np.sort(pixels))
+
+def test_no_native_filters():
+    footprint = {'type': 'patch', 'ra_range': [18., 22.],
+                 'dec_range': [-10., 10.]}
+    assert footprint_native_filters(object(), footprint) == []
@@ -0,0 +1,78 @@
+# This module tests the interchangeable FFT backends of the flat inversions
+import os
+import pickle
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from desc.wlmassmap.fft_backends import PyFFTW, get_fft_backend
+from desc.wlmassmap.kaiser_squires import FlatKSOperator, flat_KS_map
+
+def backend(name, **kwargs):
+    pytest.importorskip({'numpy': 'numpy', 'scipy': 'scipy.fft',
+                         'pyfftw': 'pyfftw'}[name])
+    return get_fft_backend(name, **kwargs)
+
+@pytest.mark.parametrize('name', ['numpy', 'scipy', 'pyfftw'])
+@pytest.mark.parametrize('dtype', ['float64', 'float32'])
+def test_backends_match_numpy(name, dtype):
+    fft = backend(name, threads=2)
+    rng = np.random.default_rng(0)
+    a = (rng.standard_normal((3, 40, 36)) +
+         1j * rng.standard_normal((3, 40, 36))).astype(
+             np.result_type(dtype, np.complex64))
+    rtol = 1e-12 if dtype == 'float64' else 1e-5
+    out = fft.fft2(a.copy())
+    assert out.dtype == a.dtype
+    assert_allclose(out, np.fft.fft2(a), rtol=rtol, atol=rtol * 40)
+    assert_allclose(fft.ifft2(out), a, rtol=rtol, atol=rtol)
+
+    # Convergence maps do not depend on the backend
+    gmap = 0.1 * rng.standard_normal((4, 2, 40, 36)).astype(dtype)
+    kwargs = {'dtype': dtype, 'zero_padding': 10, 'sigma': 1.5}
+    kappa = flat_KS_map(gmap, fft_backend=name, fft_threads=2, **kwargs)
+    expected = flat_KS_map(gmap, **kwargs)
+    for k, e in zip(kappa, expected):
+        assert k.dtype == np.dtype(dtype)
+        assert_allclose(k, e, rtol=0, atol=rtol * e.std())
+
+@pytest.mark.parametrize('name', ['scipy', 'pyfftw'])
+def test_masked_backends(name):
+    rng = np.random.default_rng(1)
+    gmap = 0.1 * rng.standard_normal((2, 30, 30))
+    nmap = rng.poisson(2., (30, 30))
+    ks = FlatKSOperator(30, 30, zero_padding=8, fft=backend(name))
+    kappa_e, kappa_b, info = ks.masked(gmap, nmap)
+    expected_e, expected_b, expected = FlatKSOperator(
+        30, 30, zero_padding=8).masked(gmap, nmap)
+    assert info['niter'] == expected['niter']
+    assert_allclose(kappa_e, expected_e, rtol=0, atol=1e-9)
+    assert_allclose(kappa_b, expected_b, rtol=0, atol=1e-9)
+
+def test_get_fft_backend():
+    assert get_fft_backend('numpy') is get_fft_backend('numpy')
+    assert get_fft_backend(None).name == 'numpy'
+    with pytest.raises(ValueError):
+        get_fft_backend('fftpack')
+
+def test_pyfftw_wisdom(tmp_path):
+    pyfftw = pytest.importorskip('pyfftw')
+    filename = str(tmp_path / 'wisdom.pkl')
+    fft = PyFFTW(threads=1, wisdom_filename=filename)
+    a = np.ones((2, 24, 20), dtype=np.complex128)
+    assert_allclose(fft.ifft2(fft.fft2(a)), a)
+    assert fft.plan(a.shape, a.dtype, 'FFTW_FORWARD') is \
+        fft.plan(a.shape, a.dtype, 'FFTW_FORWARD')
+
+    # The wisdom of the plans is saved, and loaded by later instances
+    def entries(wisdom):
+        return [sorted(w.splitlines()) for w in wisdom]
+
+    with open(filename, 'rb') as f:
+        wisdom = pickle.load(f)
+    assert entries(wisdom) == entries(pyfftw.export_wisdom())
+    pyfftw.forget_wisdom()
+    PyFFTW(threads=1, wisdom_filename=filename)
+    assert entries(pyfftw.export_wisdom()) == entries(wisdom)
+    assert not [name for name in os.listdir(str(tmp_path))
+                if name != 'wisdom.pkl']
@@ -0,0 +1,136 @@
+# This module checks that the modules of the pipeline import quickly and
+# only import the heavy dependencies they need, each stage running in its own
+# process. Budgets are in seconds, and can be scaled on slow file systems with
+# the WLMASSMAP_IMPORT_BUDGET_SCALE environment variable.
+import ast
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Root of the python packages, added to the path of the subprocesses
+python_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))))
+
+budget_scale = float(os.environ.get('WLMASSMAP_IMPORT_BUDGET_SCALE', 1.))
+
+# Modules which are slow to import, and only needed by some stages
+heavy_modules = ['GCR', 'GCRCatalogs', 'healpy', 'h5py', 'scipy',
+                 'astropy.table', 'astropy.io.fits', 'pyfftw', 'ducc0']
+
+# Import time budget and heavy modules allowed for each module
+budgets = {
+    'desc.wlmassmap.instrumentation': (0.1, []),
+    'desc.wlmassmap.fft_backends': (0.25, []),
+    'desc.wlmassmap.kaiser_squires': (0.25, []),
+    'desc.wlmassmap.projection': (0.25, []),
+    'desc.wlmassmap.map_io': (0.75, ['astropy.io.fits']),
+    'desc.wlmassmap.convergence_map': (0.75, ['astropy.io.fits']),
+    'desc.wlmassmap.catalog_io': (1., ['h5py', 'astropy.io.fits']),
+    'desc.wlmassmap.selection': (1., ['h5py', 'astropy.io.fits']),
+    'desc.wlmassmap.shear_map': (1., ['h5py', 'astropy.table',
+                                      'astropy.io.fits']),
+    'desc.wlmassmap.pipeline': (1., ['h5py', 'astropy.table',
+                                     'astropy.io.fits']),
+    'desc.wlmassmap.mocks.mock_observation': (1., ['h5py', 'astropy.table',
+                                                   'astropy.io.fits']),
+    'desc.wlmassmap.spatial_index': (1., ['healpy', 'h5py', 'astropy.table',
+                                          'astropy.io.fits']),
+    'desc.wlmassmap.noise_realizations': (1., ['healpy', 'h5py',
+                                               'astropy.table',
+                                               'astropy.io.fits']),
+    'desc.wlmassmap.tiling': (1., ['healpy', 'h5py', 'astropy.table',
+                                   'astropy.io.fits']),
+    'desc.wlmassmap.mocks.synthetic': (1., ['healpy', 'h5py', 'astropy.table',
+                                            'astropy.io.fits']),
+}
+
+def measure_import(module):
+    """
+    Imports a module in a new interpreter
+
+    Returns
+    -------
+    elapsed: float
+        Cumulative import time of the module [s], from `python -X importtime`
+
+    modules: set of string
+        Modules imported as a result
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([python_dir, env.get('PYTHONPATH', '')])
+    code = "import sys, %s; print('\\n'.join(sys.modules))" % module
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, universal_newlines=True,
+                            check=True)
+    elapsed = None
+    for line in result.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            elapsed = int(fields[1]) * 1e-6
+    return elapsed, set(result.stdout.split())
+
+def imported_heavy_modules(modules):
+    return sorted(m for m in heavy_modules if m in modules)
+
+@pytest.mark.parametrize('module', sorted(budgets))
+def test_import_time(module):
+    budget, allowed = budgets[module]
+    # Warms up the bytecode cache, the first import compiles the sources
+    measure_import(module)
+    elapsed, modules = measure_import(module)
+
+    unexpected = set(imported_heavy_modules(modules)) - set(allowed)
+    assert not unexpected, "%s imports %s" % (module, sorted(unexpected))
+    assert elapsed is not None
+    assert elapsed < budget * budget_scale, \
+        "%s takes %.3fs to import, budget %.3fs" % (module, elapsed,
+                                                    budget * budget_scale)
+
+def declared_stages():
+    """
+    Function and dependencies declared by each stage of `mmpipe.apps`, read
+    from its source so that ceci is not needed
+    """
+    stages = {}
+    with open(os.path.join(python_dir, 'mmpipe', 'apps.py')) as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef):
+            continue
+        attrs = {}
+        for statement in node.body:
+            if isinstance(statement, ast.Assign) and \
+               isinstance(statement.targets[0], ast.Name) and \
+               statement.targets[0].id in ['function', 'dependencies']:
+                attrs[statement.targets[0].id] = \
+                    ast.literal_eval(statement.value)
+        if 'function' in attrs:
+            stages[node.name] = (attrs['function'],
+                                 attrs.get('dependencies', []))
+    return stages
+
+@pytest.mark.parametrize('name', sorted(declared_stages()))
+def test_stage_dependencies(name):
+    # Each stage only imports the dependencies it declares
+    function, dependencies = declared_stages()[name]
+    module = function.split(':')[0]
+    elapsed, modules = measure_import(module)
+    unexpected = set(imported_heavy_modules(modules)) - set(dependencies)
+    assert not unexpected, "%s imports %s" % (name, sorted(unexpected))
+
+def test_mmpipe_import():
+    pytest.importorskip('ceci')
+    pytest.importorskip('descformats')
+    from mmpipe.registry import stage_registry
+
+    # Starting any stage only imports ceci and the stage classes
+    elapsed, modules = measure_import('mmpipe')
+    unexpected = set(imported_heavy_modules(modules)) - set(['astropy.io.fits'])
+    assert not unexpected, "mmpipe imports %s" % sorted(unexpected)
+
+    # The registered stages are the declared ones
+    assert {name: (cls.function, list(cls.dependencies))
+            for name, cls in stage_registry.items()} == declared_stages()
@@ -0,0 +1,46 @@
+# This module tests the instrumentation of the pipeline stages
+import json
+import os
+
+from desc.wlmassmap import instrumentation
+from desc.wlmassmap.instrumentation import (profile_stage, profile_filename,
+                                            span)
+from desc.wlmassmap.shear_map import shear_map
+
+def test_profile_stage(tmp_path):
+    output_filename = str(tmp_path / 'output.fits')
+    with profile_stage('stage', True, output_filename):
+        for i in range(3):
+            with span('chunk'):
+                with span('read'):
+                    data = bytearray(1 << 20)
+    assert instrumentation._profiler is None
+
+    with open(profile_filename(output_filename)) as f:
+        profile = json.load(f)
+    assert profile['stage'] == 'stage'
+    spans = {s['name']: s for s in profile['spans']}
+    assert sorted(spans) == ['stage', 'stage/chunk', 'stage/chunk/read']
+    # Repeated spans are aggregated
+    assert spans['stage/chunk']['calls'] == 3
+    assert spans['stage/chunk/read']['calls'] == 3
+    assert spans['stage']['wall_time'] >= spans['stage/chunk']['wall_time']
+    assert spans['stage']['peak_rss'] >= spans['stage/chunk/read']['peak_rss'] > 0
+
+def test_disabled_profile(tmp_path):
+    output_filename = str(tmp_path / 'output.fits')
+    with profile_stage('stage', False, output_filename):
+        assert span('read') is instrumentation._null_span
+    assert not os.path.exists(profile_filename(output_filename))
+
+def test_stage_profile(shape_catalog, flat_projection, tmp_path):
+    output_filename = str(tmp_path / 'shear_map.fits')
+    shear_map({'input_filename': shape_catalog, 'projection': flat_projection,
+               'chunk_size': 50000, 'profile': True,
+               'output_filename': output_filename})
+    with open(profile_filename(output_filename)) as f:
+        spans = {s['name']: s for s in json.load(f)['spans']}
+    for name in ['shear_map', 'shear_map/read', 'shear_map/responsivity',
+                 'shear_map/binning', 'shear_map/write']:
+        assert name in spans
+    assert spans['shear_map/binning']['calls'] == 3
@@ -0,0 +1,239 @@
+# This module tests the flat and spherical Kaiser-Squires inversions
+import warnings
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+from astropy.table import Table
+
+from desc.wlmassmap.kaiser_squires import (FlatKSOperator, flat_KS_map,
+                                           get_flat_KS_operator,
+                                           fft_friendly_size, healpix_KS_map)
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.shear_map import compute_shear_map, shear_map_columns
+from desc.wlmassmap.convergence_map import compute_convergence_map
+
+def reference_flat_KS_map(gmap, sigma=None):
+    """
+    Original single map implementation of the flat KS inversion, for square
+    maps, followed by a Gaussian smoothing of `sigma` pixels
+    """
+    n = gmap.shape[-1]
+    k1, k2 = np.meshgrid(np.fft.fftfreq(n), np.fft.fftfreq(n))
+    g1 = np.fft.fft2(gmap[0])
+    g2 = np.fft.fft2(gmap[1])
+    denom = k1*k1 + k2*k2
+    denom[0, 0] = 1
+    kap = ((k1*k1 - k2*k2) - 2j*(k1*k2)) * (g1 + 1j*g2) / denom
+    if sigma is not None:
+        kap *= np.exp(-2 * (np.pi * sigma)**2 * (k1*k1 + k2*k2))
+    kap = np.fft.ifft2(kap)
+    return np.real(kap), np.imag(kap)
+
+def random_shear_maps(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return 0.1 * rng.standard_normal(shape)
+
+def test_flat_ks_matches_reference():
+    gmap = random_shear_maps((2, 64, 64))
+    kappa_e, kappa_b = flat_KS_map(gmap)
+    expected_e, expected_b = reference_flat_KS_map(gmap)
+    assert_allclose(kappa_e, expected_e, rtol=0, atol=1e-13)
+    assert_allclose(kappa_b, expected_b, rtol=0, atol=1e-13)
+
+def test_flat_ks_batched():
+    # A stack of maps is inverted as each map separately
+    gmaps = random_shear_maps((5, 2, 48, 40))
+    ks = FlatKSOperator(48, 40)
+    kappa_e, kappa_b = ks(gmaps)
+    assert kappa_e.shape == (5, 48, 40)
+    for i in range(len(gmaps)):
+        e, b = ks(gmaps[i])
+        assert_allclose(kappa_e[i], e, rtol=0, atol=1e-14)
+        assert_allclose(kappa_b[i], b, rtol=0, atol=1e-14)
+
+def test_flat_ks_operator_cache():
+    assert get_flat_KS_operator(32, 32) is get_flat_KS_operator(32, 32)
+    assert get_flat_KS_operator(32, 32) is not get_flat_KS_operator(32, 16)
+
+@pytest.mark.parametrize('zero_padding', [0, 10])
+@pytest.mark.parametrize('sigma', [None, 1.5])
+def test_flat_ks_padding_smoothing(zero_padding, sigma):
+    # Equivalent to inverting the map embedded in a larger grid of zeros
+    gmap = random_shear_maps((2, 50, 50))
+    ks = FlatKSOperator(50, 50, zero_padding=zero_padding, sigma=sigma)
+    npx, npy = ks.padded_shape
+    assert npx == npy >= 50 + 2 * zero_padding
+    ox, oy = ks.offset
+
+    padded = np.zeros((2, npx, npy))
+    padded[:, ox:ox + 50, oy:oy + 50] = gmap
+    expected_e, expected_b = reference_flat_KS_map(padded, sigma)
+    kappa_e, kappa_b = ks(gmap)
+    assert_allclose(kappa_e, expected_e[ox:ox + 50, oy:oy + 50], rtol=0,
+                    atol=1e-13)
+    assert_allclose(kappa_b, expected_b[ox:ox + 50, oy:oy + 50], rtol=0,
+                    atol=1e-13)
+
+def test_fft_friendly_size():
+    assert [fft_friendly_size(n) for n in [1, 7, 11, 97, 128]] == \
+        [1, 8, 12, 100, 128]
+
+@pytest.fixture(scope='module')
+def masked_shear_map(shape_catalog):
+    """
+    Noisy 80x80 shear map with empty pixels, from a hole cut in the test
+    catalog
+    """
+    catalog = Table(read_catalog(shape_catalog, shear_map_columns),
+                    copy=False)
+    hole = np.hypot(catalog['ra'] - 20.5, catalog['dec'] + 9.5) < 0.4
+    projection = {'type': 'gnomonic', 'center_ra': 20., 'center_dec': -10.,
+                  'pixel_size': 2., 'nx': 80, 'ny': 80}
+    maps = compute_shear_map(catalog[~hole], projection)
+    assert (maps['nmap'] == 0).mean() > 0.05
+    return maps['gmap'], maps['nmap']
+
+@pytest.mark.parametrize('zero_padding', [0, 50])
+def test_masked_flat_ks_converges(masked_shear_map, zero_padding):
+    gmap, nmap = masked_shear_map
+    ks = FlatKSOperator(80, 80, zero_padding=zero_padding)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        kappa_e, kappa_b, info = ks.masked(gmap, nmap)
+    assert info['niter'] < 200 and info['residual'] <= 1e-5
+
+    # The solution is close to the fully converged one
+    expected_e, expected_b, _ = ks.masked(gmap, nmap, tol=1e-10,
+                                          max_iter=2000)
+    assert_allclose(kappa_e, expected_e, rtol=0, atol=1e-3 * expected_e.std())
+    assert_allclose(kappa_b, expected_b, rtol=0, atol=1e-3 * expected_e.std())
+
+    # Without the B mode prior, the preconditioner is the exact inverse
+    _, _, info = ks.masked(gmap, nmap, bmode_regularization=0.)
+    assert info['niter'] <= 2
+
+def test_masked_flat_ks_batched(masked_shear_map):
+    gmap, nmap = masked_shear_map
+    ks = FlatKSOperator(80, 80, zero_padding=16)
+    kappa_e, kappa_b, info = ks.masked(np.stack([gmap, 0.5 * gmap]), nmap)
+    for i, scale in enumerate([1., 0.5]):
+        e, b, _ = ks.masked(scale * gmap, nmap)
+        assert_allclose(kappa_e[i], e, rtol=0, atol=1e-12)
+        assert_allclose(kappa_b[i], b, rtol=0, atol=1e-12)
+
+    # Without padding, a warm start from the solution converges immediately
+    ks = FlatKSOperator(80, 80)
+    _, _, info = ks.masked(gmap, nmap)
+    _, _, warm = ks.masked(gmap, nmap, x0=info['x'])
+    assert warm['niter'] <= 1
+
+def test_masked_flat_ks_smoothing(masked_shear_map):
+    gmap, nmap = masked_shear_map
+    # Without smoothing a single kernel is kept
+    ks = FlatKSOperator(80, 80)
+    assert ks.ks_kernel is ks.kernel
+
+    # The smoothing is applied to the masked solution
+    smoothed = FlatKSOperator(80, 80, sigma=1.5)
+    assert smoothed._unsmoothed is None
+    kappa_e, kappa_b, info = smoothed.masked(gmap, nmap)
+    assert_allclose(smoothed.ks_kernel, ks.kernel, rtol=0, atol=1e-15)
+    # The conjugate kernel is computed once
+    assert smoothed.ks_kernel_conj is smoothed.ks_kernel_conj
+    assert_array_equal(smoothed.ks_kernel_conj, np.conj(smoothed.ks_kernel))
+    k1, k2 = np.meshgrid(np.fft.fftfreq(80), np.fft.fftfreq(80))
+    x = np.fft.fft2(info['x'][0] + 1j * info['x'][1])
+    x = np.fft.ifft2(x * np.exp(-2 * (np.pi * 1.5)**2 * (k1*k1 + k2*k2)))
+    assert_allclose(kappa_e, np.real(x), rtol=0, atol=1e-12)
+    assert_allclose(kappa_b, np.imag(x), rtol=0, atol=1e-12)
+
+def test_masked_flat_ks_warns(masked_shear_map):
+    gmap, nmap = masked_shear_map
+    ks = FlatKSOperator(80, 80, zero_padding=50)
+    with pytest.warns(UserWarning, match='did not converge in 3 iterations'):
+        _, _, info = ks.masked(gmap, nmap, max_iter=3)
+    assert info['niter'] == 3 and info['residual'] > 1e-5
+
+def reference_healpix_KS_map(gmap, lmax, sigma=None):
+    """
+    Original implementation of the spherical KS inversion, analysing a TQU
+    map with an empty temperature and synthesizing E and B separately
+    """
+    hp = pytest.importorskip('healpy')
+    nside = hp.npix2nside(gmap.shape[1])
+    if sigma is not None:
+        sigma = sigma / 60./180*np.pi
+    alms = hp.map2alm([np.zeros_like(gmap[0]), gmap[0], gmap[1]], lmax=lmax,
+                      pol=True)
+    ell, emm = hp.Alm.getlm(lmax=lmax)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fl = ((ell*(ell+1.))/((ell+2.)*(ell-1)))**0.5
+    fl[ell < 2] = 0
+    return [hp.alm2map(alm * fl, nside=nside, lmax=lmax, pol=False,
+                       sigma=sigma) for alm in alms[1:]]
+
+@pytest.mark.parametrize('sigma', [None, 30.])
+def test_healpix_ks_matches_reference(sigma):
+    gmap = random_shear_maps((2, 12 * 32**2))
+    kappa_e, kappa_b = healpix_KS_map(gmap, lmax=64, sigma=sigma)
+    expected_e, expected_b = reference_healpix_KS_map(gmap, 64, sigma)
+    scale = np.std(expected_e)
+    assert_allclose(kappa_e, expected_e, rtol=0, atol=1e-6 * scale)
+    assert_allclose(kappa_b, expected_b, rtol=0, atol=1e-6 * scale)
+
+def test_healpix_ks_smoothing_option():
+    # Smoothing is set in arcmin by the same option as the flat algorithms
+    gmap = random_shear_maps((2, 12 * 16**2))
+    expected_e, expected_b = healpix_KS_map(gmap, lmax=32, sigma=60.)
+    algorithm = {'name': 'healpix_ks', 'lmax': 32, 'smoothing': 60.}
+    kappa = compute_convergence_map({'gmap': gmap}, algorithm)
+    assert_allclose(kappa['kappa_e'], expected_e, rtol=0, atol=1e-15)
+
+    # The former sigma option is a deprecated alias
+    algorithm = {'name': 'healpix_ks', 'lmax': 32, 'sigma': 60.}
+    with pytest.warns(DeprecationWarning, match="use 'smoothing'"):
+        kappa = compute_convergence_map({'gmap': gmap}, algorithm)
+    assert_allclose(kappa['kappa_e'], expected_e, rtol=0, atol=1e-15)
+    assert_allclose(kappa['kappa_b'], expected_b, rtol=0, atol=1e-15)
+
+def test_healpix_ks_stack_and_partial():
+    gmaps = random_shear_maps((3, 2, 12 * 16**2))
+    kappa_e, kappa_b = healpix_KS_map(gmaps, lmax=32)
+    assert kappa_e.shape == (3, 12 * 16**2)
+    e, b = healpix_KS_map(gmaps[1], lmax=32)
+    assert_allclose(kappa_e[1], e, rtol=0, atol=1e-15)
+    assert_allclose(kappa_b[1], b, rtol=0, atol=1e-15)
+
+    # Partial sky maps are the full sky maps, empty outside of the pixels
+    pixels = np.arange(100, 1500, 3)
+    masked = np.zeros_like(gmaps[1])
+    masked[:, pixels] = gmaps[1][:, pixels]
+    e, b = healpix_KS_map(masked, lmax=32)
+    pe, pb = healpix_KS_map(gmaps[1][:, pixels], lmax=32, pixels=pixels,
+                            nside=16)
+    assert_allclose(pe, e[pixels], rtol=0, atol=1e-15)
+    assert_allclose(pb, b[pixels], rtol=0, atol=1e-15)
+
+@pytest.mark.parametrize('sigma', [None, 30.])
+def test_healpix_ks_threaded(sigma):
+    # The ducc0 transforms agree with the healpy ones
+    pytest.importorskip('ducc0')
+    gmaps = random_shear_maps((2, 2, 12 * 16**2))
+    expected_e, expected_b = healpix_KS_map(gmaps, lmax=32, sigma=sigma)
+    kappa_e, kappa_b = healpix_KS_map(gmaps, lmax=32, sigma=sigma,
+                                      nthreads=2)
+    scale = np.std(expected_e)
+    assert_allclose(kappa_e, expected_e, rtol=0, atol=1e-10 * scale)
+    assert_allclose(kappa_b, expected_b, rtol=0, atol=1e-10 * scale)
+
+    # Including partial sky maps
+    pixels = np.arange(100, 1500, 3)
+    expected_e, expected_b = healpix_KS_map(gmaps[0][:, pixels], lmax=32,
+                                            sigma=sigma, pixels=pixels,
+                                            nside=16)
+    kappa_e, kappa_b = healpix_KS_map(gmaps[0][:, pixels], lmax=32,
+                                      sigma=sigma, pixels=pixels, nside=16,
+                                      nthreads=2)
+    assert kappa_e.shape == (len(pixels),)
+    assert_allclose(kappa_e, expected_e, rtol=0, atol=1e-10 * scale)
+    assert_allclose(kappa_b, expected_b, rtol=0, atol=1e-10 * scale)
@@ -0,0 +1,152 @@
+# This module tests the HDF5 maps and their quick-look pyramids
+import numpy as np
+import h5py
+import pytest
+from astropy.io import fits
+from numpy.testing import assert_allclose, assert_array_equal
+
+from desc.wlmassmap.map_io import (default_pyramid_levels, downsample_map,
+                                   is_hdf5_filename, is_hdf5_map,
+                                   read_hdf5_map, read_partial_map,
+                                   write_hdf5_map)
+from desc.wlmassmap.shear_map import shear_map
+from desc.wlmassmap.convergence_map import convergence_map, read_shear_map
+
+def reference_downsample(values, weights):
+    """
+    Weighted mean of each block of 2x2 pixels, computed block by block
+    """
+    n1, n2 = values.shape[-2:]
+    mean = np.zeros(values.shape[:-2] + ((n1 + 1) // 2, (n2 + 1) // 2))
+    wsum = np.zeros(mean.shape[-2:])
+    for i in range(0, n1, 2):
+        for j in range(0, n2, 2):
+            w = weights[i:i + 2, j:j + 2]
+            wsum[i // 2, j // 2] = w.sum()
+            if w.sum() > 0:
+                mean[..., i // 2, j // 2] = (
+                    (values[..., i:i + 2, j:j + 2] * w).sum(axis=(-2, -1))
+                    / w.sum())
+    return mean, wsum
+
+@pytest.mark.parametrize('shape', [(8, 6), (7, 9)])
+def test_downsample_map(shape):
+    rng = np.random.default_rng(0)
+    values = rng.standard_normal((2,) + shape)
+    weights = rng.poisson(1., shape).astype(float)
+    mean, wsum = downsample_map(values, weights)
+    expected_mean, expected_wsum = reference_downsample(values, weights)
+    assert_allclose(mean, expected_mean, rtol=1e-12, atol=1e-15)
+    assert_array_equal(wsum[0], expected_wsum)
+
+    # Uniform weights by default
+    mean, _ = downsample_map(values[0])
+    assert_allclose(mean, reference_downsample(values[0],
+                                               np.ones(shape))[0])
+
+@pytest.fixture
+def flat_maps():
+    rng = np.random.default_rng(1)
+    nmap = rng.poisson(3., (300, 250))
+    gmap = 0.1 * rng.standard_normal((2, 300, 250)).astype(np.float32)
+    return gmap, nmap
+
+def test_hdf5_map_round_trip(flat_maps, tmp_path):
+    gmap, nmap = flat_maps
+    filename = str(tmp_path / 'map.h5')
+    assert is_hdf5_filename(filename) and not is_hdf5_filename('map.fits')
+    write_hdf5_map(filename, {'gmap': gmap, 'nmap': nmap}, weight='nmap',
+                   extra={'responsivity': np.eye(2)},
+                   attrs={'PIXSIZE': (2., 'Pixel size [arcmin]'),
+                          'NSIDE': None}, chunk_size=64)
+    assert is_hdf5_map(filename)
+
+    (g, n, R), attrs = read_hdf5_map(filename, ['gmap', 'nmap', 'responsivity'])
+    assert g.dtype == np.float32 and n.dtype == nmap.dtype
+    assert_array_equal(g, gmap)
+    assert_array_equal(n, nmap)
+    assert_array_equal(R, np.eye(2))
+    assert attrs['PIXSIZE'] == 2. and 'NSIDE' not in attrs
+    assert attrs['NLEVELS'] == default_pyramid_levels(nmap.shape) == 3
+    with h5py.File(filename, 'r') as f:
+        assert f['gmap'].chunks == (1, 64, 64)
+        assert f['gmap'].compression == 'gzip'
+
+    # Regions of the full resolution maps
+    region = ((70, 130), (10, 200))
+    (g,), _ = read_hdf5_map(filename, ['gmap'], region=region)
+    assert_array_equal(g, gmap[:, 70:130, 10:200])
+
+    # Coarse levels, the shear being averaged weighted by the counts
+    expected_g, expected_n = gmap, nmap
+    for level in range(1, 4):
+        expected_g, expected_n = reference_downsample(expected_g, expected_n)
+        (g, n), attrs = read_hdf5_map(filename, ['gmap', 'nmap'], level)
+        assert g.shape == (2,) + n.shape
+        assert n.shape == tuple(-(-s // 2**level) for s in nmap.shape)
+        assert attrs['PIXSIZE'] == 2. * 2**level
+        assert n.sum() == nmap.sum()
+        assert_array_equal(n, expected_n)
+        assert_allclose(g, expected_g, rtol=1e-5, atol=1e-7)
+
+        # Regions are widened to whole pixels of the level
+        (g_region,), _ = read_hdf5_map(filename, ['gmap'], level, region)
+        scale = 2**level
+        assert_array_equal(g_region,
+                           g[:, 70 // scale:-(-130 // scale),
+                             10 // scale:-(-200 // scale)])
+
+    with pytest.raises(ValueError):
+        read_hdf5_map(filename, ['gmap'], level=4)
+
+@pytest.mark.parametrize('projection', ['flat', 'partial'])
+def test_hdf5_stage_outputs(shape_catalog, flat_projection, projection,
+                            tmp_path):
+    if projection == 'flat':
+        c = flat_projection
+        algorithm = {'name': 'flat_ks', 'zero_padding': 16}
+    else:
+        c = {'type': 'healpix', 'nside': 64, 'partial': True}
+        algorithm = {'name': 'healpix_ks', 'lmax': 128}
+
+    kappa = {}
+    for ext in ['fits', 'h5']:
+        shear = {'input_filename': shape_catalog, 'projection': c,
+                 'output_filename': str(tmp_path / ('shear.%s' % ext)),
+                 'hdf5': {'chunk_size': 16}}
+        shear_map(shear)
+        config = {'input_filename': shear['output_filename'],
+                  'algorithm': algorithm,
+                  'output_filename': str(tmp_path / ('kappa.%s' % ext))}
+        convergence_map(config)
+        kappa[ext] = config['output_filename']
+
+    # The HDF5 shear maps hold the same maps as the FITS ones
+    fits_maps = read_shear_map(str(tmp_path / 'shear.fits'))
+    hdf5_maps = read_shear_map(str(tmp_path / 'shear.h5'))
+    assert sorted(fits_maps) == sorted(hdf5_maps)
+    for name, value in fits_maps.items():
+        assert_array_equal(np.asarray(hdf5_maps[name]), np.asarray(value))
+
+    # Convergence maps computed from either format are identical
+    (kappa_e, nmap), attrs = read_hdf5_map(kappa['h5'], ['kappa_e', 'nmap'])
+    assert_array_equal(nmap, fits_maps['nmap'])
+    if projection == 'flat':
+        assert_array_equal(kappa_e, fits.getdata(kappa['fits'], 0))
+        assert attrs['PIXSIZE'] == flat_projection['pixel_size']
+        assert attrs['NLEVELS'] == default_pyramid_levels(nmap.shape)
+    else:
+        pixels, (expected,), header = read_partial_map(kappa['fits'],
+                                                       ['KAPPA_E'])
+        (hdf5_pixels,), _ = read_hdf5_map(kappa['h5'], ['pixels'])
+        assert_array_equal(hdf5_pixels, pixels)
+        assert_array_equal(kappa_e, expected)
+        assert attrs['NSIDE'] == 64 and attrs['NLEVELS'] == 0
+
+        # HEALpix maps are chunked along their pixel axis
+        npix_obs = len(pixels)
+        with h5py.File(str(tmp_path / 'shear.h5'), 'r') as f:
+            assert f['gmap'].chunks == (1, min(256, npix_obs))
+            assert f['nmap'].chunks == (min(256, npix_obs),)
+        with h5py.File(kappa['h5'], 'r') as f:
+            assert f['kappa_e'].chunks == (min(256**2, npix_obs),)
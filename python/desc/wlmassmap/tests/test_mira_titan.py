@@ -0,0 +1,57 @@
+# This module tests the reader of the Mira Titan tomographic files
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+from astropy.table import Table
+
+pytest.importorskip('GCR')
+from concurrent.futures import ThreadPoolExecutor
+from desc.wlmassmap.mocks.MiraTitanCatalog import MiraTitanCatalog, _TomoFile
+
+columns = ['ra_arcmin', 'dec_arcmin', 'z_spec', 'shear1', 'shear2']
+
+@pytest.fixture
+def tomo_files(tmp_path):
+    """
+    Three tomographic FITS files, stored in big endian byte order
+    """
+    rng = np.random.default_rng(0)
+    tables = []
+    for i in range(1, 4):
+        t = Table({c: rng.random(1000 * i) for c in columns})
+        t.write(str(tmp_path / ('MT_LSST_tomo%d.fits' % i)))
+        tables.append(t)
+    return str(tmp_path), tables
+
+@pytest.mark.parametrize('prefetch', [0, 1, 3])
+def test_quantities(tomo_files, prefetch):
+    directory, tables = tomo_files
+    catalog = MiraTitanCatalog(catalog_main_dir=directory, nbins=3,
+                               prefetch=prefetch)
+    data = catalog.get_quantities(['ra', 'shear_1', 'redshift', 'galaxy_id'])
+    for q, c in [('ra', 'ra_arcmin'), ('shear_1', 'shear1'),
+                 ('redshift', 'z_spec')]:
+        assert_array_equal(data[q], np.concatenate([t[c] for t in tables]))
+        assert data[q].dtype.isnative
+    assert_array_equal(data['galaxy_id'], 0)
+
+    # Native chunks are the tomographic bins
+    chunks = catalog.get_quantities(['shear_2'], return_iterator=True)
+    assert [len(chunk['shear_2']) for chunk in chunks] == [1000, 2000, 3000]
+
+def test_prefetch(tomo_files):
+    directory, tables = tomo_files
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        datasets = [_TomoFile(i, '%s/MT_LSST_tomo%d.fits' % (directory, i),
+                              pool) for i in [1, 2]]
+        datasets[0].following = datasets[1:]
+
+        # Fetching a column of the first bin reads it from the second one
+        assert_array_equal(datasets[0].fetch('shear1'), tables[0]['shear1'])
+        assert list(datasets[1]._futures) == ['shear1']
+        assert_array_equal(datasets[1].fetch('shear1'), tables[1]['shear1'])
+        assert datasets[1]._futures == {}
+
+        for dataset in datasets:
+            dataset.close()
+            assert dataset._reader is None
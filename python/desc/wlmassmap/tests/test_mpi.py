@@ -0,0 +1,59 @@
+# This module tests that shear maps distributed over MPI processes match the
+# serial maps, running the processes with mpiexec
+import os
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+
+from desc.wlmassmap.shear_map import stream_shear_map
+
+python_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.dirname(os.path.abspath(__file__)))))
+
+script = """
+import sys, yaml
+import numpy as np
+from mpi4py import MPI
+from desc.wlmassmap.shear_map import stream_shear_map
+
+filename, output = sys.argv[1], sys.argv[2]
+projection = yaml.safe_load(sys.argv[3])
+assert MPI.COMM_WORLD.size == 3
+maps = stream_shear_map(filename, projection, 7919, comm=MPI.COMM_WORLD)
+if MPI.COMM_WORLD.rank == 0:
+    np.savez(output, **{k: v for k, v in maps.items() if v is not None})
+else:
+    assert maps is None
+"""
+
+projections = {
+    'flat': {'type': 'gnomonic', 'center_ra': 20., 'center_dec': -10.,
+             'pixel_size': 4., 'nx': 60, 'ny': 50},
+    'partial': {'type': 'healpix', 'nside': 64, 'partial': True},
+}
+
+@pytest.mark.parametrize('kind', sorted(projections))
+def test_mpi_matches_serial(shape_catalog, tmp_path, kind):
+    pytest.importorskip('mpi4py')
+    if shutil.which('mpiexec') is None:
+        pytest.skip("mpiexec is not available")
+    import yaml
+
+    projection = projections[kind]
+    output = str(tmp_path / 'maps.npz')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([python_dir, env.get('PYTHONPATH', '')])
+    subprocess.run(['mpiexec', '-n', '3', sys.executable, '-c', script,
+                    shape_catalog, output, yaml.safe_dump(projection)],
+                   env=env, check=True, timeout=300)
+
+    maps = stream_shear_map(shape_catalog, projection, 7919)
+    with np.load(output) as distributed:
+        assert_array_equal(distributed['nmap'], maps['nmap'])
+        assert_allclose(distributed['gmap'], maps['gmap'], rtol=0, atol=1e-12)
+        if kind == 'partial':
+            assert_array_equal(distributed['pixels'], maps['pixels'])
@@ -0,0 +1,70 @@
+# This module tests the randomized realizations of the convergence maps
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+from astropy.table import Table
+
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.shear_map import shear_map_columns
+from desc.wlmassmap.noise_realizations import (ShearRealizations,
+                                               compute_noise_realizations)
+
+def random_catalog(n=5000, npix=40, seed=0):
+    rng = np.random.default_rng(seed)
+    pixel_index = rng.integers(-1, npix, n)
+    g = rng.normal(0, 0.3, (n, 2))
+    return pixel_index, g, npix
+
+@pytest.mark.parametrize('kind', ['rotation', 'noise'])
+def test_realizations_independent_of_batch(kind):
+    pixel_index, g, npix = random_catalog()
+    reference = ShearRealizations(pixel_index, g, npix, kind, 0.2, seed=42,
+                                  batch_size=1)
+    reference = np.concatenate([reference(i, i + 1) for i in range(11)])
+    for batch_size in [4, 16]:
+        realizations = ShearRealizations(pixel_index, g, npix, kind, 0.2,
+                                         seed=42, batch_size=batch_size)
+        gmap = np.concatenate([realizations(start, min(start + batch_size, 11))
+                               for start in range(0, 11, batch_size)])
+        assert_allclose(gmap, reference, rtol=1e-12, atol=1e-15)
+
+    # Realizations differ from each other and with the seed
+    assert not np.allclose(reference[0], reference[1])
+    other = ShearRealizations(pixel_index, g, npix, kind, 0.2, seed=43)
+    assert not np.allclose(other(0, 1)[0], reference[0])
+
+def test_rotation_binning():
+    pixel_index, g, npix = random_catalog()
+    realizations = ShearRealizations(pixel_index, g, npix, 'rotation',
+                                     seed=1, batch_size=2)
+    gmap = realizations(0, 2)
+
+    # Each realization is the mean rotated shear in each pixel, rotations
+    # preserving the modulus of the shear of each galaxy
+    sel = pixel_index >= 0
+    nmap = np.bincount(pixel_index[sel], minlength=npix)
+    assert_array_equal(realizations.nmap, nmap)
+    for j in range(2):
+        w1, w2 = np.empty(sel.sum()), np.empty(sel.sum())
+        realizations._draw(j, w1, w2)
+        assert_allclose(np.hypot(w1, w2), np.hypot(g[sel, 0], g[sel, 1]))
+        for k, w in enumerate([w1, w2]):
+            mean = np.bincount(pixel_index[sel], weights=w, minlength=npix)
+            mean[nmap > 0] /= nmap[nmap > 0]
+            assert_allclose(gmap[j, k], mean, atol=1e-14)
+
+def test_noise_realizations_independent_of_batch(shape_catalog,
+                                                 flat_projection):
+    catalog = Table(read_catalog(shape_catalog, shear_map_columns),
+                    copy=False)
+    algorithm = {'name': 'flat_ks', 'zero_padding': 8}
+    kappa = [compute_noise_realizations(catalog, flat_projection, algorithm, 5,
+                                        seed=7, batch_size=batch_size)
+             for batch_size in [1, 2, 5]]
+    shape = (5, flat_projection['ny'], flat_projection['nx'])
+    for k in kappa[1:]:
+        assert k['kappa_e'].shape == shape
+        assert_allclose(k['kappa_e'], kappa[0]['kappa_e'], atol=1e-12)
+        assert_allclose(k['kappa_b'], kappa[0]['kappa_b'], atol=1e-12)
+        assert_array_equal(k['nmap'], kappa[0]['nmap'])
+    assert kappa[0]['info']['NREAL'][0] == 5
@@ -0,0 +1,103 @@
+# This module tests the in-memory pipeline runner
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+from astropy.io import fits
+from astropy.table import Table
+
+from desc.wlmassmap.pipeline import run_pipeline
+from desc.wlmassmap.mocks.mock_observation import mock_observation
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.shear_map import (shear_map, shear_map_columns,
+                                      stream_shear_map)
+from desc.wlmassmap.convergence_map import convergence_map, read_shear_map
+from desc.wlmassmap.map_io import read_partial_map
+
+def test_pipeline_matches_stages(truth_catalog, flat_projection, tmp_path):
+    mock = {'input_filename': truth_catalog,
+            'output_filename': str(tmp_path / 'shape.hdf5'),
+            'reduced_shear': True,
+            'shape_noise': {'type': 'Gaussian', 'sigma': 0.26, 'seed': 1},
+            'format': {'type': 'metacal'}}
+    shear = {'input_filename': mock['output_filename'],
+             'projection': flat_projection,
+             'output_filename': str(tmp_path / 'shear_map.fits')}
+    kappa = {'input_filename': shear['output_filename'],
+             'algorithm': {'name': 'flat_ks', 'zero_padding': 16},
+             'output_filename': str(tmp_path / 'kappa.fits')}
+
+    # Stages chained through files
+    mock_observation(mock)
+    shear_map(shear)
+    convergence_map(kappa)
+
+    # Stages chained in memory, only the first one reads its input
+    config = {'mock_observation': dict(mock, output_filename=None),
+              'shear_map': dict(shear, input_filename=None,
+                                output_filename=None),
+              'convergence_map': dict(kappa, input_filename=None,
+                                      output_filename=None)}
+    products = run_pipeline(config)
+    assert sorted(products) == ['convergence_map', 'shape_catalog',
+                                'shear_map']
+
+    maps = products['shear_map']
+    assert_array_equal(maps['nmap'], fits.getdata(shear['output_filename'], 1))
+    assert_allclose(maps['gmap'], fits.getdata(shear['output_filename'], 0),
+                    rtol=0, atol=1e-15)
+    kappa_e = products['convergence_map']['kappa_e']
+    assert_allclose(kappa_e, fits.getdata(kappa['output_filename'], 0),
+                    rtol=0, atol=1e-14)
+
+    # The pipeline can start from an in-memory product
+    products = run_pipeline({'convergence_map': config['convergence_map']},
+                            shear_map=maps)
+    assert_allclose(products['convergence_map']['kappa_e'], kappa_e,
+                    rtol=0, atol=1e-15)
+
+@pytest.mark.parametrize('algorithm', [{'name': 'flat_ks', 'zero_padding': 16},
+                                       {'name': 'flat_ks', 'smoothing': 8.}])
+def test_single_precision(shape_catalog, flat_projection, algorithm,
+                          tmp_path):
+    catalog = Table(read_catalog(shape_catalog, shear_map_columns), copy=False)
+    config = {'shear_map': {'projection': flat_projection},
+              'convergence_map': {'algorithm': algorithm}}
+    reference = run_pipeline(dict(config, dtype='float64'),
+                             shape_catalog=catalog)
+    products = run_pipeline(dict(config, dtype='float32'),
+                            shape_catalog=catalog)
+
+    # Galaxy counts are unchanged, maps only differ by rounding
+    maps = products['shear_map']
+    assert maps['gmap'].dtype == np.float32
+    assert_array_equal(maps['nmap'], reference['shear_map']['nmap'])
+    assert_allclose(maps['gmap'], reference['shear_map']['gmap'], rtol=0,
+                    atol=1e-6 * reference['shear_map']['gmap'].std())
+    for name in ['kappa_e', 'kappa_b']:
+        kappa = products['convergence_map'][name]
+        expected = reference['convergence_map'][name]
+        assert kappa.dtype == np.float32
+        assert_allclose(kappa, expected, rtol=0, atol=2e-6 * expected.std())
+
+    # Streamed maps are accumulated in double precision as well
+    streamed = stream_shear_map(shape_catalog, flat_projection, 10007,
+                                dtype='float32')
+    assert streamed['gmap'].dtype == np.float32
+    assert_array_equal(streamed['nmap'], maps['nmap'])
+    assert_allclose(streamed['gmap'], maps['gmap'], rtol=0,
+                    atol=1e-6 * maps['gmap'].std())
+
+    # Partial sky maps are saved and read back in single precision
+    shear = {'input_filename': shape_catalog, 'dtype': 'float32',
+             'projection': {'type': 'healpix', 'nside': 64, 'partial': True},
+             'output_filename': str(tmp_path / 'shear_map.fits')}
+    kappa = {'input_filename': shear['output_filename'],
+             'algorithm': {'name': 'healpix_ks', 'lmax': 128},
+             'output_filename': str(tmp_path / 'kappa.fits')}
+    shear_map(shear)
+    convergence_map(kappa)
+    maps = read_shear_map(shear['output_filename'])
+    assert maps['gmap'].dtype == np.float32
+    _, (kappa_e, kappa_b), _ = read_partial_map(kappa['output_filename'],
+                                                ['KAPPA_E', 'KAPPA_B'])
+    assert kappa_e.dtype == kappa_b.dtype == np.float32
@@ -0,0 +1,32 @@
+# This module tests the projection of catalogs on flat and HEALpix maps
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+
+from desc.wlmassmap.projection import flat_grid, flat_pixel_index
+from desc.wlmassmap.projection_utils import radec2xy
+
+def test_flat_pixel_index_matches_binning():
+    # Same pixels as the 2D histogram binning of the projected coordinates,
+    # galaxies outside of the map are flagged
+    stats = pytest.importorskip('scipy.stats')
+    rng = np.random.default_rng(1)
+    ra = rng.uniform(17., 23., 200000)
+    dec = rng.uniform(-13., -7., 200000)
+    nx, ny = 60, 50
+    edges_x, edges_y, _, _ = flat_grid(nx, ny, 4., 20., -10.)
+    pixel_index = flat_pixel_index(ra, dec, edges_x, edges_y, 20., -10.)
+
+    x, y = radec2xy(20., -10., ra, dec)
+    sel = ((x >= edges_x[0]) & (x < edges_x[-1]) &
+           (y >= edges_y[0]) & (y < edges_y[-1]))
+    assert_array_equal(pixel_index >= 0, sel)
+    assert 0 < sel.sum() < len(sel)
+
+    binnumber = stats.binned_statistic_2d(x[sel], y[sel], None, 'count',
+                                          bins=(edges_x, edges_y),
+                                          expand_binnumbers=True)[3] - 1
+    expected = binnumber[1] * nx + binnumber[0]
+    # Galaxies on the edge of a pixel may fall on either side
+    mismatch = pixel_index[sel] != expected
+    assert mismatch.sum() <= 1e-4 * sel.sum()
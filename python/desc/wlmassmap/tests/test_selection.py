@@ -0,0 +1,73 @@
+# This module tests the compiled selection cuts
+import numpy as np
+from numpy.testing import assert_array_equal
+import pytest
+from astropy.table import Table
+
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.selection import CutExpression, selection, selection_mask
+
+cuts = ["shape['mcal_g'][:,0] > -0.2",
+        "abs(shape['mcal_g'][:,1]) < 0.3",
+        "(np.sqrt(shape['ra']**2 + shape['dec']**2) > 21.) | "
+        "~(shape['redshift'] < 0.4)",
+        "np.isfinite(shape['mcal_g_1p'][:,0])"]
+
+def test_cuts_match_eval(shape_catalog):
+    shape = read_catalog(shape_catalog)
+    expected = np.ones(len(shape['ra']), dtype='bool')
+    for cut in cuts:
+        expected &= eval(cut)
+    assert 0 < expected.sum() < len(expected)
+
+    expression = CutExpression(cuts)
+    assert sorted(expression.columns) == sorted(['mcal_g', 'ra', 'dec',
+                                                 'redshift', 'mcal_g_1p'])
+    assert_array_equal(expression(shape), expected)
+
+@pytest.mark.parametrize('cut', [
+    "__import__('os').system('true')",
+    "shape.__class__",
+    "open('catalog.fits')",
+    "np.load('catalog.npy')",
+    "shape[0] > 1",
+    "(lambda x: x)(shape['ra']) > 0",
+    "[x for x in shape['ra']]",
+    "abs(shape['ra'], out=shape['dec'])",
+    "shape['ra'].sum() > 0",
+])
+def test_unsafe_cuts_are_rejected(cut):
+    with pytest.raises(ValueError):
+        CutExpression([cut])
+
+@pytest.mark.parametrize('constant', ["1 > 2", "False", "abs(-1) < 0"])
+def test_constant_cuts(shape_catalog, constant):
+    # Cuts that reference no column still apply to every row
+    nrows = len(read_catalog(shape_catalog, ['ra'])['ra'])
+    mask = selection_mask(shape_catalog, [constant], chunk_size=10007)
+    assert mask.shape == (nrows,) and not mask.any()
+    assert selection_mask(shape_catalog, ["2 > 1"]).all()
+
+    # Combined with column cuts
+    expected = selection_mask(shape_catalog, cuts[:1])
+    assert_array_equal(selection_mask(shape_catalog, cuts[:1] + ["True"]),
+                       expected)
+    assert not selection_mask(shape_catalog, cuts[:1] + [constant]).any()
+
+@pytest.mark.parametrize('fmt', ['hdf5', 'fits'])
+def test_selection_streams_selected_rows(shape_catalog, tmp_path, fmt):
+    catalog = read_catalog(shape_catalog)
+    input_filename = shape_catalog
+    if fmt == 'fits':
+        input_filename = str(tmp_path / 'shape.fits')
+        Table(catalog).write(input_filename)
+    output_filename = str(tmp_path / ('selected.' + fmt))
+
+    selection({'input_filename': input_filename, 'cuts': cuts,
+               'output_filename': output_filename, 'chunk_size': 10007})
+
+    mask = CutExpression(cuts)(catalog)
+    selected = read_catalog(output_filename)
+    assert sorted(selected) == sorted(catalog)
+    for name in catalog:
+        assert_array_equal(selected[name], catalog[name][mask])
@@ -0,0 +1,138 @@
+# This module tests the construction of shear maps
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+from astropy.table import Table
+
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.shear_map import (compute_shear_map, stream_shear_map,
+                                      shear_map_columns, write_shear_map,
+                                      accumulate_shear_map,
+                                      accumulate_sparse_shear_map,
+                                      merge_sparse_shear_maps,
+                                      stream_responsivity)
+from desc.wlmassmap.convergence_map import read_shear_map
+
+healpix_projection = {'type': 'healpix', 'nside': 64}
+
+def load_catalog(filename, columns=shear_map_columns):
+    return Table(read_catalog(filename, columns), copy=False)
+
+@pytest.mark.parametrize('kind', ['flat', 'healpix'])
+def test_stream_matches_in_memory(shape_catalog, flat_projection, kind):
+    projection = flat_projection if kind == 'flat' else healpix_projection
+    maps = compute_shear_map(load_catalog(shape_catalog), projection)
+
+    # Chunks not aligned with the blocks of the catalog
+    streamed = stream_shear_map(shape_catalog, projection, chunk_size=10007)
+    assert_array_equal(streamed['nmap'], maps['nmap'])
+    assert_allclose(streamed['gmap'], maps['gmap'], rtol=0, atol=1e-12)
+    assert maps['nmap'].sum() > 0
+
+tomography = {'column': 'redshift', 'edges': [0.2, 0.5, 0.8, 1.5]}
+
+def test_tomography_matches_single_bins(shape_catalog, flat_projection):
+    # Maps of all bins built in a single pass match the maps of each bin,
+    # calibrated with the responsivity of the bin
+    catalog = load_catalog(shape_catalog, shear_map_columns + ['redshift'])
+    maps = compute_shear_map(catalog.copy(), flat_projection, tomography)
+    assert maps['gmap'].shape == (3, 2, 50, 60)
+    assert maps['nmap'].shape == (3, 50, 60)
+
+    z = np.asarray(catalog['redshift'])
+    edges = tomography['edges']
+    for i in range(3):
+        sel = (z >= edges[i]) & (z < edges[i + 1])
+        expected = compute_shear_map(catalog[sel], flat_projection)
+        assert_array_equal(maps['nmap'][i], expected['nmap'])
+        assert_allclose(maps['gmap'][i], expected['gmap'], rtol=0, atol=1e-12)
+
+    streamed = stream_shear_map(shape_catalog, flat_projection, 10007,
+                                tomography=tomography)
+    assert_array_equal(streamed['nmap'], maps['nmap'])
+    assert_allclose(streamed['gmap'], maps['gmap'], rtol=0, atol=1e-12)
+
+def test_tomography_requires_bins(shape_catalog, flat_projection):
+    catalog = load_catalog(shape_catalog, shear_map_columns + ['redshift'])
+    with pytest.raises(ValueError):
+        compute_shear_map(catalog, flat_projection,
+                          {'column': 'redshift', 'edges': [0.5]})
+
+@pytest.mark.parametrize('tomo', [None, tomography])
+def test_empty_selection(shape_catalog, flat_projection, tmp_path, tomo):
+    # No rows read, e.g. by an MPI process with an empty range
+    R = stream_responsivity(shape_catalog, 1000, tomography=tomo,
+                            start=0, stop=0)
+    assert R.shape == ((2, 2) if tomo is None else (3, 2, 2))
+    assert_array_equal(R, 0)
+
+    # Empty catalogs give empty maps
+    filename = str(tmp_path / 'empty.fits')
+    load_catalog(shape_catalog, shear_map_columns + ['redshift'])[:0].write(
+        filename)
+    for projection in [flat_projection, dict(healpix_projection, partial=True)]:
+        maps = stream_shear_map(filename, projection, 1000, tomography=tomo)
+        assert maps['nmap'].sum() == 0
+        assert_array_equal(maps['gmap'], 0)
+
+def test_merge_sparse_shear_maps():
+    # Merging sparse sums of chunks gives the dense sums of the catalog
+    rng = np.random.default_rng(2)
+    npix = 1000
+    index = rng.integers(-1, npix, 5000)
+    index[rng.random(5000) < 0.5] //= 10
+    g = rng.standard_normal((5000, 2))
+
+    chunks = [accumulate_sparse_shear_map(index[start:start + 700],
+                                          g[start:start + 700])
+              for start in range(0, 5000, 700)]
+    # The chunks share pixels
+    assert len(np.intersect1d(chunks[0][0], chunks[1][0])) > 0
+
+    dense = accumulate_shear_map(index, g, npix)
+    expected = np.nonzero(dense[2])[0]
+
+    # In both orders, small chunks merged into the map and conversely
+    forward = chunks[0]
+    backward = chunks[-1]
+    for chunk in chunks[1:]:
+        forward = merge_sparse_shear_maps(forward, chunk)
+    for chunk in chunks[-2::-1]:
+        backward = merge_sparse_shear_maps(chunk, backward)
+    for sums in [forward, backward]:
+        pixels = sums[0]
+        assert_array_equal(pixels, expected)
+        for x, y in zip(sums[1:], dense):
+            assert_allclose(x, y[pixels], rtol=1e-12)
+
+    # Accumulating into the merged sums is equivalent
+    sums = None
+    for start in range(0, 5000, 700):
+        sums = accumulate_sparse_shear_map(index[start:start + 700],
+                                           g[start:start + 700], acc=sums)
+    for x, y in zip(sums, forward):
+        assert_allclose(x, y, rtol=1e-12)
+
+def test_partial_sky_map(shape_catalog, tmp_path):
+    projection = dict(healpix_projection, partial=True)
+    maps = compute_shear_map(load_catalog(shape_catalog), projection)
+    full = compute_shear_map(load_catalog(shape_catalog), healpix_projection)
+    pixels = maps['pixels']
+
+    # Same values as the full sky map on the observed pixels only
+    assert_array_equal(pixels, np.nonzero(full['nmap'])[0])
+    assert_array_equal(maps['nmap'], full['nmap'][pixels])
+    assert_allclose(maps['gmap'], full['gmap'][:, pixels], rtol=0, atol=1e-15)
+
+    streamed = stream_shear_map(shape_catalog, projection, chunk_size=10007)
+    assert_array_equal(streamed['pixels'], pixels)
+    assert_allclose(streamed['gmap'], maps['gmap'], rtol=0, atol=1e-12)
+
+    # Written as a partial sky table and read back
+    filename = str(tmp_path / 'partial.fits')
+    write_shear_map(filename, **maps)
+    read = read_shear_map(filename)
+    assert_array_equal(read['pixels'], pixels)
+    assert_array_equal(read['nmap'], maps['nmap'])
+    assert_array_equal(read['gmap'], maps['gmap'])
+    assert read['nside'] == 64
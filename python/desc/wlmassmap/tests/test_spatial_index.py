@@ -0,0 +1,152 @@
+# This module tests the spatial index of the sorted catalogs
+import numpy as np
+import healpy as hp
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+from astropy.table import Table
+
+from desc.wlmassmap.catalog_io import CatalogReader, read_catalog
+from desc.wlmassmap.shear_map import shear_map
+from desc.wlmassmap.convergence_map import read_shear_map
+from desc.wlmassmap.spatial_index import (SpatialIndex, build_spatial_index,
+                                          patch_pixels, read_flat_map_region)
+
+# Flat map of a region smaller than the test catalogs
+projection = {'type': 'gnomonic', 'center_ra': 19.5, 'center_dec': -10.5,
+              'pixel_size': 2., 'nx': 40, 'ny': 30}
+
+@pytest.mark.parametrize('nest', [False, True])
+@pytest.mark.parametrize('ra_range', [[18., 22.], [350., 10.], [0., 360.],
+                                      [100., 300.]])
+@pytest.mark.parametrize('dec_range', [[-12., -8.], [-10., 40.], [70., 89.]])
+def test_patch_pixels(ra_range, dec_range, nest):
+    nside = 32
+    rng = np.random.default_rng(0)
+    width = ra_range[1] - ra_range[0]
+    if width < 360.:
+        width %= 360.
+    ra = (ra_range[0] + width * rng.random(500000)) % 360.
+    # Uniform on the sphere, so that small pixels near the poles are hit
+    dec = np.rad2deg(np.arcsin(rng.uniform(*np.sin(np.deg2rad(dec_range)),
+                                           500000)))
+    expected = np.unique(hp.ang2pix(nside, ra, dec, nest=nest, lonlat=True))
+
+    pixels = patch_pixels(ra_range, dec_range, nside, nest=nest)
+    assert len(np.unique(pixels)) == len(pixels)
+    assert np.all(np.isin(expected, pixels))
+    # Away from the poles, a margin of about one pixel is added around the
+    # patch
+    if max(np.abs(dec_range)) < 60.:
+        assert len(pixels) <= 1.5 * len(expected) + 16
+
+@pytest.fixture(scope='module')
+def sorted_catalog(shape_catalog, tmp_path_factory):
+    """
+    Shape catalog sorted by `build_spatial_index`, gathering the rows of a
+    chunked HDF5 catalog by windows smaller than its chunks
+    """
+    filename = str(tmp_path_factory.mktemp('index') / 'sorted.hdf5')
+    build_spatial_index(shape_catalog, filename, nside=64, chunk_size=40000)
+    return filename
+
+@pytest.mark.parametrize('input_format', ['hdf5', 'fits'])
+def test_build_spatial_index(shape_catalog, sorted_catalog, input_format,
+                             tmp_path):
+    catalog = read_catalog(shape_catalog)
+    filename = sorted_catalog
+    if input_format == 'fits':
+        # Memory mapped input, in big endian byte order
+        Table(catalog).write(str(tmp_path / 'shape.fits'))
+        filename = str(tmp_path / 'sorted.hdf5')
+        build_spatial_index(str(tmp_path / 'shape.fits'), filename, nside=64,
+                            chunk_size=40000)
+    data = read_catalog(filename)
+
+    # The sorted catalog is a stable permutation of the input, by pixel
+    pixels = hp.ang2pix(64, catalog['ra'], catalog['dec'], nest=True,
+                        lonlat=True)
+    order = np.argsort(pixels, kind='stable')
+    assert list(data) == list(catalog)
+    for name in catalog:
+        assert data[name].dtype.isnative
+        assert_array_equal(data[name], catalog[name][order])
+
+    index = SpatialIndex(filename)
+    assert index.nrows == len(pixels)
+    assert_array_equal(index.pixels, np.unique(pixels))
+    assert_array_equal(index.stops - index.starts,
+                       np.bincount(pixels)[index.pixels])
+
+def test_take(shape_catalog):
+    rows = np.unique(np.random.default_rng(1).integers(0, 150000, 5000))
+    catalog = read_catalog(shape_catalog, ['ra', 'mcal_g'])
+    with CatalogReader(shape_catalog) as reader:
+        data = reader.take(rows, ['ra', 'mcal_g'])
+        assert_array_equal(data['ra'], catalog['ra'][rows])
+        assert_array_equal(data['mcal_g'], catalog['mcal_g'][rows])
+        assert len(reader.take([], ['ra'])['ra']) == 0
+
+def test_region_queries(sorted_catalog):
+    catalog = read_catalog(sorted_catalog, ['ra', 'dec'])
+    index = SpatialIndex(sorted_catalog)
+    vec = hp.ang2vec(catalog['ra'], catalog['dec'], lonlat=True)
+
+    def selected(ranges):
+        sel = np.zeros(len(catalog['ra']), dtype=bool)
+        for start, stop in ranges:
+            sel[start:stop] = True
+        return sel
+
+    # Queries return all the galaxies of the region
+    ranges = index.query_disc(20., -10., 1.)
+    center = hp.ang2vec(20., -10., lonlat=True)
+    inside = np.dot(vec, center) >= np.cos(np.deg2rad(1.))
+    assert inside.any()
+    assert np.all(selected(ranges)[inside])
+    assert np.all(np.diff(ranges.ravel()) > 0)
+
+    ranges = index.query_patch([19., 21.], [-11., -9.])
+    inside = ((catalog['ra'] > 19.) & (catalog['ra'] < 21.) &
+              (catalog['dec'] > -11.) & (catalog['dec'] < -9.))
+    assert np.all(selected(ranges)[inside])
+
+    data = index.read(ranges, ['ra'])
+    assert_array_equal(data['ra'], catalog['ra'][selected(ranges)])
+
+def test_flat_map_region(sorted_catalog):
+    catalog = read_catalog(sorted_catalog, ['ra', 'dec'])
+    data = read_flat_map_region(sorted_catalog, projection, ['ra', 'dec'])
+    assert len(data['ra']) < len(catalog['ra'])
+    inside = ((np.abs(catalog['ra'] - 19.5) < 0.7) &
+              (np.abs(catalog['dec'] + 10.5) < 0.5))
+    assert inside.any()
+    assert np.all(np.isin(catalog['ra'][inside], data['ra']))
+
+def test_shear_map_spatial_index(shape_catalog, tmp_path):
+    # Catalog whose responsivity varies with ra, so that the mean
+    # responsivity of the map region differs from the one of the catalog
+    catalog = Table(read_catalog(shape_catalog))
+    R = 1. + 0.25 * (catalog['ra'] - 20.)
+    for i in range(2):
+        dg = np.zeros((len(catalog), 2))
+        dg[:, i] = 0.01 * R
+        catalog['mcal_g_%dp' % (i + 1)] = catalog['mcal_g'] + dg
+        catalog['mcal_g_%dm' % (i + 1)] = catalog['mcal_g'] - dg
+    catalog.write(str(tmp_path / 'shape.fits'))
+    filename = str(tmp_path / 'sorted.hdf5')
+    build_spatial_index(str(tmp_path / 'shape.fits'), filename, nside=64)
+
+    tomography = {'column': 'redshift', 'edges': [0., 0.5, 1., 3.]}
+    for tomo in [None, tomography]:
+        maps = []
+        for index in [False, True]:
+            config = {'input_filename': filename,
+                      'projection': projection, 'tomography': tomo,
+                      'spatial_index': index,
+                      'output_filename': str(tmp_path / ('map%d%d.fits' %
+                                                         (tomo is None, index)))}
+            shear_map(config)
+            maps.append(read_shear_map(config['output_filename']))
+        assert_allclose(maps[1]['gmap'], maps[0]['gmap'], rtol=1e-10,
+                        atol=1e-15)
+        assert_array_equal(maps[1]['nmap'], maps[0]['nmap'])
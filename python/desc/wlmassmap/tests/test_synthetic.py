@@ -0,0 +1,33 @@
+# This module tests the synthetic catalogs used by the benchmarks
+import numpy as np
+from numpy.testing import assert_array_equal
+import healpy as hp
+
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.mocks.synthetic import (synthetic_catalog,
+                                            write_synthetic_catalog,
+                                            healpix_footprint,
+                                            sample_footprint)
+
+patch = {'type': 'patch', 'ra_range': [18., 22.], 'dec_range': [-12., -8.]}
+
+def test_catalog_does_not_depend_on_chunks(tmp_path):
+    catalog = synthetic_catalog(150000, patch, kind='shape')
+    filename = str(tmp_path / 'shape.hdf5')
+    write_synthetic_catalog(filename, 150000, patch, kind='shape',
+                            chunk_size=65536)
+    written = read_catalog(filename)
+    for name in catalog.colnames:
+        assert_array_equal(written[name], catalog[name])
+
+    # Galaxies are drawn within the patch
+    assert np.all((catalog['ra'] >= 18.) & (catalog['ra'] <= 22.))
+    assert np.all((catalog['dec'] >= -12.) & (catalog['dec'] <= -8.))
+
+def test_healpix_footprint_sampling():
+    footprint = healpix_footprint(32, 40., -30., 5.)
+    ra, dec = sample_footprint(np.random.default_rng(0), 10000, footprint)
+    pixels = hp.ang2pix(32, ra, dec, lonlat=True)
+    assert np.all(np.isin(pixels, footprint['pixels']))
+    # All the pixels of the footprint are sampled
+    assert len(np.unique(pixels)) == len(footprint['pixels'])
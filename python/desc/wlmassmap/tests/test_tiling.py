@@ -0,0 +1,99 @@
+# This module tests the tiled wide field convergence maps
+import numpy as np
+import healpy as hp
+import pytest
+from numpy.testing import assert_allclose, assert_array_equal
+from astropy.io import fits
+from astropy.table import Table
+
+from desc.wlmassmap.catalog_io import read_catalog
+from desc.wlmassmap.map_io import read_partial_map
+from desc.wlmassmap.projection import flat_grid, flat_pixel_index
+from desc.wlmassmap.shear_map import shear_map_columns, compute_shear_map
+from desc.wlmassmap.convergence_map import compute_convergence_map
+from desc.wlmassmap.tiling import (TileLookup, iter_tiled_convergence_maps,
+                                   tiled_convergence_map, tile_size)
+
+tiling = {'tile_nside': 16, 'pixel_size': 4., 'overlap': 30.}
+algorithm = {'name': 'flat_ks', 'zero_padding': 16, 'smoothing': 8.}
+
+@pytest.fixture(scope='module')
+def catalog(shape_catalog):
+    return Table(read_catalog(shape_catalog, shear_map_columns), copy=False)
+
+def test_tile_lookup(catalog):
+    ra, dec = np.asarray(catalog['ra']), np.asarray(catalog['dec'])
+    nx = tile_size(tiling['tile_nside'], tiling['pixel_size'],
+                   tiling['overlap'])
+    lookup = TileLookup(ra, dec, tiling['tile_nside'], nx,
+                        tiling['pixel_size'])
+    assert_array_equal(lookup.tiles,
+                       np.unique(hp.ang2pix(16, ra, dec, lonlat=True)))
+
+    # Members include all the galaxies within the circumscribed disc
+    for tile in lookup.tiles:
+        vec = np.array(hp.pix2vec(16, tile))
+        dist = np.arccos(np.clip(np.dot(hp.ang2vec(ra, dec, lonlat=True),
+                                        vec), -1, 1))
+        members = lookup.members(tile)
+        assert len(np.unique(members)) == len(members)
+        assert np.all(np.isin(np.nonzero(dist < lookup.radius)[0], members))
+
+def test_tiles_match_single_patch(catalog):
+    tiles = list(iter_tiled_convergence_maps(catalog, tiling, algorithm))
+    assert len(tiles) > 1
+    nx = tile_size(tiling['tile_nside'], tiling['pixel_size'],
+                   tiling['overlap'])
+    for tile in tiles:
+        projection = {'type': 'gnomonic', 'center_ra': tile['center_ra'],
+                      'center_dec': tile['center_dec'], 'nx': nx, 'ny': nx,
+                      'pixel_size': tiling['pixel_size']}
+        maps = compute_shear_map(catalog, projection)
+        kappa = compute_convergence_map(maps, algorithm)
+        assert tile['ngal'] == maps['nmap'].sum()
+        assert_allclose(tile['kappa_e'], kappa['kappa_e'], atol=1e-12)
+        assert_allclose(tile['kappa_b'], kappa['kappa_b'], atol=1e-12)
+
+    # Tiles computed in parallel are returned in the same order
+    parallel = list(iter_tiled_convergence_maps(catalog, tiling, algorithm,
+                                                nprocs=2))
+    for tile, other in zip(tiles, parallel):
+        assert tile['tile'] == other['tile']
+        assert_array_equal(tile['kappa_e'], other['kappa_e'])
+
+def test_mosaic(shape_catalog, catalog, tmp_path):
+    config = {'input_filename': shape_catalog, 'tiling': tiling,
+              'algorithm': algorithm,
+              'output_filename': str(tmp_path / 'tiles.fits'),
+              'mosaic_nside': 128,
+              'mosaic_filename': str(tmp_path / 'mosaic.fits')}
+    tiled_convergence_map(config)
+
+    tiles = list(iter_tiled_convergence_maps(catalog, tiling, algorithm))
+    with fits.open(config['output_filename']) as f:
+        assert len(f) == len(tiles) + 1
+        for hdu, tile in zip(f[1:], tiles):
+            assert hdu.header['TILEPIX'] == tile['tile']
+            assert_array_equal(hdu.data[0], tile['kappa_e'])
+
+    # The mosaic covers the HEALpix pixels of the tiles once, each pixel
+    # taking the value of the nearest pixel of its tile
+    pixels, (kappa_e, kappa_b), header = read_partial_map(
+        config['mosaic_filename'], ['kappa_e', 'kappa_b'])
+    assert header['NSIDE'] == 128
+    assert np.all(np.diff(pixels) > 0)
+    parents = hp.nest2ring(16, hp.ring2nest(128, pixels) // 64)
+    assert_array_equal(np.unique(parents), [t['tile'] for t in tiles])
+    assert len(pixels) == 64 * len(tiles)
+    ra, dec = hp.pix2ang(128, pixels, lonlat=True)
+    nx = tiles[0]['kappa_e'].shape[0]
+    for tile in tiles:
+        sel = parents == tile['tile']
+        edges_x, edges_y, _, _ = flat_grid(nx, nx, tiling['pixel_size'],
+                                           tile['center_ra'],
+                                           tile['center_dec'])
+        index = flat_pixel_index(ra[sel], dec[sel], edges_x, edges_y,
+                                 tile['center_ra'], tile['center_dec'])
+        assert np.all(index >= 0)
+        assert_array_equal(kappa_e[sel], tile['kappa_e'].ravel()[index])
+        assert_array_equal(kappa_b[sel], tile['kappa_b'].ravel()[index])
@@ -0,0 +1,338 @@
+# This module maps wide fields with a set of overlapping flat sky tiles,
+# inverted in parallel and optionally mosaicked back onto a HEALpix map
+from optparse import OptionParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import yaml
+import numpy as np
+import healpy as hp
+from astropy.io import fits
+from astropy.table import Table
+
+from .shear_map import (add_metacal_shear, accumulate_shear_map,
+                        normalize_shear_map, shear_map_columns)
+from .projection import flat_grid, flat_pixel_index
+from .kaiser_squires import get_flat_KS_operator
+from .convergence_map import smoothing_scale, write_convergence_map
+from .catalog_io import read_catalog
+from .instrumentation import profile_stage, span
+
+# Resolution of the lookup cells used to assign galaxies to tiles, relative
+# to the resolution of the tiles
+lookup_factor = 8
+
+def tile_size(tile_nside, pixel_size, overlap):
+    """
+    Number of pixels of the side of square tiles covering a HEALpix pixel of
+    resolution `tile_nside` with an overlap of `overlap` [arcmin] on each
+    side, for pixels of `pixel_size` [arcmin]
+    """
+    side = 2 * np.rad2deg(hp.max_pixrad(tile_nside)) * 60. + 2 * overlap
+    return int(np.ceil(side / pixel_size))
+
+def tile_centers(tiles, tile_nside):
+    """
+    Centers (ra, dec) [degrees] of the tiles, centered on the HEALpix pixels
+    `tiles` (RING ordering) of resolution `tile_nside`
+    """
+    return hp.pix2ang(tile_nside, tiles, lonlat=True)
+
+class TileLookup(object):
+    """
+    Assigns galaxies to overlapping tiles in a single pass. Tiles are
+    centered on the HEALpix pixels of resolution `tile_nside` containing
+    galaxies. Galaxies are sorted once by lookup cell, a HEALpix pixel of
+    resolution `lookup_factor * tile_nside`, and each tile gathers the
+    galaxies of the cells overlapping its square.
+
+    Parameters
+    ----------
+    ra, dec: array_like
+        Coordinates of the galaxies [degrees]
+
+    tile_nside: int
+        Resolution of the HEALpix pixels defining the tiles
+
+    nx: int
+        Number of pixels of the side of the tiles
+
+    pixel_size: float
+        Size of the pixels [arcmin]
+    """
+
+    def __init__(self, ra, dec, tile_nside, nx, pixel_size):
+        self.tile_nside = tile_nside
+        self.lookup_nside = lookup_factor * tile_nside
+        npix = hp.nside2npix(self.lookup_nside)
+        cells = hp.ang2pix(self.lookup_nside, ra, dec, lonlat=True)
+        self._order = np.argsort(cells, kind='stable')
+        self._offsets = np.zeros(npix + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=npix), out=self._offsets[1:])
+
+        # Tiles containing galaxies, parents of the occupied cells
+        occupied = np.nonzero(self._offsets[1:] > self._offsets[:-1])[0]
+        parents = hp.ring2nest(self.lookup_nside, occupied) // lookup_factor**2
+        self.tiles = np.unique(hp.nest2ring(tile_nside, parents))
+
+        # Radius of the disc circumscribing a tile
+        self.radius = np.deg2rad(np.sqrt(2) * nx * pixel_size / 120.)
+
+    def members(self, tile):
+        """
+        Indices of the galaxies which may fall in a tile, a superset of the
+        galaxies in the tile
+        """
+        offsets = self._offsets
+        vec = hp.pix2vec(self.tile_nside, tile)
+        cells = hp.query_disc(self.lookup_nside, vec, self.radius,
+                              inclusive=True)
+        cells = cells[offsets[cells + 1] > offsets[cells]]
+        return np.concatenate([self._order[offsets[c]:offsets[c + 1]]
+                               for c in cells])
+
+def tile_convergence_map(ra, dec, g, center_ra, center_dec, nx, pixel_size,
+                         algorithm):
+    """
+    Bins and inverts the shear map of a single tile, see the `flat_ks` and
+    `masked_flat_ks` options of `convergence_map.compute_convergence_map`
+
+    Returns
+    -------
+    kappa_e, kappa_b: (nx,nx) ndarray
+        Convergence maps of the tile
+
+    ngal: int
+        Number of galaxies in the tile
+    """
+    edges_x, edges_y, _, _ = flat_grid(nx, nx, pixel_size, center_ra,
+                                       center_dec)
+    pixel_index = flat_pixel_index(ra, dec, edges_x, edges_y, center_ra,
+                                   center_dec)
+    sums = accumulate_shear_map(pixel_index, g, nx * nx)
+    gmap, nmap = normalize_shear_map(*sums, nx=nx, ny=nx)
+
+    sigma = None
+    smoothing = smoothing_scale(algorithm)
+    if smoothing:
+        sigma = smoothing / pixel_size
+    ks = get_flat_KS_operator(nx, nx, algorithm.get('dtype') or 'float64',
+                              zero_padding=algorithm.get('zero_padding') or 0,
+                              sigma=sigma,
+                              fft_backend=algorithm.get('fft_backend'),
+                              fft_threads=algorithm.get('fft_threads'),
+                              fft_wisdom=algorithm.get('fft_wisdom'))
+    if algorithm.get('name') == 'masked_flat_ks':
+        kappa_e, kappa_b, _ = ks.masked(
+            gmap, nmap, regularization=algorithm.get('regularization', 1e-3),
+            bmode_regularization=algorithm.get('bmode_regularization', 1.),
+            tol=algorithm.get('tol', 1e-5),
+            max_iter=algorithm.get('max_iter', 200))
+    else:
+        kappa_e, kappa_b = ks(gmap)
+    return kappa_e, kappa_b, int(nmap.sum())
+
+def iter_tiled_convergence_maps(catalog, tiling, algorithm, nprocs=None):
+    """
+    Computes the convergence maps of overlapping flat sky tiles covering a
+    shape catalog loaded in memory. The shear is calibrated once over the
+    whole catalog, galaxies are assigned to tiles with `TileLookup`,
+    and tiles are binned and inverted in a pool of `nprocs` processes.
+
+    Parameters
+    ----------
+    catalog: table
+        Shape catalog, with at least the `shear_map_columns`
+
+    tiling: dictionary
+        Tiling configuration, with the resolution `tile_nside` of the
+        HEALpix pixels the tiles are centered on, the `pixel_size` [arcmin],
+        and either the `overlap` [arcmin] between neighbouring tiles or the
+        number of pixels `nx` of the side of the tiles
+
+    algorithm: dictionary
+        Options of the 'flat_ks' or 'masked_flat_ks' algorithm, e.g.
+        `smoothing` [arcmin] and `zero_padding` [pixels]
+
+    nprocs: int, optional
+        Number of processes, tiles are processed serially by default
+
+    Yields
+    ------
+    tile: dictionary
+        HEALpix pixel the tile is centered on (`tile`), center (`center_ra`,
+        `center_dec`), convergence maps (`kappa_e`, `kappa_b`) and number of
+        galaxies (`ngal`), in the order of the tiles
+    """
+    c = tiling
+    if algorithm.get('name', 'flat_ks') not in ['flat_ks', 'masked_flat_ks']:
+        raise NotImplementedError
+    tile_nside = c['tile_nside']
+    pixel_size = c['pixel_size']
+    nx = c.get('nx') or tile_size(tile_nside, pixel_size, c.get('overlap', 0.))
+
+    with span('metacal'):
+        catalog = add_metacal_shear(catalog)
+    ra = np.asarray(catalog['ra'])
+    dec = np.asarray(catalog['dec'])
+    g = np.asarray(catalog['g'])
+
+    with span('assignment'):
+        lookup = TileLookup(ra, dec, tile_nside, nx, pixel_size)
+
+    def tasks():
+        for tile in lookup.tiles:
+            index = lookup.members(tile)
+            center_ra, center_dec = tile_centers(tile, tile_nside)
+            yield ({'tile': tile, 'center_ra': center_ra,
+                    'center_dec': center_dec},
+                   (ra[index], dec[index], g[index], center_ra, center_dec,
+                    nx, pixel_size, algorithm))
+
+    if not nprocs or nprocs <= 1:
+        for info, args in tasks():
+            with span('tiles'):
+                info['kappa_e'], info['kappa_b'], info['ngal'] = \
+                    tile_convergence_map(*args)
+            yield info
+        return
+
+    # Bounds the number of tiles in flight, so that only a few copies of
+    # the galaxies of a tile are held at once, and returns them in order
+    with ProcessPoolExecutor(max_workers=nprocs) as pool:
+        pending = deque()
+        for info, args in tasks():
+            pending.append((info, pool.submit(tile_convergence_map, *args)))
+            if len(pending) >= 2 * nprocs:
+                info, future = pending.popleft()
+                with span('tiles'):
+                    info['kappa_e'], info['kappa_b'], info['ngal'] = future.result()
+                yield info
+        while pending:
+            info, future = pending.popleft()
+            with span('tiles'):
+                info['kappa_e'], info['kappa_b'], info['ngal'] = future.result()
+            yield info
+
+def mosaic_tile(tile, tile_nside, mosaic_nside, pixel_size):
+    """
+    Samples the convergence maps of a tile on the HEALpix pixels of
+    resolution `mosaic_nside` falling in the HEALpix pixel the tile is
+    centered on, so that the overlap between tiles is trimmed and each pixel
+    of the mosaic comes from a single tile
+
+    Parameters
+    ----------
+    tile: dictionary
+        Tile, as returned by `iter_tiled_convergence_maps`
+
+    tile_nside: int
+        Resolution of the HEALpix pixels defining the tiles
+
+    mosaic_nside: int
+        Resolution of the mosaic, a multiple of `tile_nside`
+
+    pixel_size: float
+        Size of the pixels of the tile [arcmin]
+
+    Returns
+    -------
+    pixels: int array
+        Pixels of the mosaic (RING ordering)
+
+    kappa_e, kappa_b: ndarray
+        Convergence at the center of the pixels, from the nearest pixel of
+        the tile
+    """
+    k = mosaic_nside // tile_nside
+    nest = hp.ring2nest(tile_nside, tile['tile']) * k * k + np.arange(k * k)
+    pixels = np.sort(hp.nest2ring(mosaic_nside, nest))
+
+    ra, dec = hp.pix2ang(mosaic_nside, pixels, lonlat=True)
+    ny, nx = tile['kappa_e'].shape
+    edges_x, edges_y, _, _ = flat_grid(nx, ny, pixel_size, tile['center_ra'],
+                                       tile['center_dec'])
+    index = flat_pixel_index(ra, dec, edges_x, edges_y, tile['center_ra'],
+                             tile['center_dec'])
+    assert (index >= 0).all(), "Tiles do not cover their HEALpix pixel"
+    return (pixels, tile['kappa_e'].ravel()[index],
+            tile['kappa_b'].ravel()[index])
+
+def tiled_convergence_map(config):
+    """
+    Computes convergence maps of a wide field with overlapping flat sky
+    tiles, reading the shape catalog once, see `iter_tiled_convergence_maps`.
+
+    Each tile is saved as an image extension of shape (2,nx,nx) holding the
+    E and B mode maps, with the HEALpix pixel it is centered on (TILEPIX),
+    its center (CENTRA, CENTDEC), its pixel size (PIXSIZE) and number of
+    galaxies (NGAL) in its header. If `mosaic_nside` and `mosaic_filename`
+    are set, the overlap-trimmed tiles are also mosaicked onto a partial sky
+    HEALpix map, see `mosaic_tile`.
+
+    Parameters
+    ----------
+        config: dictionary
+            Configuration dictionary read from yaml config file, with the
+            `tiling` and `algorithm` configurations and the number of
+            processes `nprocs`. If `profile` is set, the time, memory and
+            I/O of each phase are saved next to the output, see
+            `instrumentation.profile_stage`.
+    """
+    c = config['tiling']
+    mosaic_nside = config.get('mosaic_nside')
+    if mosaic_nside is not None and mosaic_nside % c['tile_nside']:
+        raise ValueError("The mosaic resolution must be a multiple of tile_nside")
+
+    with profile_stage('tiled_convergence_map', config.get('profile'),
+                       config['output_filename']):
+        with span('read'):
+            catalog = Table(read_catalog(config['input_filename'],
+                                         shear_map_columns), copy=False)
+
+        phdu = fits.PrimaryHDU()
+        phdu.header['TILENSID'] = (c['tile_nside'], 'Resolution of the tile centers')
+        phdu.header['PIXSIZE'] = (c['pixel_size'], 'Pixel size [arcmin]')
+        phdu.writeto(config['output_filename'])
+
+        mosaic = []
+        for tile in iter_tiled_convergence_maps(catalog, c, config['algorithm'],
+                                                config.get('nprocs')):
+            with span('write'):
+                # Tiles are appended as they are computed, without reopening
+                # the extensions already written
+                data = np.stack([tile['kappa_e'], tile['kappa_b']])
+                hdr = fits.ImageHDU(data).header
+                hdr['TILEPIX'] = (int(tile['tile']), 'HEALpix pixel of the tile center')
+                hdr['CENTRA'] = (float(tile['center_ra']), 'Center of the tile [deg]')
+                hdr['CENTDEC'] = (float(tile['center_dec']), 'Center of the tile [deg]')
+                hdr['PIXSIZE'] = (c['pixel_size'], 'Pixel size [arcmin]')
+                hdr['NGAL'] = (tile['ngal'], 'Number of galaxies in the tile')
+                with fits.StreamingHDU(config['output_filename'], hdr) as hdu:
+                    hdu.write(data)
+            if mosaic_nside is not None:
+                with span('mosaic'):
+                    mosaic.append(mosaic_tile(tile, c['tile_nside'],
+                                              mosaic_nside, c['pixel_size']))
+
+        if mosaic_nside is not None and config.get('mosaic_filename'):
+            with span('write'):
+                if mosaic:
+                    pixels, kappa_e, kappa_b = [np.concatenate(x)
+                                                for x in zip(*mosaic)]
+                else:
+                    pixels = np.zeros(0, dtype=np.int64)
+                    kappa_e = kappa_b = np.zeros(0)
+                order = np.argsort(pixels)
+                write_convergence_map(config['mosaic_filename'], kappa_e[order],
+                                      kappa_b[order], pixels=pixels[order],
+                                      nside=mosaic_nside)
+
+if __name__ == "__main__":
+
+    parser = OptionParser()
+    (options, args) = parser.parse_args()
+
+    with open(args[0]) as f:
+        config = yaml.safe_load(f)
+
+    tiled_convergence_map(config['tiled_convergence_map'])
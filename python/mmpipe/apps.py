@@ -1,34 +1,48 @@
 from ceci import PipelineStage
 from descformats import HDFFile, YamlFile, FitsFile
 from descformats.tx import MetacalCatalog, TomographyCatalog
-from desc.wlmassmap.mocks.extract_footprint import extract_footprint
-from desc.wlmassmap.mocks.mock_observation import mock_observation
-from desc.wlmassmap.shear_map import shear_map
-from desc.wlmassmap.convergence_map import convergence_map
 from collections import defaultdict
 
-class extractFootprintPipe(PipelineStage):
+from .cache import CachedStage
+from .registry import LazyStage
+
+# The functions running the stages, and their dependencies, are only imported
+# by the stage being run, see `registry.LazyStage`
+
+class extractFootprintPipe(LazyStage, CachedStage, PipelineStage):
     name = 'extractFootprintPipe'
+    function = 'desc.wlmassmap.mocks.extract_footprint:extract_footprint'
+    dependencies = ['GCRCatalogs', 'healpy', 'h5py', 'astropy.table',
+                    'astropy.io.fits']
     inputs = []
     outputs = [('truth_catalog', HDFFile)]
     config_options = {'catalog':'protoDC2',
                       'ra_range':[0.,5.],
-                      'dec_range':[0.,5.]}
+                      'dec_range':[0.,5.],
+                      'profile':False,
+                      'cache_dir':'',
+                      'cache_max_size':10.}
 
     def run(self):
         config = self.read_config(defaultdict(lambda :None))
         config['output_filename'] = self.get_output('truth_catalog')
         config['footprint'] = {'type':'patch', 'ra_range':config['ra_range'],
                                'dec_range':config['dec_range']}
-        extract_footprint(config)
+        self.run_cached(config, self.load_function())
 
-class mockShearMeasurementPipe(PipelineStage):
+class mockShearMeasurementPipe(LazyStage, CachedStage, PipelineStage):
     name = 'mockShearMeasurementPipe'
+    function = 'desc.wlmassmap.mocks.mock_observation:mock_observation'
+    dependencies = ['h5py', 'astropy.table', 'astropy.io.fits']
     inputs = [('truth_catalog', HDFFile)]
     outputs = [('shear_catalog', MetacalCatalog)]
     config_options = {'reduced_shear':True,
                       'sigma_noise': float,
-                      'delta_gamma': 0.01}
+                      'delta_gamma': 0.01,
+                      'dtype':'float64',
+                      'profile':False,
+                      'cache_dir':'',
+                      'cache_max_size':10.}
 
     def run(self):
         """
@@ -40,17 +54,24 @@ class mockShearMeasurementPipe(PipelineStage):
         config['shape_noise'] = {'type':'Gaussian', 'sigma':config['sigma_noise']}
         config['format'] = {'type':'metacal', 'R':[[1,0],[0,1]],
                             'delta_gamma':config['delta_gamma']}
-        mock_observation(config)
+        self.run_cached(config, self.load_function())
 
-class shearMapPipe(PipelineStage):
+class shearMapPipe(LazyStage, CachedStage, PipelineStage):
     name = 'shearMapPipe'
+    function = 'desc.wlmassmap.shear_map:shear_map'
+    dependencies = ['h5py', 'astropy.table', 'astropy.io.fits']
     inputs = [('shear_catalog', MetacalCatalog)]
     outputs = [('shear_map', FitsFile)]
     config_options = {'center_ra':float,
                       'center_dec':float,
                       'pixel_size':1.,
                       'nx':300,
-                      'ny':300}
+                      'ny':300,
+                      'chunk_size':0,
+                      'dtype':'float64',
+                      'profile':False,
+                      'cache_dir':'',
+                      'cache_max_size':10.}
 
     def run(self):
         config = self.read_config(defaultdict(lambda :None))
@@ -62,15 +83,24 @@ class shearMapPipe(PipelineStage):
                                 'pixel_size':config['pixel_size'],
                                 'nx':config['nx'],
                                 'ny':config['ny']}
-        shear_map(config)
+
+        # When running under MPI, each process bins a slice of the catalog
+        shear_map = self.load_function()
+        self.run_cached(config, lambda c: shear_map(c, comm=self.comm))
 
 
-class convergenceMapPipe(PipelineStage):
+class convergenceMapPipe(LazyStage, CachedStage, PipelineStage):
     name = 'convergenceMapPipe'
+    function = 'desc.wlmassmap.convergence_map:convergence_map'
+    dependencies = ['astropy.io.fits']
     inputs = [('shear_map', FitsFile)]
     outputs = [('converenge_map', FitsFile)]
     config_options = {'smoothing':1.,
-                      'zero_padding': 128}
+                      'zero_padding': 128,
+                      'dtype':'float64',
+                      'profile':False,
+                      'cache_dir':'',
+                      'cache_max_size':10.}
 
     def run(self):
         config = self.read_config(defaultdict(lambda :None))
@@ -79,7 +109,7 @@ class convergenceMapPipe(PipelineStage):
         config['algorithm'] = {'name':'flat_ks',
                                 'smoothing':config['smoothing'],
                                 'zero_padding':config['zero_padding']}
-        convergence_map(config)
+        self.run_cached(config, self.load_function())
 
 if __name__ == '__main__':
     cls = PipelineStage.main()
@@ -0,0 +1,307 @@
+# This module caches the outputs of the pipeline stages in a local
+# directory, keyed on a hash of their configuration, inputs and code version,
+# so that stages whose inputs did not change are not run again
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Configuration options which do not change the outputs of a stage
+_ignored_options = ['input_filename', 'output_filename', 'cache_dir',
+                    'cache_max_size', 'profile']
+
+# Number of file digests remembered in the cache directory
+_max_digests = 4096
+
+def file_digest(filename, block_size=16777216):
+    """
+    Hash of the content of a file
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+@lru_cache(maxsize=None)
+def code_version():
+    """
+    Hash of the sources of the `desc.wlmassmap` and `mmpipe` packages, so
+    that any change of the code invalidates the cached outputs. The tests
+    do not affect the outputs and are left out.
+    """
+    import desc.wlmassmap
+    h = hashlib.blake2b(digest_size=20)
+    for package in [os.path.dirname(desc.wlmassmap.__file__),
+                    os.path.dirname(__file__)]:
+        for root, dirs, files in os.walk(package):
+            # Pruned and sorted in place, so that the walk is reproducible
+            dirs[:] = sorted(d for d in dirs if d != 'tests')
+            for name in sorted(files):
+                if name.endswith('.py'):
+                    filename = os.path.join(root, name)
+                    h.update(os.path.relpath(filename, package).encode())
+                    with open(filename, 'rb') as f:
+                        h.update(f.read())
+    return h.hexdigest()
+
+class StageCache(object):
+    """
+    Local cache of stage outputs with a least recently used eviction policy.
+
+    Each entry is a directory named after the key of a stage run, see `key`,
+    holding a copy of its output files and a `meta.json` file describing
+    them. The modification time of `meta.json` records the last use of the
+    entry. When the total size of the cache exceeds `max_size`, the least
+    recently used entries are removed.
+
+    Hashing the content of large catalogs is costly, the digests of the input
+    files are therefore remembered, keyed on their inode, size and
+    modification time: an input is only hashed again when it is rewritten, and
+    the outputs restored or stored by the cache never need to be hashed by the
+    following stages. Touching a file without changing it costs one hash but
+    does not invalidate the outputs depending on it.
+
+    Parameters
+    ----------
+    cache_dir: string
+        Directory of the cache, created if needed
+
+    max_size: float, optional
+        Maximum size of the cache [GB], unlimited by default
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._digests_filename = os.path.join(cache_dir, 'digests.json')
+        try:
+            with open(self._digests_filename) as f:
+                self._digests = json.load(f)
+        except (IOError, OSError, ValueError):
+            self._digests = {}
+
+    @staticmethod
+    def _file_id(filename):
+        st = os.stat(filename)
+        return '%d:%d:%d:%d' % (st.st_dev, st.st_ino, st.st_size,
+                                st.st_mtime_ns)
+
+    def _remember(self, filename, digest):
+        self._digests[self._file_id(filename)] = [time.time(), digest]
+
+    def _save_digests(self):
+        digests = sorted(self._digests.items(), key=lambda d: d[1][0])
+        self._digests = dict(digests[-_max_digests:])
+        tmp = '%s.%d' % (self._digests_filename, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._digests, f)
+        os.replace(tmp, self._digests_filename)
+
+    def digest(self, filename):
+        """
+        Hash of the content of a file, only computed if the file changed
+        since it was last hashed
+        """
+        file_id = self._file_id(filename)
+        if file_id not in self._digests:
+            self._digests[file_id] = [time.time(), file_digest(filename)]
+            self._save_digests()
+        return self._digests[file_id][1]
+
+    def key(self, name, config, inputs):
+        """
+        Key of a stage run, hashing the name of the stage, its configuration,
+        the content of its input files and the version of the code
+
+        Parameters
+        ----------
+        name: string
+            Name of the stage
+
+        config: dictionary
+            Configuration of the stage. Input and output filenames, and
+            options not affecting the outputs, are ignored.
+
+        inputs: dictionary
+            Input files of the stage, keyed by tag
+        """
+        options = {k: v for k, v in config.items()
+                   if k not in _ignored_options}
+        description = {'stage': name,
+                       'config': options,
+                       'inputs': {tag: self.digest(filename)
+                                  for tag, filename in inputs.items()},
+                       'code_version': code_version()}
+        description = json.dumps(description, sort_keys=True, default=repr)
+        return hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, outputs):
+        """
+        Copies the cached outputs of a stage run to their destination
+
+        Parameters
+        ----------
+        key: string
+            Key of the stage run
+
+        outputs: dictionary
+            Destination of the output files, keyed by tag
+
+        Returns
+        -------
+        hit: bool
+            Whether the outputs were found in the cache
+        """
+        meta_filename = os.path.join(self._entry(key), 'meta.json')
+        try:
+            with open(meta_filename) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        if set(meta['files']) != set(outputs):
+            return False
+
+        for tag, filename in outputs.items():
+            entry = meta['files'][tag]
+            shutil.copyfile(os.path.join(self._entry(key), entry['name']),
+                            filename)
+            self._remember(filename, entry['digest'])
+        self._save_digests()
+        os.utime(meta_filename)
+        return True
+
+    def store(self, key, outputs, name=None):
+        """
+        Copies the outputs of a stage run in the cache, then evicts the least
+        recently used entries if the cache is too large
+
+        Parameters
+        ----------
+        key: string
+            Key of the stage run
+
+        outputs: dictionary
+            Output files of the stage, keyed by tag
+
+        name: string, optional
+            Name of the stage, for reference
+        """
+        # The entry is written in a temporary directory then renamed, so that
+        # concurrent runs never see an incomplete entry
+        tmp = os.path.join(self.cache_dir, '.%s.%d' % (key, os.getpid()))
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        meta = {'stage': name, 'created': time.time(), 'files': {}}
+        for tag, filename in outputs.items():
+            entry = tag + os.path.splitext(filename)[1]
+            shutil.copyfile(filename, os.path.join(tmp, entry))
+            digest = self.digest(filename)
+            meta['files'][tag] = {'name': entry, 'digest': digest,
+                                  'size': os.path.getsize(filename)}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        try:
+            os.rename(tmp, self._entry(key))
+        except OSError:
+            # Stored in the meantime by another run
+            shutil.rmtree(tmp)
+        self.evict(keep=key)
+
+    def entries(self):
+        """
+        Entries of the cache as a list of (last use, size, key), least
+        recently used first
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            meta_filename = os.path.join(self._entry(key), 'meta.json')
+            if key.startswith('.') or not os.path.isfile(meta_filename):
+                continue
+            size = sum(os.path.getsize(os.path.join(self._entry(key), name))
+                       for name in os.listdir(self._entry(key)))
+            entries.append((os.path.getmtime(meta_filename), size, key))
+        return sorted(entries)
+
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the size of the cache
+        is below `max_size`, except the entry `keep`
+        """
+        if self.max_size is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size * 1e9:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
+
+class CachedStage(object):
+    """
+    Mixin of the pipeline stages, skipping stages whose outputs are found in
+    the cache. Caching is enabled by the `cache_dir` option, in the section
+    of a stage or in the `global` section of the configuration file, and the
+    size of the cache is limited by the `cache_max_size` option [GB].
+    """
+
+    def run_cached(self, config, run):
+        """
+        Runs a stage, unless its outputs are cached
+
+        Parameters
+        ----------
+        config: dictionary
+            Configuration of the stage
+
+        run: callable
+            Function running the stage, called as run(config)
+        """
+        # Progress of the stages is reported through logging, unless the
+        # application configured it already
+        logging.basicConfig(level=logging.INFO)
+
+        if not config.get('cache_dir'):
+            run(config)
+            return
+
+        # Only the root process accesses the cache when running under MPI
+        comm = self.comm
+        inputs = {tag: self.get_input(tag) for tag in self.input_tags()}
+        outputs = {tag: self.get_output(tag) for tag in self.output_tags()}
+        hit = False
+        if self.rank == 0:
+            cache = StageCache(config['cache_dir'],
+                               config.get('cache_max_size') or None)
+            key = cache.key(self.name, config, inputs)
+            hit = cache.fetch(key, outputs)
+        if comm is not None:
+            hit = comm.bcast(hit, root=0)
+        if hit:
+            if self.rank == 0:
+                logger.info("Outputs of %s restored from cache %s", self.name, key)
+            return
+
+        run(config)
+        if comm is not None:
+            comm.Barrier()
+        if self.rank == 0:
+            cache.store(key, outputs, self.name)
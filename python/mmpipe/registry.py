@@ -0,0 +1,38 @@
+# This module keeps track of the pipeline stages and of the functions running
+# them, so that the modules a stage depends on are only imported when that
+# stage runs, instead of whenever the mmpipe package is imported
+import importlib
+
+# Stage classes, keyed by name
+stage_registry = {}
+
+class LazyStage(object):
+    """
+    Mixin of the pipeline stages, registering them in `stage_registry`.
+
+    Stages declare the function running them as a 'module:function' string
+    in `function`, and the heavy modules it needs in `dependencies`. The
+    function is imported by `load_function`, when the stage runs, so that
+    starting a stage does not import the dependencies of all the others.
+    """
+    function = None
+    dependencies = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.function is not None:
+            stage_registry[cls.name] = cls
+
+    @classmethod
+    def load_function(cls):
+        """
+        Imports and returns the function running the stage
+        """
+        module, name = cls.function.split(':')
+        return getattr(importlib.import_module(module), name)
+
+def stage_dependencies():
+    """
+    Modules imported by each registered stage, keyed by stage name
+    """
+    return {name: list(cls.dependencies) for name, cls in stage_registry.items()}